@@ -0,0 +1,86 @@
+
+"""
+Measures the throughput of #serve_file() for a large file with the Flask test client, when the
+file is sent by the application (as a whole and in `Range` requests of 1 MiB) and when it is
+offloaded to the web server with `X-Accel-Redirect`. The Werkzeug test client has no
+`wsgi.file_wrapper`, so the direct numbers are a lower bound for servers that use `sendfile()`.
+
+    $ python benchmarks/file_serving.py --size 64 --requests 50
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from typing import Optional, Tuple
+
+import flask
+
+from feedr_backend.app.files import X_ACCEL_REDIRECT, serve_file
+from feedr_backend.model import init_db, session
+from feedr_backend.model.file import File, LocalStorageManager, init_storage
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def create_app(file_id: int, offload: Optional[str]) -> flask.Flask:
+  app = flask.Flask(__name__)
+  app.config['FEEDR_FILE_OFFLOAD'] = offload
+
+  @app.route('/file')
+  def get_file():
+    return serve_file(File.get(id=file_id).instance)
+
+  @app.teardown_request
+  def _teardown(error):
+    session.remove()
+
+  return app
+
+
+def run(app: flask.Flask, requests: int, size: int, ranges: bool = False) -> Tuple[float, float]:
+  client = app.test_client()
+  transferred = 0
+  start = time.perf_counter()
+  for i in range(requests):
+    headers = {}
+    if ranges:
+      offset = (i * CHUNK_SIZE) % size
+      headers['Range'] = f'bytes={offset}-{offset + CHUNK_SIZE - 1}'
+    response = client.get('/file', headers=headers)
+    assert response.status_code in (200, 206), response
+    transferred += len(response.get_data())
+  elapsed = time.perf_counter() - start
+  return transferred / elapsed / CHUNK_SIZE, requests / elapsed
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--size', type=int, default=64, help='The file size in MiB.')
+  parser.add_argument('--requests', type=int, default=50)
+  args = parser.parse_args()
+  size = args.size * CHUNK_SIZE
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    init_db('sqlite:///' + os.path.join(tmpdir, 'benchmark.db'), create_tables=True)
+    init_storage(LocalStorageManager(os.path.join(tmpdir, 'media')))
+    with File.create(mimetype='application/octet-stream', state='benchmark') as (fp, file_):
+      for _ in range(args.size):
+        fp.write(os.urandom(CHUNK_SIZE))
+    session.commit()
+    file_id = file_.id
+    session.remove()
+
+    direct = create_app(file_id, None)
+    offload = create_app(file_id, X_ACCEL_REDIRECT)
+    for name, app, ranges in [
+      ('direct', direct, False),
+      ('direct, 1 MiB ranges', direct, True),
+      ('x-accel-redirect', offload, False),
+    ]:
+      throughput, rate = run(app, args.requests, size, ranges)
+      print(f'{name:22s}: {throughput:10.1f} MiB/s {rate:10.1f} requests/s')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,55 @@
+
+"""
+Measures the time spent in #SessionManager.before_request() for an anonymous request that
+needs a redirect decision, with 1 and 50 `no_redirect_patterns`. Compares the previous
+implementation that calls #fnmatch.fnmatch() for every pattern with the #PathMatcher.
+
+    $ python benchmarks/path_matching.py --iterations 100000
+"""
+
+import argparse
+import fnmatch
+import timeit
+from typing import List
+
+import flask
+
+from feedr_backend.app.session import PathMatcher, SessionManager
+
+
+def get_patterns(count: int) -> List[str]:
+  patterns = ['/api/*']
+  patterns += [f'/static/{i}/*.js' for i in range(count // 2)]
+  patterns += [f'/public/{i}/*' for i in range(count - len(patterns))]
+  return patterns[:count]
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--iterations', type=int, default=100000)
+  args = parser.parse_args()
+
+  app = flask.Flask(__name__)
+  app.secret_key = 'benchmark'
+  app.add_url_rule('/feeds/<int:feed_id>', 'feed', lambda feed_id: '')
+  app.add_url_rule('/api/user/<int:user_id>', 'user', lambda user_id: '')
+
+  for count in (1, 50):
+    patterns = get_patterns(count)
+    session_manager = SessionManager('/login', patterns, 'P1D')
+    matcher = PathMatcher(patterns)
+    for path in ('/feeds/42', '/api/user/42'):
+      with app.test_request_context(path):
+        flask.request.url_rule  # Trigger the URL matching outside of the measurement.
+        hook = timeit.timeit(session_manager.before_request, number=args.iterations)
+        loop = timeit.timeit(lambda: any(fnmatch.fnmatch(path, p) for p in patterns),
+          number=args.iterations)
+        compiled = timeit.timeit(lambda: matcher(path), number=args.iterations)
+      print(f'{count:2d} pattern(s), {path:14s}: '
+        f'before_request {hook / args.iterations * 1e6:6.2f} us, '
+        f'fnmatch loop {loop / args.iterations * 1e6:6.2f} us, '
+        f'PathMatcher {compiled / args.iterations * 1e6:6.2f} us')
+
+
+if __name__ == '__main__':
+  main()
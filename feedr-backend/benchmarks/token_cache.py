@@ -0,0 +1,79 @@
+
+"""
+Measures the number of authenticated requests per second that the #SessionManager can serve
+with and without the #TokenCache, using the Flask test client and a temporary SQLite database.
+
+    $ python benchmarks/token_cache.py --requests 5000
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from typing import Optional
+
+import flask
+
+from feedr_backend.app._base import register_component
+from feedr_backend.app.session import SessionManager, TokenCache
+from feedr_backend.model import init_db, session
+from feedr_backend.model.user import User
+
+
+def create_app(token_cache: Optional[TokenCache]) -> flask.Flask:
+  app = flask.Flask(__name__)
+  app.secret_key = 'benchmark'
+  session_manager = SessionManager(None, [], 'P1D', token_cache=token_cache)
+  register_component(session_manager, app)
+
+  @app.route('/api/ping')
+  def ping():
+    return str(session_manager.current_user_id)
+
+  @app.teardown_request
+  def _teardown(error):
+    session.remove()
+
+  return app
+
+
+def run(token_value: str, token_cache: Optional[TokenCache], requests: int) -> float:
+  app = create_app(token_cache)
+  client = app.test_client()
+  with client.session_transaction() as flask_session:
+    flask_session['FEEDR_TOKEN'] = token_value
+
+  for _ in range(min(requests, 100)):
+    client.get('/api/ping')
+
+  start = time.perf_counter()
+  for _ in range(requests):
+    response = client.get('/api/ping')
+    assert response.status_code == 200 and response.data != b'None', response
+  return requests / (time.perf_counter() - start)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--requests', type=int, default=2000)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    init_db('sqlite:///' + os.path.join(tmpdir, 'benchmark.db'), create_tables=True)
+    user = User(user_name='benchmark')
+    session.add(user)
+    token = user.create_token(datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    session.commit()
+    token_value = token.value
+    session.remove()
+
+    without_cache = run(token_value, None, args.requests)
+    with_cache = run(token_value, TokenCache(), args.requests)
+
+  print(f'without cache: {without_cache:10.1f} requests/s')
+  print(f'with cache:    {with_cache:10.1f} requests/s ({with_cache / without_cache:.2f}x)')
+
+
+if __name__ == '__main__':
+  main()
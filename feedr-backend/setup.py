@@ -38,9 +38,9 @@ setuptools.setup(
   package_dir = {'': 'src'},
   include_package_data = True,
   install_requires = requirements,
-  extras_require = {},
+  extras_require = {'images': ['Pillow >=7.0.0,<8.0.0']},
   tests_require = [],
-  python_requires = '>=3.5.0,<4.0.0',
+  python_requires = '>=3.7.0,<4.0.0',
   data_files = [],
   entry_points = {},
   cmdclass = {},
@@ -1,17 +1,28 @@
 
 import logging
-from typing import cast
+import os
+import socket
+import sys
+import time
+from typing import List, Optional, Union, cast
 
 import click
 import nr.proxy
 
 from .app import create_app
+from .auth.state import SocketLoginStateStoreConfig
+from .metrics import init_metrics
 from .config import Config
 from .model import init_db
-from .model.file import LocalStorageManager, init_storage
+from .model.file import (CachingStorageManager, ContentAddressedStorageManager,
+  LocalStorageManager, StorageManager, init_storage)
+from .model.orphans import SweepOrphanedFilesTask
 from .model.rss import load_feed, UpdateRssFeedsTask
-from .model.task import queue_task
-from .task_worker import BackgroundDispatcher, TaskWorker
+from .model.user import SweepExpiredTask
+from .model.task import (InProcessTaskExecutor, PurgeTasksTask, Task, TaskExecutor, TaskStatus,
+  set_task_outbox)
+from .task_worker import (AsyncTaskWorker, ProcessTaskExecutor, RecurringTask, Scheduler,
+  TaskWorker, run_isolated_job)
 
 logger = logging.getLogger(__name__)
 config: Config = nr.proxy.proxy[Config]()  # type: ignore
@@ -24,32 +35,173 @@ config: Config = nr.proxy.proxy[Config]()  # type: ignore
 def cli(ctx: click.Context, config_file: str, create_tables: bool):
   logging.basicConfig(level=logging.INFO)
   nr.proxy.set_value(cast(nr.proxy.proxy, config), Config.load(config_file))
-  init_db(config.database.url, create_tables=create_tables)
-  init_storage(LocalStorageManager(config.media_directory))
+  init_db(
+    config.database.url,
+    create_tables=create_tables,
+    task_db_url=config.task_database.url if config.task_database else None)
+  set_task_outbox(config.tasks.outbox)
+  storage_manager: StorageManager
+  if config.files.content_addressed:
+    storage_manager = ContentAddressedStorageManager(config.media_directory)
+  else:
+    storage_manager = LocalStorageManager(config.media_directory)
+  if config.files.cache_size > 0:
+    storage_manager = CachingStorageManager(storage_manager, config.files.cache_size,
+      config.files.cache_max_file_size)
+  init_storage(storage_manager)
 
 
-@cli.command()
-def start():
-  task_worker = TaskWorker('main_task_worker')
-  dispatcher = BackgroundDispatcher()
+def _get_task_executor() -> TaskExecutor:
+  memory_limit = config.tasks.memory_limit
+  time_limit = config.tasks.time_limit.total_seconds() if config.tasks.time_limit else None
+  if not config.tasks.isolated:
+    return InProcessTaskExecutor(time_limit)
+  config_file = click.get_current_context().find_root().params['config_file']
+  return ProcessTaskExecutor(
+    [sys.executable, '-m', 'feedr_backend', '-c', config_file, 'tasks', 'exec'],
+    memory_limit=memory_limit * 1024 * 1024 if memory_limit is not None else None,
+    time_limit=time_limit)
+
+
+def _get_process_id(name: str) -> str:
+  return f'{socket.gethostname()}:{os.getpid()}:{name}'
+
+
+def _get_task_workers(
+  name: str,
+  concurrency: Optional[int] = None,
+) -> List[Union[TaskWorker, AsyncTaskWorker]]:
+  """
+  Create the task workers for this process. If `tasks.async_concurrency` is configured, a
+  single #AsyncTaskWorker executes up to *concurrency* tasks (defaults to the configured
+  value), otherwise *concurrency* #TaskWorker threads are created (defaults to one).
+  """
+
+  if config.tasks.async_concurrency is not None:
+    if config.tasks.isolated:
+      raise click.UsageError('tasks.async_concurrency and tasks.isolated are mutually exclusive')
+    return [AsyncTaskWorker(
+      _get_process_id(name),
+      concurrency=concurrency or config.tasks.async_concurrency,
+      time_limit=config.tasks.time_limit.total_seconds() if config.tasks.time_limit else None)]
+  executor = _get_task_executor()
+  return [TaskWorker(_get_process_id(f'{name}-{i}'), executor=executor) for i in range(concurrency or 1)]
 
+
+def _get_scheduler() -> Scheduler:
+  retention = config.tasks.retention
+  return Scheduler(_get_process_id('scheduler'), [
+    RecurringTask(
+      'rss.update',
+      'Update RSS Feeds',
+      UpdateRssFeedsTask(config.rss.update_interval),
+      config.rss.update_interval),
+    RecurringTask(
+      'tasks.purge',
+      'Purge Finished Tasks',
+      PurgeTasksTask(retention.max_age, retention.batch_size, retention.archive),
+      retention.interval),
+    RecurringTask(
+      'user.sweep_expired',
+      'Sweep Expired Tokens and Login States',
+      SweepExpiredTask(),
+      config.session.sweep_interval),
+    RecurringTask(
+      'files.sweep_orphans',
+      'Sweep Orphaned Files',
+      SweepOrphanedFilesTask(config.files.orphan_sweep_shards),
+      config.files.orphan_sweep_interval),
+  ])
+
+
+def _run_threads(threads: List[Union[TaskWorker, AsyncTaskWorker, Scheduler]]) -> None:
+  """
+  Run the *threads* until they exit or until the process is interrupted, then stop them.
+  """
+
+  for thread in threads:
+    thread.start()
   try:
-    task_worker.start()
-    dispatcher.start()
+    while any(thread.is_alive() for thread in threads):
+      time.sleep(1)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    logger.info('Stopping %d thread(s)', len(threads))
+    for thread in threads:
+      thread.stop()
+    for thread in threads:
+      thread.join()
 
-    dispatcher.push_recurring(
-      config.rss.update_interval.total_seconds(),
-      lambda: queue_task('Update RSS Feeds', UpdateRssFeedsTask(config.rss.update_interval)))
 
+@cli.command()
+@click.option('--web-only', is_flag=True, help='Do not run a task worker and scheduler.')
+def start(web_only):
+  """
+  Run the development server, by default together with a task worker and scheduler.
+  """
+
+  init_metrics(config.metrics.directory, config.metrics.flush_interval.total_seconds())
+  threads: List[Union[TaskWorker, AsyncTaskWorker, Scheduler]] = []
+  if not web_only:
+    threads += _get_task_workers('main_task_worker')
+    threads.append(_get_scheduler())
+
+  try:
+    for thread in threads:
+      thread.start()
     app = create_app(config)
     app.run(port=8000, debug=config.debug)
   finally:
-    logger.info('Stopping main task worker')
-    task_worker.stop()
-    dispatcher.stop()
-    task_worker.join()
-    dispatcher.join()
+    logger.info('Stopping task worker and scheduler')
+    for thread in threads:
+      thread.stop()
+    for thread in threads:
+      thread.join()
+
+
+@cli.command()
+@click.option('--concurrency', type=int, help='The number of tasks to execute concurrently.')
+def worker(concurrency):
+  """
+  Run task workers without serving HTTP requests. Start multiple worker processes to scale
+  task execution independently from the web server.
+  """
 
+  if concurrency is not None and concurrency < 1:
+    raise click.BadParameter('must be at least 1', param_hint='--concurrency')
+  init_metrics(config.metrics.directory, config.metrics.flush_interval.total_seconds())
+  _run_threads(list(_get_task_workers('worker', concurrency)))
+
+
+@cli.command()
+def scheduler():
+  """
+  Run the scheduler that keeps the recurring tasks queued. Multiple schedulers can run for
+  availability, only one of them is elected to enqueue the tasks.
+  """
+
+  init_metrics(config.metrics.directory, config.metrics.flush_interval.total_seconds())
+  _run_threads([_get_scheduler()])
+
+
+@cli.command('login-state-server')
+def login_state_server():
+  """
+  Serve the login states for all processes on this node. Requires the `socket` login state
+  store in the configuration.
+  """
+
+  if not isinstance(config.auth.state_store, SocketLoginStateStoreConfig):
+    raise click.ClickException('auth.state_store is not configured with type "socket"')
+  if os.path.exists(config.auth.state_store.path):
+    os.remove(config.auth.state_store.path)
+  with config.auth.state_store.get_server() as server:
+    logger.info('Serving login states on "%s"', config.auth.state_store.path)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
 
 
 @cli.command()
@@ -62,5 +214,88 @@ def ingest(url):
   session.commit()
 
 
+@cli.group()
+def tasks():
+  pass
+
+
+@tasks.command('list')
+@click.option('--status', type=click.Choice([x.name for x in TaskStatus]), default=TaskStatus.DEAD.name)
+@click.option('--class-name', help='Only list tasks of this class.')
+@click.option('--limit', type=int, default=50)
+def tasks_list(status, class_name, limit):
+  """
+  Inspect tasks by status, dead tasks by default.
+  """
+
+  from .model import task_session
+
+  query = task_session.query(Task).filter(Task.status == TaskStatus[status])
+  if class_name:
+    query = query.filter(Task.class_name == class_name)
+  for task in query.order_by(Task.id.desc()).limit(limit):
+    click.echo(f'{task.id}\t{task.ended_at or "-"}\t{task.attempts}\t{task.class_name}\t{task.name}')
+    if task.last_error:
+      click.echo(f'\t{task.last_error}')
+
+
+@tasks.command('replay')
+@click.argument('task_ids', type=int, nargs=-1)
+@click.option('--all', 'all_', is_flag=True, help='Replay all dead tasks.')
+@click.option('--class-name', help='Only replay dead tasks of this class.')
+def tasks_replay(task_ids, all_, class_name):
+  """
+  Replay dead tasks in bulk.
+  """
+
+  from .model import task_session
+
+  if not task_ids and not all_ and not class_name:
+    raise click.UsageError('specify TASK_IDS, --all or --class-name')
+  query = task_session.query(Task).filter(Task.status == TaskStatus.DEAD)
+  if task_ids:
+    query = query.filter(Task.id.in_(task_ids))
+  if class_name:
+    query = query.filter(Task.class_name == class_name)
+  click.echo(f'Replayed {Task.replay(query)} task(s).')
+
+
+@tasks.command('cancel')
+@click.argument('task_ids', type=int, nargs=-1, required=True)
+def tasks_cancel(task_ids):
+  """
+  Cancel pending tasks and request the cancellation of running tasks.
+  """
+
+  from .model import task_session
+
+  query = task_session.query(Task).filter(Task.id.in_(task_ids))
+  click.echo(f'Cancelled {Task.request_cancel(query)} task(s).')
+
+
+@tasks.command('log')
+@click.argument('task_id', type=int)
+def tasks_log(task_id):
+  """
+  Print the output of a task that was executed in a separate process.
+  """
+
+  task = Task.get(id=task_id).or_none()
+  if not task:
+    raise click.ClickException(f'task {task_id} does not exist')
+  out = click.get_binary_stream('stdout')
+  for chunk in task.iter_log():
+    out.write(chunk)
+
+
+@tasks.command('exec', hidden=True)
+def tasks_exec():
+  """
+  Executes a task in the child process started by the #ProcessTaskExecutor.
+  """
+
+  sys.exit(run_isolated_job(sys.stdin))
+
+
 if __name__ == '__main__':
   cli()  # pylint: disable-all
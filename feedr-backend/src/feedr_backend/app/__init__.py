@@ -4,35 +4,71 @@ from typing import Dict
 
 from ._base import register_component
 from .auth import AuthComponent
-from .session import SessionManager
+from .files import X_ACCEL_REDIRECT, X_SENDFILE
+from .metrics import MetricsComponent
+from .session import SessionManager, TokenCache, TokenExpiryWriter
+from .tokens import RevocationList, TokenSigner
+from .thumbnails import ThumbnailGenerator
 from .user import UserComponent
 from ..config import Config
-from ..model import session
+from ..model import scoped_sessions
 
 
 def init_app(app: flask.Flask, config: Config) -> None:
 
   @app.teardown_request
   def _teardown(error):
-    if error:
-      session.rollback()
-    else:
-      session.commit()
-    session.remove()
+    for session in scoped_sessions():
+      if error:
+        session.rollback()
+      else:
+        session.commit()
+      session.remove()
 
   app.secret_key = config.secret_key
+  if config.files.offload not in (None, X_ACCEL_REDIRECT, X_SENDFILE):
+    raise ValueError(f'invalid files.offload: {config.files.offload!r}')
+  app.config['FEEDR_FILE_OFFLOAD'] = config.files.offload
+  app.config['FEEDR_FILE_INTERNAL_LOCATION'] = config.files.internal_location
 
+  token_cache = None
+  token_signer = None
+  revocation_list = None
+  expiry_writer = None
+  if config.session.stateless:
+    token_signer = TokenSigner([config.secret_key] + config.session.previous_secret_keys)
+    revocation_list = RevocationList(config.session.revocation_refresh_interval.total_seconds())
+  elif config.session.token_cache.enabled:
+    token_cache = TokenCache(
+      max_size=config.session.token_cache.max_size,
+      ttl=config.session.token_cache.ttl.total_seconds(),
+      version_check_interval=config.session.token_cache.version_check_interval.total_seconds(),
+    )
+  if config.session.sliding_expiration and not config.session.stateless:
+    expiry_writer = TokenExpiryWriter(config.session.expiry_flush_interval.total_seconds())
+    expiry_writer.start()
+
+  # The /metrics endpoint is authenticated with it's own token (see #MetricsConfig.token).
   session_manager = SessionManager(
     login_page_url='/login',
-    no_redirect_patterns=['/api/*'],
-    token_ttl='P1D',
+    no_redirect_patterns=['/api/*', '/metrics'],
+    token_ttl=config.session.token_ttl,
+    token_cache=token_cache,
+    token_signer=token_signer,
+    revocation_list=revocation_list,
+    state_store=config.auth.state_store.get_store(),
+    sliding_expiration=config.session.sliding_expiration,
+    refresh_threshold=config.session.refresh_threshold,
+    expiry_writer=expiry_writer,
   )
 
   auth = AuthComponent(config.auth.handlers, session_manager, '/')
+  thumbnails = ThumbnailGenerator(config.thumbnails.sizes, config.thumbnails.max_workers)
 
+  register_component(MetricsComponent(config.metrics.token), app)
   register_component(session_manager, app)
   register_component(auth, app, '/api/auth')
-  register_component(UserComponent(session_manager), app, '/api/user')
+  register_component(UserComponent(session_manager, thumbnails), app, '/api/user')
 
 
 def create_app(config: Config) -> flask.Flask:
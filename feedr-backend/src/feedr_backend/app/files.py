@@ -0,0 +1,133 @@
+
+"""
+Helpers to serve #File#s from endpoints with HTTP caching. The strong validator of a file is
+derived from #File.state, which holds a hash of the file's contents, so requests with a
+matching `If-None-Match` header are answered with `304 Not Modified` without opening the file.
+
+Files in a local storage can be offloaded to the web server in front of the application by
+setting the `FEEDR_FILE_OFFLOAD` option of the Flask app (see #FilesConfig):
+
+* `x-accel-redirect` responds with an `X-Accel-Redirect` header that points to the file below
+  the internal location `FEEDR_FILE_INTERNAL_LOCATION` (nginx)
+* `x-sendfile` responds with an `X-Sendfile` header with the absolute path of the file (Apache,
+  lighttpd)
+
+Otherwise the file object is passed to the WSGI server's `wsgi.file_wrapper`, which servers
+like Gunicorn implement with `sendfile()`. `Range` requests are supported in both cases.
+"""
+
+import hashlib
+import io
+import os
+from typing import BinaryIO, Optional
+
+import flask
+from flask import abort, send_file
+
+from ..model.file import File, storage
+
+X_ACCEL_REDIRECT = 'x-accel-redirect'
+X_SENDFILE = 'x-sendfile'
+
+#: Cache-Control policy for URLs that always refer to the same file contents (e.g. because
+#: they contain the #file_version()).
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+#: Cache-Control policy for URLs whose file can change. Clients keep a copy but revalidate it
+#: with the ETag on every use.
+CACHE_REVALIDATE = 'no-cache'
+
+#: Cache-Control policy for files that must only be cached by the client.
+CACHE_PRIVATE = 'private, no-cache'
+
+
+def file_etag(file_: File) -> Optional[str]:
+  """
+  Returns the entity tag of the *file_* (without quotes), or `None` if the file has no state.
+  """
+
+  if not file_.state:
+    return None
+  return hashlib.sha1(file_.state.encode('utf8')).hexdigest()
+
+
+def file_version(file_: File) -> Optional[str]:
+  """
+  Returns a short string that changes when the contents of *file_* change, to be included in
+  the URL of a file that is served with #CACHE_IMMUTABLE.
+  """
+
+  etag = file_etag(file_)
+  return etag[:16] if etag else None
+
+
+def serve_file(
+  file_: File,
+  cache_control: str = CACHE_REVALIDATE,
+  filename: Optional[str] = None,
+) -> flask.Response:
+  """
+  Creates a response for the contents of *file_* with an `ETag` and the *cache_control*
+  policy. Responds with `304 Not Modified` if the request's `If-None-Match` header matches,
+  and with `404 Not Found` if the file does not exist in the storage.
+  """
+
+  etag = file_etag(file_)
+  if etag and flask.request.if_none_match.contains_weak(etag):
+    response = flask.Response(status=304)
+  else:
+    response = _offload_file(file_) or _send_file(file_, etag)
+    filename = filename or file_.filename
+    if filename:
+      response.headers.set('Content-Disposition', 'inline', filename=filename)
+  if etag:
+    response.set_etag(etag)
+  response.headers['Cache-Control'] = cache_control
+  return response
+
+
+def _offload_file(file_: File) -> Optional[flask.Response]:
+  offload = flask.current_app.config.get('FEEDR_FILE_OFFLOAD')
+  if offload == X_ACCEL_REDIRECT:
+    location = storage.get_location(file_.file_id)
+    if location is None:
+      return None
+    internal_location = flask.current_app.config.get('FEEDR_FILE_INTERNAL_LOCATION', '/_media/')
+    header = ('X-Accel-Redirect', internal_location.rstrip('/') + '/' + location)
+  elif offload == X_SENDFILE:
+    path = storage.get_path(file_.file_id)
+    if path is None:
+      return None
+    header = ('X-Sendfile', str(path))
+  else:
+    return None
+  response = flask.Response(mimetype=file_.mimetype)
+  response.headers[header[0]] = header[1]
+  return response
+
+
+def _get_size(fp: BinaryIO) -> int:
+  try:
+    return os.fstat(fp.fileno()).st_size
+  except (AttributeError, io.UnsupportedOperation, OSError):
+    size = fp.seek(0, io.SEEK_END)
+    fp.seek(0)
+    return size
+
+
+def _send_file(file_: File, etag: Optional[str]) -> flask.Response:
+  try:
+    fp = file_.open()
+  except FileNotFoundError:
+    abort(404)
+  size = _get_size(fp)
+  response = send_file(
+    fp,
+    mimetype=file_.mimetype,
+    add_etags=False,
+    conditional=False)
+  response.content_length = size
+  if etag:
+    response.set_etag(etag)
+  # Handles `Range` and `If-Range` requests.
+  return response.make_conditional(flask.request, accept_ranges=True, complete_length=size)
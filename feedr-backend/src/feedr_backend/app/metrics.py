@@ -0,0 +1,50 @@
+
+import hmac
+import time
+from typing import Optional
+
+import flask
+from flask import abort
+
+from ._base import Component, route
+from .. import metrics
+
+http_requests = metrics.Counter(
+  'feedr_http_requests_total', 'Number of HTTP requests handled.', ['method', 'endpoint', 'status'])
+http_request_duration = metrics.Histogram(
+  'feedr_http_request_duration_seconds', 'Time spent handling HTTP requests.', ['method', 'endpoint'])
+
+
+class MetricsComponent(Component):
+  """
+  Records metrics for all requests to the application and exposes the metrics of all processes
+  in the Prometheus text format. The `/metrics` endpoint requires the bearer *token* and is
+  not available if no token is specified.
+  """
+
+  def __init__(self, token: Optional[str] = None) -> None:
+    self._token = token
+
+  @route('/metrics')
+  def get_metrics(self) -> flask.Response:
+    if not self._token:
+      abort(404)
+    scheme, _, token = flask.request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(
+        token.encode('utf8'), self._token.encode('utf8')):
+      abort(401)
+    return flask.Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+  # Component
+
+  def before_request(self):
+    flask.g.metrics_start_time = time.perf_counter()
+
+  def after_request(self, response):
+    start_time = flask.g.pop('metrics_start_time', None)
+    endpoint = flask.request.endpoint or 'none'
+    method = flask.request.method
+    http_requests.inc(method=method, endpoint=endpoint, status=str(response.status_code))
+    if start_time is not None:
+      http_request_duration.observe(time.perf_counter() - start_time, method=method, endpoint=endpoint)
+    return response
@@ -1,96 +1,436 @@
 
+import atexit
 import datetime
+import fnmatch
 import logging
+import re
 import threading
-from fnmatch import fnmatch
-from typing import List, Optional, Union, cast
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple, Union
 
 import flask
 from nr.parsing.date import Duration
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import bindparam
 
 from ._base import Component
+from .tokens import RevocationList, SignedToken, TokenSigner
+from .. import metrics
 from ..auth import LoginStateRecorder
-from ..model import session
-from ..model.user import User, Token, LoginState
+from ..auth.state import DatabaseLoginStateStore, LoginStateStore
+from ..model import session, session_context
+from ..model.user import TOKEN_VERSION, User, Token
+from ..model.version import Version
 
 logger = logging.getLogger(__name__)
 
+token_cache_lookups = metrics.Counter(
+  'feedr_token_cache_lookups_total', 'Number of token cache lookups by result.', ['result'])
+token_cache_invalidations = metrics.Counter(
+  'feedr_token_cache_invalidations_total', 'Number of times the token cache was cleared.')
+token_expiry_extensions = metrics.Counter(
+  'feedr_token_expiry_extensions_total', 'Number of times the expiry of a token was extended.')
+
+
+class TokenSnapshot(NamedTuple):
+  """
+  The information of a validated token that is needed to authenticate a request. The
+  *token_id* is the ID of a #Token, or the ID of a #SignedToken in stateless mode.
+  """
+
+  token_id: Union[int, str]
+  user_id: int
+  expiration_date: datetime.datetime
+
+
+class TokenCache:
+  """
+  A bounded, least recently used cache of validated tokens. Entries expire after *ttl*
+  seconds or when the token expires, whichever comes first.
+
+  Revoking a token increments the #TOKEN_VERSION counter in the database. The cache compares
+  the counter with the last value it has seen at most every *version_check_interval* seconds
+  and drops all entries when it changed, so a token revoked in another process is rejected
+  after that interval at the latest.
+  """
+
+  def __init__(
+    self,
+    max_size: int = 10000,
+    ttl: float = 300.0,
+    version_check_interval: float = 1.0,
+  ) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    self.version_check_interval = version_check_interval
+    self._entries: 'OrderedDict[str, Tuple[TokenSnapshot, float]]' = OrderedDict()
+    self._lock = threading.Lock()
+    self._version: Optional[int] = None
+    self._version_checked_at = 0.0
+
+  def _check_version(self) -> int:
+    now = time.monotonic()
+    if self._version is not None and now - self._version_checked_at < self.version_check_interval:
+      return self._version
+    version = Version.get_value(TOKEN_VERSION)
+    with self._lock:
+      if self._version is not None and version != self._version:
+        logger.debug('Token version changed from %d to %d, clearing the token cache',
+          self._version, version)
+        self._entries.clear()
+        token_cache_invalidations.inc()
+      self._version = version
+      self._version_checked_at = now
+    return version
+
+  def get(self, value: str) -> Tuple[Optional[TokenSnapshot], int]:
+    """
+    Look up the token with the specified *value*. Returns the cached snapshot (or #None) and
+    the cache version that must be passed to #put() when the token is loaded from the database.
+    """
+
+    version = self._check_version()
+    with self._lock:
+      entry = self._entries.get(value)
+      if entry is None:
+        token_cache_lookups.inc(result='miss')
+        return None, version
+      snapshot, expires_at = entry
+      if time.monotonic() >= expires_at or datetime.datetime.utcnow() >= snapshot.expiration_date:
+        del self._entries[value]
+        token_cache_lookups.inc(result='expired')
+        return None, version
+      self._entries.move_to_end(value)
+    token_cache_lookups.inc(result='hit')
+    return snapshot, version
+
+  def put(self, value: str, snapshot: TokenSnapshot, version: int) -> None:
+    """
+    Add a validated token to the cache, unless the cache was invalidated since *version* was
+    returned by #get().
+    """
+
+    with self._lock:
+      if version != self._version:
+        return
+      self._entries[value] = (snapshot, time.monotonic() + self.ttl)
+      self._entries.move_to_end(value)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def update(self, value: str, snapshot: TokenSnapshot) -> None:
+    """
+    Replace the snapshot of a token that is already in the cache.
+    """
+
+    with self._lock:
+      entry = self._entries.get(value)
+      if entry is not None:
+        self._entries[value] = (snapshot, entry[1])
+
+  def discard(self, value: str) -> None:
+    with self._lock:
+      self._entries.pop(value, None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+
+
+class TokenExpiryWriter(threading.Thread):
+  """
+  Buffers the extended expiration dates of #Token#s in memory and writes them to the database
+  in batches every *interval* seconds, so that extending the expiry of active sessions does
+  not cost a write per request. Pending updates are also written when the process exits.
+  """
+
+  def __init__(self, interval: float = 5.0, batch_size: int = 500) -> None:
+    super().__init__(daemon=True)
+    self.interval = interval
+    self.batch_size = batch_size
+    self._pending: Dict[int, Tuple[datetime.datetime, datetime.datetime]] = {}
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+
+  def extend(
+    self,
+    token_id: int,
+    expiration_date: datetime.datetime,
+    last_seen_at: datetime.datetime,
+  ) -> None:
+    with self._lock:
+      self._pending[token_id] = (expiration_date, last_seen_at)
+
+  def flush(self) -> None:
+    with self._lock:
+      pending, self._pending = self._pending, {}
+    if not pending:
+      return
+    table = Token.__table__
+    statement = (table.update()
+      .where(table.c.id == bindparam('_id'))
+      .values(
+        expiration_date=bindparam('_expiration_date'),
+        last_seen_at=bindparam('_last_seen_at')))
+    params = [{'_id': token_id, '_expiration_date': expiration_date, '_last_seen_at': last_seen_at}
+      for token_id, (expiration_date, last_seen_at) in pending.items()]
+    with session_context():
+      for offset in range(0, len(params), self.batch_size):
+        session.execute(statement, params[offset:offset + self.batch_size])
+    logger.debug('Extended the expiry of %d token(s)', len(params))
+
+  def start(self) -> None:
+    super().start()
+    atexit.register(self.flush)
+
+  def stop(self) -> None:
+    self._stopped.set()
+
+  def run(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        self.flush()
+      except:
+        logger.exception('Error writing token expiry updates')
+    self.flush()
+
+
+class PathMatcher:
+  """
+  Matches request paths against a list of glob *patterns* with the same semantics as
+  #fnmatch.fnmatchcase(). Patterns of the common form `/prefix/*` are checked with a single
+  #str.startswith() call, all other patterns are compiled into one anchored regular
+  expression.
+  """
+
+  def __init__(self, patterns: List[str]) -> None:
+    prefixes = []
+    others = []
+    for pattern in patterns:
+      if pattern.endswith('*') and not any(c in pattern[:-1] for c in '*?['):
+        prefixes.append(pattern[:-1])
+      else:
+        others.append(pattern)
+    self.patterns = list(patterns)
+    self._prefixes = tuple(prefixes)
+    self._regex: Optional[Pattern[str]] = None
+    if others:
+      self._regex = re.compile('|'.join(f'(?:{fnmatch.translate(p)})' for p in others))
+
+  def __call__(self, path: str) -> bool:
+    if self._prefixes and path.startswith(self._prefixes):
+      return True
+    return self._regex is not None and self._regex.match(path) is not None
+
+  def match_rule(self, rule: str) -> Optional[bool]:
+    """
+    Decide if all paths of the URL *rule* (e.g. `/api/user/<int:user_id>`) match. Returns #None
+    if that depends on the variable parts of the rule.
+    """
+
+    static_prefix, has_variables, _ = rule.partition('<')
+    if not has_variables:
+      return self(rule)
+    if self._prefixes and static_prefix.startswith(self._prefixes):
+      return True
+    return None
+
 
 class SessionManager(Component, LoginStateRecorder):
+  """
+  Authenticates requests by the login token stored in the Flask session. By default, tokens
+  are #Token rows in the database, validated tokens can be cached with a #TokenCache. If a
+  *token_signer* is specified, the manager issues stateless signed tokens instead that are
+  verified without a database query, and revocations are tracked with a #RevocationList.
+  """
 
   def __init__(self,
     login_page_url: Optional[str],
     no_redirect_patterns: List[str],
     token_ttl: Union[str, Duration],
     cookie_name: str = 'FEEDR_TOKEN',
+    token_cache: Optional[TokenCache] = None,
+    token_signer: Optional[TokenSigner] = None,
+    revocation_list: Optional[RevocationList] = None,
+    state_store: Optional[LoginStateStore] = None,
+    sliding_expiration: bool = False,
+    refresh_threshold: float = 0.5,
+    expiry_writer: Optional[TokenExpiryWriter] = None,
   ) -> None:
     if isinstance(token_ttl, str):
       token_ttl = Duration.parse(token_ttl)
     self._login_page_url = login_page_url
-    self._no_redirect_patterns = no_redirect_patterns
+    self._no_redirect = PathMatcher(no_redirect_patterns)
+    self._no_redirect_endpoints: Dict[str, Optional[bool]] = {}
     self._token_ttl = token_ttl
     self._cookie_name = cookie_name
+    self._token_cache = token_cache
+    self._token_signer = token_signer
+    self._revocation_list = revocation_list or (RevocationList() if token_signer else None)
+    self._state_store = state_store or DatabaseLoginStateStore()
+    self._sliding_expiration = sliding_expiration
+    self._refresh_threshold = refresh_threshold
+    self._expiry_writer = expiry_writer
+    if sliding_expiration and not token_signer and not expiry_writer:
+      self._expiry_writer = TokenExpiryWriter()
+      self._expiry_writer.start()
     self._local = threading.local()
 
   @property
   def current_token(self) -> Optional[Token]:
-    return cast(Optional[Token], self._local.token)
+    """
+    The #Token of the current request. Always #None with stateless tokens.
+    """
+
+    snapshot = self._local.token
+    if snapshot is None or self._token_signer:
+      return None
+    return session.query(Token).get(snapshot.token_id)
+
+  @property
+  def current_user_id(self) -> Optional[int]:
+    """
+    The ID of the user that is logged in with the current request. Prefer this over
+    #current_user if the user does not need to be loaded from the database.
+    """
+
+    snapshot = self._local.token
+    return snapshot.user_id if snapshot else None
 
   @property
   def current_user(self) -> Optional[User]:
-    if self._local.token:
-      return cast(User, self._local.token.user)
-    return None
+    snapshot = self._local.token
+    if snapshot is None:
+      return None
+    return session.query(User).get(snapshot.user_id)
 
   def logout(self) -> None:
+    snapshot = self._local.token
+    if snapshot and self._revocation_list:
+      logger.info('Logging out user "%s" with signed token ID %s', snapshot.user_id,
+        snapshot.token_id)
+      # Tokens with the same ID may have been issued with a later expiry than the current one
+      # (see #_extend_expiry()), but not later than a full lifetime from now.
+      expiration_date = max(snapshot.expiration_date,
+        datetime.datetime.utcnow() + self._token_ttl.as_timedelta())
+      self._revocation_list.revoke(SignedToken(*snapshot._replace(expiration_date=expiration_date)))
+      flask.session.pop(self._cookie_name, None)
     token = self.current_token
     if token:
-      logger.info('Logging out user "%s" with token ID %s', token.user.id, token.id)
+      logger.info('Logging out user "%s" with token ID %s', token.user_id, token.id)
       token.revoke()
-      session.pop(self._cookie_name, None)
+      if self._token_cache:
+        self._token_cache.discard(token.value)
+      flask.session.pop(self._cookie_name, None)
+    self._local.token = None
+
+  def _get_token(self, token_value: str) -> Optional[TokenSnapshot]:
+    if self._token_signer:
+      assert self._revocation_list is not None
+      signed_token = self._token_signer.verify(token_value)
+      if not signed_token or self._revocation_list.is_revoked(signed_token.token_id):
+        return None
+      return TokenSnapshot(*signed_token)
+
+    version = 0
+    if self._token_cache:
+      snapshot, version = self._token_cache.get(token_value)
+      if snapshot:
+        return snapshot
+    token = Token.get(value=token_value).or_none()
+    if not token or not token.is_valid:
+      return None
+    snapshot = TokenSnapshot(token.id, token.user_id, token.expiration_date)
+    if self._token_cache:
+      self._token_cache.put(token_value, snapshot, version)
+    return snapshot
+
+  def _extend_expiry(self, token_value: str, snapshot: TokenSnapshot) -> TokenSnapshot:
+    """
+    Extend the expiry of the token if less than the refresh threshold of it's lifetime
+    remains. Signed tokens are replaced with a new token with the same ID, the new expiry of
+    database tokens is written by the #TokenExpiryWriter.
+    """
+
+    now = datetime.datetime.utcnow()
+    ttl = self._token_ttl.as_timedelta()
+    if snapshot.expiration_date - now > ttl * self._refresh_threshold:
+      return snapshot
+
+    token_expiry_extensions.inc()
+    expiration_date = now + ttl
+    if self._token_signer:
+      assert isinstance(snapshot.token_id, str)
+      token_value = self._token_signer.sign(snapshot.user_id, expiration_date, snapshot.token_id)
+      signed_token = self._token_signer.verify(token_value)
+      assert signed_token is not None
+      flask.session[self._cookie_name] = token_value
+      return TokenSnapshot(*signed_token)
+
+    assert self._expiry_writer is not None
+    assert isinstance(snapshot.token_id, int)
+    self._expiry_writer.extend(snapshot.token_id, expiration_date, now)
+    snapshot = snapshot._replace(expiration_date=expiration_date)
+    if self._token_cache:
+      self._token_cache.update(token_value, snapshot)
+    return snapshot
+
+  def _is_no_redirect(self) -> bool:
+    """
+    Returns #True if the current request must not be redirected to the login page. The
+    decision is cached per endpoint if it does not depend on the actual path.
+    """
+
+    endpoint = flask.request.endpoint
+    rule = flask.request.url_rule
+    if endpoint is not None and rule is not None:
+      try:
+        decision = self._no_redirect_endpoints[endpoint]
+      except KeyError:
+        decision = self._no_redirect_endpoints[endpoint] = self._no_redirect.match_rule(rule.rule)
+      if decision is not None:
+        return decision
+    return self._no_redirect(flask.request.path)
 
   # Component
 
   def before_request(self):
     token_value = flask.session.get(self._cookie_name)
-    token = None
-    if token_value is not None:
-      token = Token.get(value=token_value).or_none()
-      if token and not token.is_valid:
-        token = None
-    self._local.token = token
+    snapshot = self._get_token(token_value) if token_value is not None else None
+    if snapshot and self._sliding_expiration:
+      snapshot = self._extend_expiry(token_value, snapshot)
+    self._local.token = snapshot
     if (not self._local.token and
         self._login_page_url and
         flask.request.path != self._login_page_url and
-        not any(fnmatch(flask.request.path, p) for p in self._no_redirect_patterns)):
+        not self._is_no_redirect()):
       logger.info('Redirecting to login page "%s"', self._login_page_url)
       return flask.redirect(self._login_page_url)
 
   # LoginStateRecorder
 
   def create_state(self, state_id, expires_in, data):
-    session.add(LoginState(
-      id=state_id,
-      expires_at=datetime.datetime.utcnow() + expires_in.as_timedelta(),
-      data=data))
+    self._state_store.create_state(state_id, expires_in, data)
 
   def get_state(self, state_id, consume=False):
-    try:
-      state = LoginState.get(id=state_id).instance
-    except NoResultFound:
-      raise LoginStateRecorder.UnknownState
-    if state.is_expired:
-      raise LoginStateRecorder.ExpiredState
-    if consume:
-      session.delete(state)
-    return state.data
+    return self._state_store.get_state(state_id, consume)
 
   def consume_state(self, state_id):
     self.get_state(state_id, True)
 
   def login(self, user: User) -> None:
     expiration_date = datetime.datetime.utcnow() + self._token_ttl.as_timedelta()
-    self._local.token = user.create_token(expiration_date)
-    logger.info('Logging in user "%s" with token ID %s', user.id, self._local.token.id)
-    flask.session[self._cookie_name] = self._local.token.value
+    if self._token_signer:
+      token_value = self._token_signer.sign(user.id, expiration_date)
+      signed_token = self._token_signer.verify(token_value)
+      assert signed_token is not None
+      self._local.token = TokenSnapshot(*signed_token)
+      logger.info('Logging in user "%s" with signed token ID %s', user.id, signed_token.token_id)
+      flask.session[self._cookie_name] = token_value
+      return
+
+    token = user.create_token(expiration_date)
+    session.flush()
+    self._local.token = TokenSnapshot(token.id, user.id, token.expiration_date)
+    logger.info('Logging in user "%s" with token ID %s', user.id, token.id)
+    flask.session[self._cookie_name] = token.value
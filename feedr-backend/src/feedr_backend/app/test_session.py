@@ -0,0 +1,52 @@
+
+import datetime
+import fnmatch
+from pathlib import Path
+
+from .session import PathMatcher, TokenCache, TokenSnapshot
+from ..model import init_db, session
+from ..model.user import TOKEN_VERSION
+from ..model.version import Version
+
+
+def test_token_cache_invalidation(tmp_path: Path) -> None:
+  init_db('sqlite:///' + str(tmp_path / 'test.db'), create_tables=True)
+  try:
+    cache = TokenCache(max_size=2, version_check_interval=0)
+    snapshot = TokenSnapshot(1, 42, datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+    assert cache.get('a') == (None, 0)
+    cache.put('a', snapshot, 0)
+    assert cache.get('a') == (snapshot, 0)
+
+    # The least recently used token is evicted.
+    cache.put('b', snapshot, 0)
+    cache.get('a')
+    cache.put('c', snapshot, 0)
+    assert cache.get('b') == (None, 0)
+    assert cache.get('a') == (snapshot, 0)
+
+    # Revoking a token in any process invalidates the cache.
+    _, version = cache.get('d')
+    Version.increment(TOKEN_VERSION)
+    session.commit()
+    assert cache.get('a') == (None, 1)
+    # A token that was loaded before the invalidation is not cached.
+    cache.put('d', snapshot, version)
+    assert cache.get('d') == (None, 1)
+
+    expired = snapshot._replace(expiration_date=datetime.datetime.utcnow())
+    cache.put('e', expired, 1)
+    assert cache.get('e') == (None, 1)
+  finally:
+    session.remove()
+
+
+def test_path_matcher_is_equivalent_to_fnmatch() -> None:
+  patterns = ['/api/*', '/metrics', '/static/*.js', '/files/?/*', '/[ab]*', '/x*y']
+  paths = ['/api', '/api/', '/api/user/1', '/apix', '/metrics', '/metrics/', '/static/app.js',
+    '/static/app.css', '/files/1/a', '/files/12/a', '/a', '/b/c', '/c', '/xy', '/x/y/z', '']
+  for subset in [patterns, patterns[:2], patterns[2:], []]:
+    matcher = PathMatcher(subset)
+    for path in paths:
+      expected = any(fnmatch.fnmatchcase(path, pattern) for pattern in subset)
+      assert matcher(path) == expected, (subset, path)
@@ -0,0 +1,50 @@
+
+import datetime
+from pathlib import Path
+
+from .tokens import RevocationList, TokenSigner
+from ..model import init_db, session
+
+
+def test_sign_and_verify() -> None:
+  expiration_date = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(hours=1)
+  signer = TokenSigner(['secret'])
+  token = signer.verify(signer.sign(42, expiration_date))
+  assert token is not None
+  assert token.user_id == 42
+  assert token.expiration_date == expiration_date
+
+  value = signer.sign(42, expiration_date)
+  assert signer.verify(value[:-1]) is None
+  assert TokenSigner(['other']).verify(value) is None
+  # Tokens signed with a previous key are accepted during the rotation.
+  assert TokenSigner(['other', 'secret']).verify(value) is not None
+  expired = signer.sign(42, datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+  assert signer.verify(expired) is None
+
+
+def test_revocation(tmp_path: Path) -> None:
+  init_db('sqlite:///' + str(tmp_path / 'test.db'), create_tables=True)
+  try:
+    now = datetime.datetime.utcnow()
+    signer = TokenSigner(['secret'])
+    token = signer.verify(signer.sign(42, now + datetime.timedelta(hours=1)))
+    other_token = signer.verify(signer.sign(42, now + datetime.timedelta(hours=1)))
+    assert token and other_token and token.token_id != other_token.token_id
+
+    # A refreshed token keeps the ID of the token that it replaces.
+    refreshed_token = signer.verify(
+      signer.sign(42, now + datetime.timedelta(hours=2), token.token_id))
+    assert refreshed_token and refreshed_token.token_id == token.token_id
+
+    revocation_list = RevocationList(refresh_interval=0)
+    other_revocation_list = RevocationList(refresh_interval=0)
+    assert not other_revocation_list.is_revoked(token.token_id)
+
+    revocation_list.revoke(refreshed_token)
+    assert revocation_list.is_revoked(token.token_id)
+    session.commit()
+    assert other_revocation_list.is_revoked(token.token_id)
+    assert not other_revocation_list.is_revoked(other_token.token_id)
+  finally:
+    session.remove()
@@ -0,0 +1,166 @@
+
+"""
+Generates resized variants of image #File#s (see #File.variants). Requires Pillow; if it is not
+installed, #ThumbnailGenerator.available is `False` and the original images are served.
+"""
+
+import hashlib
+import io
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from .. import metrics
+from ..model import session, session_context
+from ..model.file import File, storage
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+logger = logging.getLogger(__name__)
+
+thumbnails_generated = metrics.Counter(
+  'feedr_thumbnails_generated_total', 'Number of generated thumbnails.')
+thumbnail_requests = metrics.Counter(
+  'feedr_thumbnail_requests_total', 'Number of thumbnail requests by result.', ['result'])
+
+#: Image formats that are kept for thumbnails, all other formats are converted to PNG.
+_KEEP_FORMATS = frozenset(['JPEG', 'PNG', 'GIF', 'WEBP'])
+
+
+class ThumbnailGenerator:
+  """
+  Creates thumbnails of image files in a pool of *max_workers* threads. Requested sizes are
+  rounded up to the next of the configured *sizes*, so that only a bounded number of variants
+  is stored per image. Concurrent requests for the same thumbnail wait for the same job.
+
+  If a thumbnail can not be generated (e.g. because the image is corrupt) or not within
+  *timeout* seconds, the original image is served. Failures are remembered for
+  *failure_ttl* seconds, during which the original image is served without another attempt.
+  """
+
+  def __init__(
+    self,
+    sizes: List[int],
+    max_workers: int = 2,
+    timeout: float = 30.0,
+    failure_ttl: float = 600.0,
+  ) -> None:
+    self.sizes = sorted(sizes)
+    self.timeout = timeout
+    self.failure_ttl = failure_ttl
+    self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='thumbnails')
+    self._pending: Dict[Tuple[int, int], Future] = {}
+    self._failures: Dict[Tuple[int, int], float] = {}
+    self._lock = threading.RLock()
+
+  @property
+  def available(self) -> bool:
+    return Image is not None
+
+  def get_size(self, size: int) -> Optional[int]:
+    """
+    Returns the configured size that *size* is rounded up to, or `None` if it is larger than
+    all configured sizes.
+    """
+
+    for value in self.sizes:
+      if value >= size:
+        return value
+    return None
+
+  def get_thumbnail(self, source: File, size: int) -> File:
+    """
+    Returns the thumbnail of *source* for the requested *size*, generating it if it does not
+    exist. Returns *source* itself if the size is too large or Pillow is not available.
+    """
+
+    rounded_size = self.get_size(size)
+    if not self.available or rounded_size is None:
+      thumbnail_requests.inc(result='original')
+      return source
+
+    variant = source.get_variant(_variant_name(rounded_size))
+    if variant is not None:
+      thumbnail_requests.inc(result='hit')
+      return variant
+
+    key = (source.id, rounded_size)
+    with self._lock:
+      if self._failures.get(key, 0.0) > time.monotonic():
+        thumbnail_requests.inc(result='failed')
+        return source
+      self._failures.pop(key, None)
+      future = self._pending.get(key)
+      if future is None:
+        future = self._executor.submit(self._generate, source.id, rounded_size)
+        self._pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+
+    thumbnail_requests.inc(result='miss')
+    try:
+      variant_id = future.result(self.timeout)
+    except TimeoutError:
+      logger.warning('Timed out waiting for thumbnail %s of file %s', rounded_size, source.id)
+      thumbnail_requests.inc(result='timeout')
+      return source
+    except Exception:
+      thumbnail_requests.inc(result='failed')
+      return source
+    return File.get(id=variant_id).instance
+
+  def _done(self, key: Tuple[int, int], future: Future) -> None:
+    with self._lock:
+      self._pending.pop(key, None)
+      if not future.cancelled() and future.exception() is not None:
+        logger.error('Unable to create thumbnail %s of file %s', key[1], key[0],
+          exc_info=future.exception())
+        self._failures[key] = time.monotonic() + self.failure_ttl
+
+  def _generate(self, source_id: int, size: int) -> int:
+    name = _variant_name(size)
+    try:
+      with session_context():
+        source = File.get(id=source_id).instance
+        variant = source.get_variant(name)
+        if variant is not None:
+          return variant.id
+        data, mimetype = _resize(source, size)
+        state = 'sha256:' + hashlib.sha256(data).hexdigest()
+        with File.create(mimetype=mimetype, state=state) as (fp, variant):
+          fp.write(data)
+          variant.source = source
+          variant.variant = name
+        try:
+          session.flush()
+        except IntegrityError:
+          # Another process created the same variant in the meantime.
+          if not storage.deduplicates:
+            storage.delete(variant.file_id)
+          raise
+        thumbnails_generated.inc()
+        logger.info('Created thumbnail %s of file %s', name, source_id)
+        return variant.id
+    except IntegrityError:
+      with session_context():
+        return File.get(source_id=source_id, variant=name).instance.id
+
+
+def _variant_name(size: int) -> str:
+  return f'thumbnail-{size}'
+
+
+def _resize(source: File, size: int) -> Tuple[bytes, str]:
+  with source.open() as fp:
+    image = Image.open(fp)
+    format_ = image.format if image.format in _KEEP_FORMATS else 'PNG'
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, format_)
+  return buffer.getvalue(), Image.MIME[format_]
@@ -0,0 +1,166 @@
+
+"""
+Stateless login tokens that are signed with HMAC-SHA256 and can be verified without a database
+query. A token has the form `<key_id>.<payload>.<signature>`, where the payload is the URL-safe
+base64 encoded JSON object `{"jti": ..., "uid": ..., "exp": ...}`. The token ID (`jti`) is kept
+when the token is replaced with one that expires later, so revoking it revokes every token of
+the login session.
+
+Keys are derived from the application's secret keys. The first key signs new tokens, all keys
+are accepted for verification, so the secret key can be rotated by moving the old key to
+#SessionConfig.previous_secret_keys until all tokens signed with it have expired.
+"""
+
+import base64
+import binascii
+import calendar
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
+
+from .. import metrics
+from ..model.user import TOKEN_VERSION, RevokedToken
+from ..model.version import Version
+
+logger = logging.getLogger(__name__)
+
+signed_token_verifications = metrics.Counter(
+  'feedr_signed_token_verifications_total', 'Number of signed token verifications by result.',
+  ['result'])
+
+
+def _b64encode(data: bytes) -> str:
+  return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+  return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class SignedToken(NamedTuple):
+  token_id: str
+  user_id: int
+  expiration_date: datetime.datetime
+
+
+class TokenSigner:
+  """
+  Signs and verifies #SignedToken#s with keys derived from the *secret_keys*. The first key is
+  used to sign tokens.
+  """
+
+  #: Separates the token signing keys from other uses of the secret keys.
+  salt = b'feedr.session-token'
+
+  def __init__(self, secret_keys: List[str]) -> None:
+    if not secret_keys:
+      raise ValueError('at least one secret key is required')
+    self._keys: Dict[str, bytes] = {}
+    self._signing_key_id = ''
+    for secret_key in secret_keys:
+      key = hmac.new(secret_key.encode('utf8'), self.salt, hashlib.sha256).digest()
+      key_id = hashlib.sha256(key).hexdigest()[:8]
+      self._keys.setdefault(key_id, key)
+      self._signing_key_id = self._signing_key_id or key_id
+
+  def _signature(self, key: bytes, message: str) -> str:
+    return _b64encode(hmac.new(key, message.encode('ascii'), hashlib.sha256).digest())
+
+  def sign(
+    self,
+    user_id: int,
+    expiration_date: datetime.datetime,
+    token_id: Optional[str] = None,
+  ) -> str:
+    """
+    Returns a new token for the *user_id*. Pass the *token_id* of an existing token to extend
+    it's expiry, otherwise a new ID is generated.
+    """
+
+    payload = {
+      'jti': token_id or secrets.token_urlsafe(12),
+      'uid': user_id,
+      'exp': calendar.timegm(expiration_date.utctimetuple()),
+    }
+    encoded_payload = _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf8'))
+    message = self._signing_key_id + '.' + encoded_payload
+    return message + '.' + self._signature(self._keys[self._signing_key_id], message)
+
+  def verify(self, token: str) -> Optional[SignedToken]:
+    """
+    Returns the decoded token if it's signature is valid and it has not expired.
+    """
+
+    try:
+      key_id, payload, signature = token.split('.')
+    except ValueError:
+      signed_token_verifications.inc(result='malformed')
+      return None
+    key = self._keys.get(key_id)
+    if key is None:
+      signed_token_verifications.inc(result='unknown_key')
+      return None
+    if not hmac.compare_digest(signature, self._signature(key, key_id + '.' + payload)):
+      signed_token_verifications.inc(result='invalid_signature')
+      return None
+    try:
+      data = json.loads(_b64decode(payload))
+      result = SignedToken(str(data['jti']), int(data['uid']),
+        datetime.datetime.utcfromtimestamp(data['exp']))
+    except (binascii.Error, ValueError, KeyError, TypeError):
+      signed_token_verifications.inc(result='malformed')
+      return None
+    if result.expiration_date <= datetime.datetime.utcnow():
+      signed_token_verifications.inc(result='expired')
+      return None
+    signed_token_verifications.inc(result='valid')
+    return result
+
+
+class RevocationList:
+  """
+  An in-memory copy of the IDs of revoked signed tokens that have not expired yet (see
+  #RevokedToken). The list is reloaded when the #TOKEN_VERSION changed, which is checked
+  at most every *refresh_interval* seconds.
+  """
+
+  def __init__(self, refresh_interval: float = 5.0) -> None:
+    self.refresh_interval = refresh_interval
+    self._token_ids: FrozenSet[str] = frozenset()
+    self._version: Optional[int] = None
+    self._checked_at = 0.0
+    self._lock = threading.Lock()
+
+  def _refresh(self) -> None:
+    now = time.monotonic()
+    if self._version is not None and now - self._checked_at < self.refresh_interval:
+      return
+    with self._lock:
+      if self._version is not None and now - self._checked_at < self.refresh_interval:
+        return
+      version = Version.get_value(TOKEN_VERSION)
+      if version != self._version:
+        self._token_ids = frozenset(RevokedToken.active_token_ids())
+        logger.debug('Loaded %d revoked token(s) (version %d)', len(self._token_ids), version)
+        self._version = version
+      self._checked_at = now
+
+  def is_revoked(self, token_id: str) -> bool:
+    self._refresh()
+    return token_id in self._token_ids
+
+  def revoke(self, token: SignedToken) -> None:
+    """
+    Revoke the *token* as part of the current transaction. The token is rejected by this
+    process immediately and by other processes after their next refresh.
+    """
+
+    RevokedToken.revoke(token.token_id, token.expiration_date)
+    with self._lock:
+      self._token_ids = self._token_ids | {token.token_id}
@@ -1,13 +1,13 @@
 
-import io
 from typing import Optional
 
-import requests
 from databind.core import datamodel
-from flask import abort, send_file
+from flask import abort, request
 
 from ._base import Component, route, url_for, json_response
+from .files import CACHE_IMMUTABLE, CACHE_REVALIDATE, file_version, serve_file
 from .session import SessionManager
+from .thumbnails import ThumbnailGenerator
 from ..model.user import User
 
 
@@ -20,24 +20,30 @@ class UserInfo:
 
 class UserComponent(Component):
 
-  def __init__(self, session_manager: SessionManager) -> None:
+  def __init__(
+    self,
+    session_manager: SessionManager,
+    thumbnails: Optional[ThumbnailGenerator] = None,
+  ) -> None:
     self._session_manager = session_manager
+    self._thumbnails = thumbnails
 
   @route('/me')
   def get_me(self) -> UserInfo:
-    user = self._session_manager.current_user
-    if not user:
+    user_id = self._session_manager.current_user_id
+    if user_id is None:
       abort(403)
-    return self.get_user(user.id)
+    return self.get_user(user_id)
 
   @route('/<int:user_id>')
   @json_response
   def get_user(self, user_id: int) -> UserInfo:
-    if not self._session_manager.current_user:
+    if self._session_manager.current_user_id is None:
       abort(403)
     user = User.get(id=user_id).instance
     if user.avatar_file:
-      avatar_url = url_for(self.get_avatar, user_id=user_id)
+      # The version makes the URL change with the avatar, so it can be cached indefinitely.
+      avatar_url = url_for(self.get_avatar, user_id=user_id, v=file_version(user.avatar_file))
     else:
       avatar_url = user.avatar_url
     return UserInfo(user.id, user.user_name, avatar_url)
@@ -46,12 +52,23 @@ class UserComponent(Component):
   def get_avatar(self, user_id: int):
     user = User.get(id=user_id).instance
     if user.avatar_file:
-      try:
-        filename = 'avatar'  # TODO: Suffix?
-        return send_file(
-          user.avatar_file.open(),
-          mimetype=user.avatar_file.mimetype,
-          attachment_filename=filename)
-      except FileNotFoundError:
-        pass
+      avatar_file = user.avatar_file
+      size = request.args.get('size', type=int)
+      if size is not None and size <= 0:
+        abort(400)
+      is_requested_file = True
+      if size is not None:
+        if self._thumbnails:
+          avatar_file = self._thumbnails.get_thumbnail(avatar_file, size)
+        # The original image is served in place of a thumbnail that can not be created (yet),
+        # that response must not be cached under the thumbnail's URL.
+        is_requested_file = avatar_file is not user.avatar_file or (
+          self._thumbnails is not None and self._thumbnails.get_size(size) is None)
+      version = request.args.get('v')
+      if is_requested_file and version and version == file_version(user.avatar_file):
+        cache_control = CACHE_IMMUTABLE
+      else:
+        cache_control = CACHE_REVALIDATE
+      filename = 'avatar'  # TODO: Suffix?
+      return serve_file(avatar_file, cache_control, filename)
     abort(404)
@@ -10,6 +10,7 @@ from nr.parsing.date import Duration
 from feedr_oauth2 import OAuth2Client, OAuth2Session, OAuth2SessionData
 from ..model.user import User
 from ..app._base import Component, route, url_for
+from .state import ExpiredState, UnknownState
 
 __all__ = [
   'LoginStateRecorder',
@@ -26,11 +27,8 @@ class LoginStateRecorder(metaclass=abc.ABCMeta):
   state, allowing login processes to run run over multiple requests.
   """
 
-  class ExpiredState(Exception):
-    pass
-
-  class UnknownState(Exception):
-    pass
+  ExpiredState = ExpiredState
+  UnknownState = UnknownState
 
   @abc.abstractmethod
   def create_state(self, state_id: str, expires_in: Duration, data: Dict[str, Any]) -> None:
@@ -7,7 +7,7 @@ from databind.core import datamodel, implementation
 from feedr_oauth2 import OAuth2Client
 from ._base import AuthContext, AuthHandlerConfig, OAuth2Handler
 from ..model import session
-from ..model.task import BaseTask, queue_task
+from ..model.task import BaseTask, queue_task, register_task
 from ..model.user import User
 
 
@@ -53,6 +53,7 @@ class NextcloudOAuth2Handler(OAuth2Handler):
     return user
 
 
+@register_task('nextcloud.refresh_avatar')
 @datamodel
 class RefreshAvatar(BaseTask):
   user_id: int
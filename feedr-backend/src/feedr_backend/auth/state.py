@@ -0,0 +1,239 @@
+
+"""
+Backends for storing the state of login processes that run over multiple requests (e.g. the
+OAuth2 `state` parameter). The backend is selected with #Auth.state_store in the configuration:
+
+* `database` (default) stores states in the #LoginState table
+* `memory` keeps states in the memory of the process, suitable for single-process deployments
+* `socket` keeps states in a #LoginStateServer that is shared by all processes on a node
+  through a Unix domain socket (see the `login-state-server` command)
+"""
+
+import abc
+import datetime
+import heapq
+import json
+import logging
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from databind.core import datamodel, implementation, interface
+from nr.parsing.date import Duration
+
+from ..model import session
+from ..model.user import LoginState
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+  'ExpiredState',
+  'UnknownState',
+  'LoginStateStore',
+  'DatabaseLoginStateStore',
+  'MemoryLoginStateStore',
+  'SocketLoginStateStore',
+  'LoginStateServer',
+  'LoginStateStoreConfig',
+]
+
+
+class ExpiredState(Exception):
+  pass
+
+
+class UnknownState(Exception):
+  pass
+
+
+class LoginStateStore(metaclass=abc.ABCMeta):
+  """
+  Abstract base class for login state backends. See #LoginStateRecorder for the semantics of
+  the methods. Backends discard states after they expired.
+  """
+
+  @abc.abstractmethod
+  def create_state(self, state_id: str, expires_in: Duration, data: Dict[str, Any]) -> None:
+    pass
+
+  @abc.abstractmethod
+  def get_state(self, state_id: str, consume: bool = False) -> Dict[str, Any]:
+    pass
+
+
+class DatabaseLoginStateStore(LoginStateStore):
+  """
+  Stores states in the #LoginState table as part of the current transaction. Expired states
+  are deleted by the #SweepExpiredTask.
+  """
+
+  def create_state(self, state_id, expires_in, data):
+    session.add(LoginState(
+      id=state_id,
+      expires_at=datetime.datetime.utcnow() + expires_in.as_timedelta(),
+      data=data))
+
+  def get_state(self, state_id, consume=False):
+    state = LoginState.get(id=state_id).or_none()
+    if state is None:
+      raise UnknownState(state_id)
+    if state.is_expired:
+      raise ExpiredState(state_id)
+    if consume:
+      session.delete(state)
+    return state.data
+
+
+class MemoryLoginStateStore(LoginStateStore):
+  """
+  Keeps states in memory. Expired states are removed on every access. If the store holds
+  *max_size* states, the states that expire first are evicted.
+  """
+
+  def __init__(self, max_size: int = 10000) -> None:
+    self.max_size = max_size
+    self._states: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+    self._expiry: List[Tuple[float, str]] = []
+    self._lock = threading.Lock()
+
+  def _expire(self, now: float) -> None:
+    while self._expiry and (self._expiry[0][0] <= now or len(self._states) > self.max_size):
+      expires_at, state_id = heapq.heappop(self._expiry)
+      entry = self._states.get(state_id)
+      if entry and entry[0] == expires_at:
+        del self._states[state_id]
+
+  def create_state(self, state_id, expires_in, data):
+    now = time.time()
+    expires_at = now + expires_in.total_seconds()
+    with self._lock:
+      self._states[state_id] = (expires_at, data)
+      heapq.heappush(self._expiry, (expires_at, state_id))
+      self._expire(now)
+
+  def get_state(self, state_id, consume=False):
+    now = time.time()
+    with self._lock:
+      entry = self._states.get(state_id)
+      if entry is not None and entry[0] <= now:
+        del self._states[state_id]
+        raise ExpiredState(state_id)
+      self._expire(now)
+      if entry is None:
+        raise UnknownState(state_id)
+      if consume:
+        del self._states[state_id]
+    return entry[1]
+
+
+class _LoginStateRequestHandler(socketserver.StreamRequestHandler):
+
+  server: 'LoginStateServer'
+
+  def handle(self):
+    for line in self.rfile:
+      request = json.loads(line)
+      store = self.server.store
+      try:
+        if request['op'] == 'create':
+          store.create_state(request['state_id'], Duration(seconds=request['expires_in']),
+            request['data'])
+          response: Dict[str, Any] = {}
+        elif request['op'] == 'get':
+          response = {'data': store.get_state(request['state_id'], request['consume'])}
+        else:
+          response = {'error': 'bad_request'}
+      except ExpiredState:
+        response = {'error': 'expired'}
+      except UnknownState:
+        response = {'error': 'unknown'}
+      self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+
+class LoginStateServer(socketserver.ThreadingUnixStreamServer):
+  """
+  Serves a #MemoryLoginStateStore on a Unix domain socket for the #SocketLoginStateStore.
+  The protocol is one JSON object per line in both directions.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, path: str, max_size: int = 10000) -> None:
+    super().__init__(path, _LoginStateRequestHandler)
+    self.store = MemoryLoginStateStore(max_size)
+
+
+class SocketLoginStateStore(LoginStateStore):
+  """
+  A client for the #LoginStateServer listening on the Unix domain socket at *path*.
+  """
+
+  def __init__(self, path: str, timeout: float = 5.0) -> None:
+    self.path = path
+    self.timeout = timeout
+
+  def _request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(self.timeout)
+      sock.connect(self.path)
+      with sock.makefile('rwb') as fp:
+        fp.write(json.dumps(request).encode('utf8') + b'\n')
+        fp.flush()
+        response = json.loads(fp.readline())
+    error = response.get('error')
+    if error == 'expired':
+      raise ExpiredState(request.get('state_id'))
+    elif error == 'unknown':
+      raise UnknownState(request.get('state_id'))
+    elif error:
+      raise RuntimeError(f'login state server returned an error: {error}')
+    return response
+
+  def create_state(self, state_id, expires_in, data):
+    self._request({'op': 'create', 'state_id': state_id,
+      'expires_in': expires_in.total_seconds(), 'data': data})
+
+  def get_state(self, state_id, consume=False):
+    return self._request({'op': 'get', 'state_id': state_id, 'consume': consume})['data']
+
+
+@interface
+class LoginStateStoreConfig(metaclass=abc.ABCMeta):
+
+  @abc.abstractmethod
+  def get_store(self) -> LoginStateStore:
+    pass
+
+
+@datamodel
+@implementation('database')
+class DatabaseLoginStateStoreConfig(LoginStateStoreConfig):
+
+  def get_store(self) -> LoginStateStore:
+    return DatabaseLoginStateStore()
+
+
+@datamodel
+@implementation('memory')
+class MemoryLoginStateStoreConfig(LoginStateStoreConfig):
+  max_size: int = 10000
+
+  def get_store(self) -> LoginStateStore:
+    return MemoryLoginStateStore(self.max_size)
+
+
+@datamodel
+@implementation('socket')
+class SocketLoginStateStoreConfig(LoginStateStoreConfig):
+  #: The path of the Unix domain socket of the #LoginStateServer.
+  path: str
+  max_size: int = 10000
+  timeout: float = 5.0
+
+  def get_store(self) -> LoginStateStore:
+    return SocketLoginStateStore(self.path, self.timeout)
+
+  def get_server(self) -> LoginStateServer:
+    return LoginStateServer(self.path, self.max_size)
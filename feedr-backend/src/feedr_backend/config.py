@@ -1,12 +1,13 @@
 
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Optional, Union
 
 from databind.core import datamodel, field, uniontype
 from databind.yaml import from_str
 from nr.parsing.date import Duration
 
 from .auth import AuthHandlerConfig
+from .auth.state import DatabaseLoginStateStoreConfig, LoginStateStoreConfig
 
 
 @datamodel
@@ -18,20 +19,175 @@ class DatabaseConfig:
 class Auth:
   handlers: Dict[str, AuthHandlerConfig]
 
+  #: The backend that stores the state of login processes.
+  state_store: LoginStateStoreConfig = field(default_factory=DatabaseLoginStateStoreConfig)
+
+
+@datamodel
+class TokenCacheConfig:
+  enabled: bool = True
+
+  #: The maximum number of tokens in the cache of every process.
+  max_size: int = 10000
+
+  #: The time after which a cached token must be validated against the database again.
+  ttl: Duration = Duration.parse('PT5M')
+
+  #: The interval in which the cache checks if tokens have been revoked by another process.
+  #: A revoked token is still accepted by other processes for up to this duration.
+  version_check_interval: Duration = Duration.parse('PT1S')
+
+
+@datamodel
+class SessionConfig:
+  #: The lifetime of a login token.
+  token_ttl: Duration = Duration.parse('P1D')
+
+  token_cache: TokenCacheConfig = field(default_factory=TokenCacheConfig)
+
+  #: Issue stateless tokens signed with keys derived from #Config.secret_key instead of
+  #: storing tokens in the database. The #token_cache is not used for stateless tokens.
+  stateless: bool = False
+
+  #: Secret keys that were used before the current #Config.secret_key. Stateless tokens
+  #: signed with these keys are still accepted until they expire.
+  previous_secret_keys: List[str] = field(default_factory=list)
+
+  #: The interval in which every process reloads the list of revoked stateless tokens when
+  #: a token was revoked.
+  revocation_refresh_interval: Duration = Duration.parse('PT5S')
+
+  #: The interval in which expired tokens and login states are deleted.
+  sweep_interval: Duration = Duration.parse('PT1H')
+
+  #: Extend the expiry of a token when it is used and less than #refresh_threshold of the
+  #: #token_ttl remains. Stateless tokens are replaced with a new token.
+  sliding_expiration: bool = True
+
+  refresh_threshold: float = 0.5
+
+  #: The interval in which extended token expiration dates are written to the database.
+  expiry_flush_interval: Duration = Duration.parse('PT5S')
+
 
 @datamodel
 class RssConfig:
   update_interval: Duration = Duration.parse('PT10M')
 
 
+@datamodel
+class TaskRetentionConfig:
+  #: The interval in which finished tasks are purged.
+  interval: Duration = Duration.parse('PT1H')
+
+  #: Maps task status names (e.g. `COMPLETED`) to the maximum age of finished tasks with that
+  #: status. Tasks with a status that is not listed here are kept forever.
+  max_age: Dict[str, Duration] = field(default_factory=lambda: {
+    'COMPLETED': Duration.parse('P7D'),
+    'CANCELLED': Duration.parse('P7D'),
+    'FAILED': Duration.parse('P30D'),
+    'DEAD': Duration.parse('P30D'),
+  })
+
+  #: The number of tasks that are deleted per transaction.
+  batch_size: int = 500
+
+  #: Archive tasks to compressed NDJSON files before they are deleted.
+  archive: bool = False
+
+
+@datamodel
+class TasksConfig:
+  #: Execute every task in a separate process. The output of the process is stored
+  #: in the task's log file.
+  isolated: bool = False
+
+  #: The default memory limit for tasks executed in a separate process, in MiB.
+  memory_limit: Optional[int] = None
+
+  #: The default time limit for tasks. Tasks executed in a separate process are killed when
+  #: they exceed the limit, other tasks must check it with #check_cancelled().
+  time_limit: Optional[Duration] = None
+
+  #: If set, the worker executes up to this many tasks concurrently on an asyncio event
+  #: loop (see #AsyncTaskWorker). Only useful for I/O bound tasks. Not compatible with
+  #: #isolated.
+  async_concurrency: Optional[int] = None
+
+  retention: TaskRetentionConfig = field(default_factory=TaskRetentionConfig)
+
+  #: Hold back tasks queued with #queue_task() until the main database transaction is
+  #: committed (a transactional outbox). Recommended with a separate #Config.task_database.
+  outbox: bool = False
+
+
+@datamodel
+class MetricsConfig:
+  #: A directory that is shared by all processes to aggregate their metrics. If not set, only
+  #: the metrics of the process that serves the `/metrics` endpoint are reported.
+  directory: Optional[str] = None
+
+  #: The interval in which every process writes it's metrics to the #directory.
+  flush_interval: Duration = Duration.parse('PT5S')
+
+  #: The bearer token that clients (e.g. Prometheus) must send in the `Authorization` header
+  #: to read the `/metrics` endpoint. The endpoint is disabled if no token is set.
+  token: Optional[str] = None
+
+
+@datamodel
+class FilesConfig:
+  #: Store files under the hash of their contents, so that files with the same contents are
+  #: stored only once (see #ContentAddressedStorageManager). Existing files remain readable.
+  content_addressed: bool = False
+
+  #: Offload serving files from the #Config.media_directory to the web server in front of the
+  #: application. Either `x-accel-redirect` (nginx) or `x-sendfile` (Apache, lighttpd).
+  offload: Optional[str] = None
+
+  #: The internal location of the web server that maps to the #Config.media_directory, used
+  #: with `x-accel-redirect`.
+  internal_location: str = '/_media/'
+
+  #: The interval in which the #SweepOrphanedFilesTask runs and the number of shards of the
+  #: storage that it sweeps per run.
+  orphan_sweep_interval: Duration = Duration.parse('PT1H')
+  orphan_sweep_shards: int = 16
+
+  #: The maximum size in bytes of the in-memory cache of every process for small files (see
+  #: #CachingStorageManager), and the maximum size of a file in the cache. Set #cache_size
+  #: to 0 to disable the cache.
+  cache_size: int = 32 * 1024 * 1024
+  cache_max_file_size: int = 256 * 1024
+
+
+@datamodel
+class ThumbnailConfig:
+  #: The sizes in pixels of the thumbnails that are generated. Requested sizes are rounded up
+  #: to the next of these sizes, larger sizes are served the original image.
+  sizes: List[int] = field(default_factory=lambda: [32, 64, 128, 256])
+
+  #: The number of threads per process that generate thumbnails.
+  max_workers: int = 2
+
+
 @datamodel
 class Config:
   debug: bool = False
   auth: Auth
   database: DatabaseConfig
+
+  #: A separate database for the task queue. If not set, tasks are stored in the #database.
+  task_database: Optional[DatabaseConfig] = None
+
   secret_key: str
   media_directory: str
+  session: SessionConfig = field(default_factory=SessionConfig)
   rss: RssConfig = field(default_factory=RssConfig)
+  tasks: TasksConfig = field(default_factory=TasksConfig)
+  metrics: MetricsConfig = field(default_factory=MetricsConfig)
+  files: FilesConfig = field(default_factory=FilesConfig)
+  thumbnails: ThumbnailConfig = field(default_factory=ThumbnailConfig)
 
   @classmethod
   def load(cls, file_: Union[str, Path]) -> 'Config':
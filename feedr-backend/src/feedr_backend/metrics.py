@@ -0,0 +1,383 @@
+
+"""
+A minimal in-process metrics registry with counters, gauges and histograms that can be rendered
+in the Prometheus text exposition format.
+
+When multiple processes report metrics (e.g. the web server and task workers), every process
+periodically writes a snapshot of it's counters and histograms into a shared directory (see
+#init_metrics()). Rendering the metrics then sums up the values of all snapshots. Gauges are
+not aggregated across processes, they are expected to be computed by a collector at the time
+the metrics are rendered. Snapshots of processes that have exited or stopped writing them are
+deleted.
+
+# Example
+
+```python
+from feedr_backend import metrics
+
+requests_total = metrics.Counter('myapp_requests_total', 'Number of requests.', ['method'])
+requests_total.inc(method='GET')
+print(metrics.registry.render())
+```
+"""
+
+import abc
+import atexit
+import bisect
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _escape_label_value(value: str) -> str:
+  return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+  parts = [f'{k}="{_escape_label_value(v)}"' for k, v in zip(names, values)]
+  if extra:
+    parts.append(extra)
+  return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  return repr(float(value))
+
+
+class Metric(metaclass=abc.ABCMeta):
+  """
+  Base class for metrics. A metric has a name, a help text and zero or more label names. Values
+  are stored per combination of label values.
+  """
+
+  type_name: str
+
+  def __init__(
+    self,
+    name: str,
+    help: str,
+    labelnames: Sequence[str] = (),
+    registry: Optional['Registry'] = None,
+  ) -> None:
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+    (registry or _get_default_registry()).register(self)
+
+  def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+    if set(labels) != set(self.labelnames):
+      raise ValueError(f'{self.name}: expected labels {self.labelnames!r}, got {tuple(labels)!r}')
+    return tuple(str(labels[k]) for k in self.labelnames)
+
+  @abc.abstractmethod
+  def snapshot(self) -> Dict[LabelValues, object]:
+    """
+    Returns a copy of the values of the metric per combination of label values.
+    """
+
+  @staticmethod
+  @abc.abstractmethod
+  def merge(a: object, b: object) -> object:
+    """
+    Combine two values of the metric from different processes.
+    """
+
+  @abc.abstractmethod
+  def render(self, values: Dict[LabelValues, object]) -> Iterable[str]:
+    """
+    Render the *values* in the Prometheus text exposition format.
+    """
+
+
+class Counter(Metric):
+  """
+  A value that only ever increases.
+  """
+
+  type_name = 'counter'
+
+  def __init__(self, *args, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self._values: Dict[LabelValues, float] = {}
+
+  def inc(self, amount: float = 1.0, **labels: str) -> None:
+    key = self._label_values(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0.0) + amount
+
+  def get(self, **labels: str) -> float:
+    return self._values.get(self._label_values(labels), 0.0)
+
+  def snapshot(self):
+    with self._lock:
+      return dict(self._values)
+
+  @staticmethod
+  def merge(a: float, b: float) -> float:
+    return a + b
+
+  def render(self, values):
+    for key, value in sorted(values.items()):
+      yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+  """
+  A value that can go up and down. Gauges are not aggregated across processes.
+  """
+
+  type_name = 'gauge'
+
+  def set(self, value: float, **labels: str) -> None:
+    key = self._label_values(labels)
+    with self._lock:
+      self._values[key] = value
+
+  def dec(self, amount: float = 1.0, **labels: str) -> None:
+    self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+  """
+  Counts observed values in buckets and keeps track of their sum.
+  """
+
+  type_name = 'histogram'
+
+  def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self.buckets = tuple(sorted(buckets))
+    # Per label values: one count per bucket, plus one for +Inf, and the sum.
+    self._values: Dict[LabelValues, Tuple[List[float], float]] = {}
+
+  def observe(self, value: float, **labels: str) -> None:
+    key = self._label_values(labels)
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      counts, total = self._values.get(key) or ([0.0] * (len(self.buckets) + 1), 0.0)
+      counts[index] += 1
+      self._values[key] = (counts, total + value)
+
+  def time(self, **labels: str) -> '_Timer':
+    """
+    Returns a context manager that observes the time spent in it's body.
+    """
+
+    return _Timer(self, labels)
+
+  def snapshot(self):
+    with self._lock:
+      return {k: (list(counts), total) for k, (counts, total) in self._values.items()}
+
+  @staticmethod
+  def merge(a, b):
+    return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1]
+
+  def render(self, values):
+    for key, (counts, total) in sorted(values.items()):
+      cumulative = 0.0
+      for bound, count in zip(self.buckets + (math.inf,), counts):
+        cumulative += count
+        le = 'le="' + _format_value(bound) + '"'
+        yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}'
+      yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}'
+      yield f'{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(cumulative)}'
+
+
+class _Timer:
+
+  def __init__(self, histogram: Histogram, labels: Dict[str, str]) -> None:
+    self._histogram = histogram
+    self._labels = labels
+
+  def __enter__(self) -> None:
+    self._start = time.perf_counter()
+
+  def __exit__(self, *args) -> None:
+    self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Registry:
+  """
+  A collection of metrics. Collectors are functions that are called before the metrics are
+  rendered, usually to update gauges from an external source (e.g. the database).
+  """
+
+  def __init__(self) -> None:
+    self._metrics: Dict[str, Metric] = {}
+    self._collectors: List[Callable[[], None]] = []
+    self._directory: Optional[Path] = None
+    self._stale_after: Optional[float] = None
+    self._lock = threading.Lock()
+
+  def register(self, metric: Metric) -> None:
+    with self._lock:
+      if metric.name in self._metrics:
+        raise ValueError(f'metric {metric.name!r} is already registered')
+      self._metrics[metric.name] = metric
+
+  def add_collector(self, collector: Callable[[], None]) -> Callable[[], None]:
+    self._collectors.append(collector)
+    return collector
+
+  def set_directory(
+    self,
+    directory: Union[str, Path, None],
+    stale_after: Optional[float] = None,
+  ) -> None:
+    """
+    Set the directory in which processes exchange snapshots of their metrics. The directory
+    must be shared by all processes that should be aggregated. Snapshots that have not been
+    updated for *stale_after* seconds, or whose process on the same host has exited, are
+    deleted when the metrics are rendered.
+    """
+
+    self._directory = Path(directory) if directory is not None else None
+    self._stale_after = stale_after
+    if self._directory:
+      self._directory.mkdir(parents=True, exist_ok=True)
+
+  @property
+  def _snapshot_file(self) -> Path:
+    assert self._directory is not None
+    return self._directory / f'{socket.gethostname()}-{os.getpid()}.json'
+
+  def snapshot(self) -> Dict[str, List[Tuple[LabelValues, object]]]:
+    return {
+      name: list(metric.snapshot().items())
+      for name, metric in self._metrics.items()
+      if not isinstance(metric, Gauge)
+    }
+
+  def flush(self) -> None:
+    """
+    Write a snapshot of the metrics of this process into the metrics directory. Does nothing
+    if no directory is configured.
+    """
+
+    if not self._directory:
+      return
+    filename = self._snapshot_file
+    tmp = filename.with_suffix('.tmp')
+    tmp.write_text(json.dumps(self.snapshot()))
+    os.replace(tmp, filename)
+
+  def _load_snapshots(self) -> Iterable[Dict[str, List[Tuple[LabelValues, object]]]]:
+    yield self.snapshot()
+    if not self._directory:
+      return
+    own_file = self._snapshot_file
+    for filename in self._directory.glob('*.json'):
+      if filename == own_file:
+        continue
+      try:
+        if self._is_stale(filename):
+          logger.info('Deleting stale metrics snapshot "%s"', filename)
+          filename.unlink()
+          continue
+        yield json.loads(filename.read_text())
+      except FileNotFoundError:
+        # Deleted by another process in the meantime.
+        pass
+      except (OSError, ValueError) as exc:
+        logger.warning('Unable to read metrics snapshot "%s": %s', filename, exc)
+
+  def _is_stale(self, filename: Path) -> bool:
+    if self._stale_after is not None and time.time() - filename.stat().st_mtime > self._stale_after:
+      return True
+    hostname, _, pid = filename.stem.rpartition('-')
+    if hostname != socket.gethostname() or not pid.isdigit():
+      return False
+    try:
+      os.kill(int(pid), 0)
+    except ProcessLookupError:
+      return True
+    except PermissionError:
+      pass
+    return False
+
+  def render(self) -> str:
+    """
+    Render the metrics in the Prometheus text exposition format.
+    """
+
+    for collector in self._collectors:
+      try:
+        collector()
+      except Exception:
+        logger.exception('Error in metrics collector %s', collector)
+
+    merged: Dict[str, Dict[LabelValues, object]] = {}
+    for snapshot in self._load_snapshots():
+      for name, items in snapshot.items():
+        metric = self._metrics.get(name)
+        if metric is None:
+          continue
+        values = merged.setdefault(name, {})
+        for key, value in items:
+          key = tuple(key)
+          values[key] = metric.merge(values[key], value) if key in values else value  # type: ignore
+
+    lines = []
+    for name, metric in sorted(self._metrics.items()):
+      values = metric.snapshot() if isinstance(metric, Gauge) else merged.get(name, {})
+      lines.append(f'# HELP {name} {metric.help}')
+      lines.append(f'# TYPE {name} {metric.type_name}')
+      lines.extend(metric.render(values))
+    return '\n'.join(lines) + '\n'
+
+
+class _Flusher(threading.Thread):
+
+  def __init__(self, registry: Registry, interval: float) -> None:
+    super().__init__(daemon=True)
+    self._registry = registry
+    self._interval = interval
+
+  def run(self):
+    while True:
+      time.sleep(self._interval)
+      try:
+        self._registry.flush()
+      except OSError:
+        logger.exception('Unable to flush metrics')
+
+
+registry = Registry()
+
+#: The number of flush intervals after which the metrics snapshot of a process that stopped
+#: flushing is deleted (see #init_metrics()).
+STALE_FLUSH_INTERVALS = 12
+
+
+def _get_default_registry() -> Registry:
+  return registry
+
+
+def init_metrics(directory: Union[str, Path, None], flush_interval: float = 5.0) -> None:
+  """
+  Configure the default #registry to exchange metrics with other processes through the
+  specified *directory* and start a background thread that flushes the metrics of the
+  current process periodically and at exit. Snapshots that have not been flushed for
+  #STALE_FLUSH_INTERVALS intervals are considered stale.
+  """
+
+  registry.set_directory(directory, flush_interval * STALE_FLUSH_INTERVALS)
+  if directory is None:
+    return
+  _Flusher(registry, flush_interval).start()
+  atexit.register(registry.flush)
@@ -1,7 +1,8 @@
 
 from sqlalchemy.orm.exc import NoResultFound
 
-from ._session import Session, session, session_context, init_db
+from ._session import (Session, TaskSession, init_db, scoped_sessions, session, session_context,
+  task_session)
 from ._base import Entity
 
-from . import file, task, user
+from . import file, lease, orphans, task, user, version
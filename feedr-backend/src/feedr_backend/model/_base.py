@@ -78,8 +78,14 @@ class instance_getter(Generic[T_Entity]):
     get = instance_getter['User']()
 
   user = User.get(id=42).or_create(name='Mr. Universal')
+  ```
+
+  The *session* defaults to the global #session.
   """
 
+  def __init__(self, session: Optional[Session] = None) -> None:
+    self._session = session
+
   if TYPE_CHECKING:
     class _GetProto(Protocol[T]):
       def __call__(self, **on: Any) -> _RetrievalHelper[T]:
@@ -92,5 +98,5 @@ class instance_getter(Generic[T_Entity]):
     from ._session import session
     assert type_ is not None
     def getter(**on):
-      return _RetrievalHelper[T_Entity](session, type_, on)
+      return _RetrievalHelper[T_Entity](self._session if self._session is not None else session, type_, on)
     return getter
@@ -1,33 +1,80 @@
 
 import contextlib
-from typing import Iterator
+from typing import Iterator, List, Optional
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session as _Session
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.util import ThreadLocalRegistry
 
 from ._base import Entity
 
+#: The value of `Table.info['database']` for tables that live in the task database.
+TASK_DATABASE = 'tasks'
 
 Session = sessionmaker()
 session: _Session = scoped_session(Session)
 
+#: Sessions for the task queue (see #TASK_DATABASE). If no separate task database is
+#: configured, #task_session refers to the same thread-local session as #session.
+TaskSession = sessionmaker()
+task_session: _Session = scoped_session(TaskSession)
+task_session.registry = session.registry  # type: ignore
+
+
+def has_task_database() -> bool:
+  return task_session.registry is not session.registry  # type: ignore
+
+
+def scoped_sessions() -> List[_Session]:
+  """
+  Returns the scoped sessions that need to be committed or rolled back at the end of a unit
+  of work. This is the #session and, if a separate task database is used, the #task_session.
+  """
+
+  return [session, task_session] if has_task_database() else [session]
+
 
 @contextlib.contextmanager
 def session_context() -> Iterator[None]:
+  sessions = scoped_sessions()
   try:
     yield
   except:  # noqa
-    session.rollback()
+    for s in sessions:
+      s.rollback()
     raise
   else:
-    session.commit()
+    for s in sessions:
+      s.commit()
   finally:
-    session.remove()
+    for s in sessions:
+      s.remove()
 
 
-def init_db(db_url: str, echo: bool = False, create_tables: bool = False) -> None:
+def init_db(
+  db_url: str,
+  echo: bool = False,
+  create_tables: bool = False,
+  task_db_url: Optional[str] = None,
+) -> None:
+  """
+  Configure the #session for the database at *db_url*. If *task_db_url* is specified, the
+  tables of the task queue are stored in that database instead and accessed through the
+  #task_session, so that the frequent writes of task workers do not contend with the rest of
+  the application.
+  """
+
   engine = create_engine(db_url, echo=echo)
   Session.configure(bind=engine)
+  task_engine = create_engine(task_db_url, echo=echo) if task_db_url else engine
+  TaskSession.configure(bind=task_engine)
+  task_session.registry = ThreadLocalRegistry(TaskSession) if task_db_url else session.registry  # type: ignore
+
   if create_tables:
-    Entity.metadata.create_all(engine)
+    tables = Entity.metadata.sorted_tables
+    Entity.metadata.create_all(engine, tables=[
+      t for t in tables if t.info.get('database') != TASK_DATABASE or not task_db_url])
+    if task_db_url:
+      Entity.metadata.create_all(task_engine, tables=[
+        t for t in tables if t.info.get('database') == TASK_DATABASE])
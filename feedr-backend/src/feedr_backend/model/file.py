@@ -1,32 +1,100 @@
 
 import abc
+import atexit
 import contextlib
+import hashlib
+import io
 import logging
+import os
+import queue
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from pathlib import Path
-from typing import BinaryIO, Iterator, Optional, Tuple, Union, cast
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple, Union, cast
 
 import nr.proxy
-from sqlalchemy import Column, Integer, String, event
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, UniqueConstraint, event
+from sqlalchemy.orm import backref, object_session, relationship
 
-from ._base import Entity
-from ._session import session
+from .. import metrics
+from ._base import Entity, instance_getter
+from ._session import Session, session
 
 logger = logging.getLogger(__name__)
 storage: 'StorageManager' = nr.proxy.proxy['LocalStorageManager']()  # type: ignore
 
+_PENDING_DELETES_KEY = __name__ + '.pending_deletes'
+_blob_deleter: Optional['BlobDeleter'] = None
+_blob_deleter_lock = threading.Lock()
+
+storage_files_deleted = metrics.Counter(
+  'feedr_storage_files_deleted_total', 'Number of files deleted from the storage.')
+storage_cache_requests = metrics.Counter(
+  'feedr_storage_cache_requests_total', 'Number of file reads by cache result.', ['result'])
+storage_cache_evictions = metrics.Counter(
+  'feedr_storage_cache_evictions_total', 'Number of files evicted from the storage cache.')
+storage_cache_bytes = metrics.Gauge(
+  'feedr_storage_cache_bytes', 'Size of the files in the storage cache.')
+
+storage_deduplicated_writes = metrics.Counter(
+  'feedr_storage_deduplicated_writes_total',
+  'Number of written files whose contents were already in the storage.')
+
+#: Signatures at the start of a file that are used by #sniff_mimetype().
+_MAGIC_NUMBERS = [
+  (b'\x89PNG\r\n\x1a\n', 'image/png'),
+  (b'\xff\xd8\xff', 'image/jpeg'),
+  (b'GIF87a', 'image/gif'),
+  (b'GIF89a', 'image/gif'),
+  (b'BM', 'image/bmp'),
+  (b'\x1f\x8b', 'application/gzip'),
+  (b'%PDF-', 'application/pdf'),
+]
+
+
+class FileTooLarge(Exception):
+  pass
+
+
+def sniff_mimetype(head: bytes) -> Optional[str]:
+  """
+  Guess the mimetype of a file from the first bytes of its contents. Returns `None` if the
+  format is not recognized.
+  """
+
+  if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+    return 'image/webp'
+  for magic, mimetype in _MAGIC_NUMBERS:
+    if head.startswith(magic):
+      return mimetype
+  return None
+
 
 class StorageManager(metaclass=abc.ABCMeta):
   """
   Abstract base class for storage managers.
   """
 
+  #: If `True`, the same file ID can be returned for multiple files with the same contents,
+  #: and a file may only be deleted when no #File refers to it anymore.
+  deduplicates = False
+
   @abc.abstractmethod
   def create(self) -> Tuple[BinaryIO, str]:
     """
     Create a new file and return a tuple of the writable file object and the file ID.
     """
 
+  def commit(self, fp: BinaryIO, file_id: str) -> str:
+    """
+    Called after the file object returned by #create() was written and closed. Returns the
+    final ID of the file, which may differ from the ID returned by #create().
+    """
+
+    return file_id
+
   @abc.abstractmethod
   def open(self, file_id: str) -> BinaryIO:
     """
@@ -39,6 +107,48 @@ class StorageManager(metaclass=abc.ABCMeta):
     Delete a file by file ID.
     """
 
+  def delete_stale(self, file_id: str, min_age: float) -> bool:
+    """
+    Delete a file that may be reused concurrently by a deduplicating storage manager, but only
+    if it was not written or reused within the last *min_age* seconds. Returns `True` if the
+    file was deleted.
+    """
+
+    self.delete(file_id)
+    return True
+
+  def get_path(self, file_id: str) -> Optional[Path]:
+    """
+    Returns the absolute path of the file on the local filesystem, if the storage manager
+    stores files on the local filesystem.
+    """
+
+    return None
+
+  def get_location(self, file_id: str) -> Optional[str]:
+    """
+    Returns the path of the file relative to the storage directory, so that a web server
+    can serve the file from an internal location that maps to the directory.
+    """
+
+    return None
+
+  def get_shards(self) -> List[str]:
+    """
+    Returns the names of the shards that the files in the storage are partitioned into, to be
+    listed with #iter_files(). Storage managers that can not list their files return an
+    empty list.
+    """
+
+    return []
+
+  def iter_files(self, shard: str) -> Iterator[Tuple[str, float]]:
+    """
+    Yields the file ID and the modification time of every file in the *shard*.
+    """
+
+    return iter([])
+
 
 class LocalStorageManager(StorageManager):
 
@@ -46,7 +156,7 @@ class LocalStorageManager(StorageManager):
     self._directory = Path(directory)
 
   def _file_id_to_path(self, file_id: str) -> Path:
-    return self._directory / file_id[0:2] / file_id[2:4] / file_id[4:]
+    return self._directory / self.get_location(file_id)
 
   def create(self) -> Tuple[BinaryIO, str]:
     file_id = str(uuid.uuid4())
@@ -63,6 +173,231 @@ class LocalStorageManager(StorageManager):
     except OSError as exc:
       logger.warning('Unable to delete file "%s" from disk: %s', file_id, exc)
 
+  def get_path(self, file_id: str) -> Path:
+    return self._file_id_to_path(file_id).absolute()
+
+  def get_location(self, file_id: str) -> str:
+    return f'{file_id[0:2]}/{file_id[2:4]}/{file_id[4:]}'
+
+  def get_shards(self) -> List[str]:
+    return [f'{i:02x}' for i in range(256)]
+
+  def iter_files(self, shard: str) -> Iterator[Tuple[str, float]]:
+    directory = self._directory / shard
+    if not directory.is_dir():
+      return
+    for subdirectory in directory.iterdir():
+      for path in subdirectory.iterdir():
+        yield shard + subdirectory.name + path.name, path.stat().st_mtime
+
+
+class _HashingWriter(io.RawIOBase):
+  """
+  Wraps a writable file object and computes the SHA-256 hash of all data written to it.
+  """
+
+  def __init__(self, fp: BinaryIO) -> None:
+    self._fp = fp
+    self._hash = hashlib.sha256()
+
+  @property
+  def name(self) -> str:
+    return self._fp.name
+
+  def writable(self) -> bool:
+    return True
+
+  def write(self, data) -> int:
+    self._hash.update(data)
+    return self._fp.write(data)
+
+  def flush(self) -> None:
+    # Also called by #io.IOBase.close() after the wrapped file was closed.
+    if not self._fp.closed:
+      self._fp.flush()
+
+  def close(self) -> None:
+    if not self.closed:
+      self._fp.flush()
+      os.fsync(self._fp.fileno())
+      self._fp.close()
+    super().close()
+
+  def hexdigest(self) -> str:
+    return self._hash.hexdigest()
+
+
+class ContentAddressedStorageManager(LocalStorageManager):
+  """
+  Stores files under the SHA-256 hash of their contents, so that files with the same contents
+  are only stored once. Files are written to a temporary file in the `.tmp` directory first
+  and then renamed to their final path. Files stored by the #LocalStorageManager in the same
+  directory can still be read.
+  """
+
+  deduplicates = True
+
+  def _file_id_to_path(self, file_id: str) -> Path:
+    if file_id.startswith('.tmp/'):
+      return self._directory / file_id
+    return super()._file_id_to_path(file_id)
+
+  def get_shards(self) -> List[str]:
+    # Temporary files of writes that were interrupted are swept as well.
+    return super().get_shards() + ['.tmp']
+
+  def iter_files(self, shard: str) -> Iterator[Tuple[str, float]]:
+    if shard != '.tmp':
+      yield from super().iter_files(shard)
+      return
+    directory = self._directory / shard
+    if directory.is_dir():
+      for path in directory.iterdir():
+        yield '.tmp/' + path.name, path.stat().st_mtime
+
+  def create(self) -> Tuple[BinaryIO, str]:
+    file_id = '.tmp/' + str(uuid.uuid4())
+    path = self._file_id_to_path(file_id)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    return cast(BinaryIO, _HashingWriter(path.open('wb'))), file_id
+
+  def commit(self, fp: BinaryIO, file_id: str) -> str:
+    assert isinstance(fp, _HashingWriter), type(fp)
+    temp_path = self._file_id_to_path(file_id)
+    final_id = fp.hexdigest()
+    final_path = self._file_id_to_path(final_id)
+    try:
+      # Protects the file from #delete_stale() until the new reference is committed.
+      os.utime(final_path)
+    except FileNotFoundError:
+      final_path.parent.mkdir(exist_ok=True, parents=True)
+      os.replace(temp_path, final_path)
+    else:
+      storage_deduplicated_writes.inc()
+      temp_path.unlink()
+    return final_id
+
+  def delete_stale(self, file_id: str, min_age: float) -> bool:
+    # The file is moved out of the way before its modification time is checked. A concurrent
+    # #commit() either refreshed the modification time before, or finds no file and puts its
+    # own copy in place.
+    path = self._file_id_to_path(file_id)
+    tombstone = path.with_name(path.name + '.deleting')
+    try:
+      os.rename(path, tombstone)
+    except FileNotFoundError:
+      return False
+    if tombstone.stat().st_mtime > time.time() - min_age:
+      try:
+        os.link(tombstone, path)
+      except FileExistsError:
+        pass
+      tombstone.unlink()
+      return False
+    tombstone.unlink()
+    return True
+
+
+class CachingStorageManager(StorageManager):
+  """
+  Wraps another storage manager and keeps the contents of files of up to *max_file_size*
+  bytes in a least-recently-used cache of at most *max_size* bytes. Files are removed from
+  the cache when they are deleted through this process, other processes may serve a deleted
+  file from their cache until it is evicted. File IDs are never reused for different
+  contents, so the cache never serves outdated contents.
+  """
+
+  def __init__(
+    self,
+    storage_manager: StorageManager,
+    max_size: int = 32 * 1024 * 1024,
+    max_file_size: int = 256 * 1024,
+  ) -> None:
+    self._storage = storage_manager
+    self.max_size = max_size
+    self.max_file_size = max_file_size
+    self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+    self._size = 0
+    self._lock = threading.Lock()
+
+  @property
+  def deduplicates(self) -> bool:  # type: ignore
+    return self._storage.deduplicates
+
+  def get_cached(self, file_id: str) -> Optional[bytes]:
+    """
+    Returns the contents of the file if it is in the cache.
+    """
+
+    with self._lock:
+      data = self._entries.get(file_id)
+      if data is not None:
+        self._entries.move_to_end(file_id)
+    return data
+
+  def _put(self, file_id: str, data: bytes) -> None:
+    with self._lock:
+      if file_id in self._entries:
+        return
+      self._entries[file_id] = data
+      self._size += len(data)
+      while self._size > self.max_size:
+        _, evicted = self._entries.popitem(last=False)
+        self._size -= len(evicted)
+        storage_cache_evictions.inc()
+      storage_cache_bytes.set(self._size)
+
+  def _discard(self, file_id: str) -> None:
+    with self._lock:
+      data = self._entries.pop(file_id, None)
+      if data is not None:
+        self._size -= len(data)
+        storage_cache_bytes.set(self._size)
+
+  def create(self) -> Tuple[BinaryIO, str]:
+    return self._storage.create()
+
+  def commit(self, fp: BinaryIO, file_id: str) -> str:
+    return self._storage.commit(fp, file_id)
+
+  def open(self, file_id: str) -> BinaryIO:
+    data = self.get_cached(file_id)
+    if data is not None:
+      storage_cache_requests.inc(result='hit')
+      return io.BytesIO(data)
+    fp = self._storage.open(file_id)
+    data = fp.read(self.max_file_size + 1)
+    if len(data) > self.max_file_size:
+      storage_cache_requests.inc(result='uncacheable')
+      fp.seek(0)
+      return fp
+    fp.close()
+    storage_cache_requests.inc(result='miss')
+    self._put(file_id, data)
+    return io.BytesIO(data)
+
+  def delete(self, file_id: str) -> None:
+    self._discard(file_id)
+    self._storage.delete(file_id)
+
+  def delete_stale(self, file_id: str, min_age: float) -> bool:
+    deleted = self._storage.delete_stale(file_id, min_age)
+    if deleted:
+      self._discard(file_id)
+    return deleted
+
+  def get_path(self, file_id: str) -> Optional[Path]:
+    return self._storage.get_path(file_id)
+
+  def get_location(self, file_id: str) -> Optional[str]:
+    return self._storage.get_location(file_id)
+
+  def get_shards(self) -> List[str]:
+    return self._storage.get_shards()
+
+  def iter_files(self, shard: str) -> Iterator[Tuple[str, float]]:
+    return self._storage.iter_files(shard)
+
 
 class File(Entity):
   """
@@ -86,6 +421,22 @@ class File(Entity):
   #: Some value to indicate the state of the file (e.g. a hash).
   state = Column(String, nullable=True)
 
+  #: If the file is derived from another file (e.g. a thumbnail of an image), the ID of the
+  #: source file and the name of the variant (e.g. `thumbnail-64`). Variants are deleted
+  #: together with their source and when the #state of the source changes.
+  source_id = Column(Integer, ForeignKey(id, ondelete='CASCADE'), nullable=True)
+  variant = Column(String, nullable=True)
+
+  variants = relationship('File', cascade='all, delete-orphan',
+    backref=backref('source', remote_side=[id]))
+
+  __table_args__ = (
+    UniqueConstraint('source_id', 'variant'),
+    Index(__tablename__ + '.ix_file_id', 'file_id'),
+  )
+
+  get = instance_getter['File']()
+
   @classmethod
   @contextlib.contextmanager
   def create(cls,
@@ -101,20 +452,154 @@ class File(Entity):
       finally:
         if not fp.closed:
           fp.close()
+      instance.file_id = storage.commit(fp, file_id)
     except:
       storage.delete(file_id)
       raise
     else:
       session.add(instance)
 
+  @classmethod
+  def create_from_chunks(cls,
+    chunks: Iterable[bytes],
+    filename: Optional[str] = None,
+    mimetype: Optional[str] = None,
+    max_size: Optional[int] = None,
+  ) -> 'File':
+    """
+    Create a file from an iterable of *chunks* (e.g. #requests.Response.iter_content()) without
+    holding the whole contents in memory. The #state is set to the SHA-256 hash of the contents
+    and the #mimetype is sniffed from the first bytes, falling back to *mimetype* if the format
+    is not recognized. Raises #FileTooLarge if the contents exceed *max_size* bytes, in which
+    case nothing is stored.
+    """
+
+    hash_ = hashlib.sha256()
+    head = b''
+    size = 0
+    with cls.create(filename=filename) as (fp, instance):
+      for chunk in chunks:
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+          raise FileTooLarge(f'file exceeds the maximum size of {max_size} bytes')
+        if len(head) < 16:
+          head += chunk[:16]
+        hash_.update(chunk)
+        fp.write(chunk)
+      instance.state = 'sha256:' + hash_.hexdigest()
+      instance.mimetype = sniff_mimetype(head) or mimetype
+    return instance
+
+  def discard(self) -> None:
+    """
+    Discard a file that was created but not flushed to the database yet.
+    """
+
+    session.expunge(self)
+    if not storage.deduplicates:
+      storage.delete(self.file_id)
+
   def open(self) -> BinaryIO:
     return storage.open(self.file_id)
 
+  def get_variant(self, name: str) -> Optional['File']:
+    return File.get(source_id=self.id, variant=name).or_none()
+
+
+@event.listens_for(File.state, 'set')
+def _file_state_set(target: File, value, oldvalue, initiator):
+  if target.id is not None and value != oldvalue and target.variants:
+    logger.info('Evicting %d variant(s) of file %s', len(target.variants), target.id)
+    target.variants.clear()
+
+
+class BlobDeleter(threading.Thread):
+  """
+  Deletes files from the #storage in a background thread, in batches of up to *batch_size*
+  files. With a deduplicating storage, files that are still referenced by a #File are kept,
+  as well as files that were written or reused within the last *min_age* seconds because a
+  new reference to them may not be committed yet. These are left to the orphan sweeper.
+  """
+
+  def __init__(self, batch_size: int = 100, min_age: float = 3600.0) -> None:
+    super().__init__(daemon=True, name='blob-deleter')
+    self.batch_size = batch_size
+    self.min_age = min_age
+    self._queue: 'queue.Queue[str]' = queue.Queue()
+
+  def delete(self, file_ids: List[str]) -> None:
+    for file_id in file_ids:
+      self._queue.put(file_id)
+
+  def flush(self) -> None:
+    """
+    Wait until all queued files are deleted.
+    """
+
+    self._queue.join()
+
+  def run(self):
+    while True:
+      file_ids = [self._queue.get()]
+      while len(file_ids) < self.batch_size:
+        try:
+          file_ids.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+      try:
+        self._delete_batch(file_ids)
+      except:
+        logger.exception('Error deleting %d file(s) from the storage', len(file_ids))
+      finally:
+        for _ in file_ids:
+          self._queue.task_done()
+
+  def _delete_batch(self, file_ids: List[str]) -> None:
+    if storage.deduplicates:
+      try:
+        referenced = {x for x, in session.query(File.file_id).filter(File.file_id.in_(file_ids))}
+      finally:
+        session.remove()
+      file_ids = [x for x in file_ids if x not in referenced
+        and storage.delete_stale(x, self.min_age)]
+    else:
+      for file_id in file_ids:
+        storage.delete(file_id)
+    storage_files_deleted.inc(len(file_ids))
+    logger.info('Deleted %d file(s) from the storage', len(file_ids))
+
+
+def get_blob_deleter() -> BlobDeleter:
+  """
+  Returns the #BlobDeleter of this process, starting it on first use. Pending deletes are
+  flushed when the process exits.
+  """
+
+  global _blob_deleter
+  with _blob_deleter_lock:
+    if _blob_deleter is None:
+      _blob_deleter = BlobDeleter()
+      _blob_deleter.start()
+      atexit.register(_blob_deleter.flush)
+    return _blob_deleter
+
 
 @event.listens_for(File, 'after_delete')
 def _file_after_delete(mapper, connection, target: File):
-  logger.info('Deleting file "%s" from disk', target.file_id)
-  storage.delete(target.file_id)
+  # The file is only deleted from the storage after the transaction is committed.
+  object_session(target).info.setdefault(_PENDING_DELETES_KEY, []).append(target.file_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _delete_files_after_commit(session_) -> None:
+  file_ids = session_.info.pop(_PENDING_DELETES_KEY, None)
+  if file_ids:
+    get_blob_deleter().delete(file_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_deletes(session_) -> None:
+  session_.info.pop(_PENDING_DELETES_KEY, None)
 
 
 def init_storage(storage_manager: StorageManager) -> None:
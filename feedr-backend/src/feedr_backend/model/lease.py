@@ -0,0 +1,65 @@
+
+import datetime
+import logging
+
+from sqlalchemy import Column, DateTime, String
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import or_
+
+from ._base import Entity
+from ._session import session
+
+logger = logging.getLogger(__name__)
+
+
+class Lease(Entity):
+  """
+  A named lease that can be held by at most one holder at a time. Used for leader election
+  between multiple processes, e.g. so that only one scheduler enqueues recurring tasks. The
+  holder must renew the lease with #acquire() before it expires.
+  """
+
+  __tablename__ = __name__ + '.Lease'
+
+  name = Column(String, primary_key=True)
+  holder = Column(String, nullable=False)
+  expires_at = Column(DateTime, nullable=False)
+
+  @classmethod
+  def acquire(cls, name: str, holder: str, duration: datetime.timedelta) -> bool:
+    """
+    Acquire or renew the lease *name* for the *holder*. Returns #True if the *holder* holds
+    the lease for the next *duration*, #False if the lease is held by someone else. The
+    session is committed.
+    """
+
+    now = datetime.datetime.utcnow()
+    acquired = (session.query(cls)
+      .filter(cls.name == name, or_(cls.holder == holder, cls.expires_at < now))
+      .update({cls.holder: holder, cls.expires_at: now + duration}, synchronize_session=False))
+    session.commit()
+    if acquired:
+      return True
+
+    if session.query(cls.name).filter(cls.name == name).scalar() is not None:
+      return False
+    try:
+      session.add(cls(name=name, holder=holder, expires_at=now + duration))
+      session.commit()
+    except IntegrityError:
+      # Another holder created the lease at the same time.
+      session.rollback()
+      return False
+    return True
+
+  @classmethod
+  def release(cls, name: str, holder: str) -> None:
+    """
+    Release the lease *name* if it is held by *holder*, allowing another holder to acquire it
+    immediately. The session is committed.
+    """
+
+    (session.query(cls)
+      .filter(cls.name == name, cls.holder == holder)
+      .delete(synchronize_session=False))
+    session.commit()
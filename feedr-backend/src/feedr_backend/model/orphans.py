@@ -0,0 +1,80 @@
+
+"""
+Reconciles the files in the #storage with the #File table. Files that no #File refers to (e.g.
+because the process was killed before a deletion was executed) are deleted. The storage is
+swept incrementally, a few shards (see #StorageManager.get_shards()) per run.
+"""
+
+import datetime
+import logging
+import time
+from typing import List
+
+from databind.core import datamodel, field
+from nr.parsing.date import Duration
+
+from .. import metrics
+from ._session import session
+from .file import File, storage
+from .task import BaseTask, check_cancelled, register_task
+from .version import Version
+
+logger = logging.getLogger(__name__)
+
+#: The name of the #Version that counts the runs of the #SweepOrphanedFilesTask. It
+#: determines the shards that are swept in the next run.
+SWEEP_VERSION = __name__ + '.sweep'
+
+orphaned_files_deleted = metrics.Counter(
+  'feedr_orphaned_files_deleted_total', 'Number of orphaned files deleted from the storage.')
+
+
+def sweep_orphaned_files(
+  shards: List[str],
+  min_age: datetime.timedelta,
+  batch_size: int = 500,
+) -> int:
+  """
+  Delete the files in the *shards* of the #storage that are older than *min_age* and that
+  no #File refers to. The minimum age protects files that are being written and not yet
+  committed. Returns the number of deleted files.
+  """
+
+  cutoff = time.time() - min_age.total_seconds()
+  total = 0
+  for shard in shards:
+    check_cancelled()
+    file_ids = [file_id for file_id, mtime in storage.iter_files(shard) if mtime < cutoff]
+    for offset in range(0, len(file_ids), batch_size):
+      batch = file_ids[offset:offset + batch_size]
+      referenced = {x for x, in session.query(File.file_id).filter(File.file_id.in_(batch))}
+      for file_id in batch:
+        if file_id not in referenced and storage.delete_stale(file_id, min_age.total_seconds()):
+          logger.info('Deleted orphaned file "%s" from the storage', file_id)
+          orphaned_files_deleted.inc()
+          total += 1
+  return total
+
+
+@register_task('files.sweep_orphans')
+@datamodel
+class SweepOrphanedFilesTask(BaseTask):
+  """
+  Sweeps *shards_per_run* shards of the storage for orphaned files, continuing where the
+  previous run stopped.
+  """
+
+  shards_per_run: int = 16
+  min_age: Duration = field(default_factory=lambda: Duration.parse('P1D'))
+
+  def execute(self):
+    shards = storage.get_shards()
+    if not shards:
+      return
+    run = Version.get_value(SWEEP_VERSION)
+    Version.increment(SWEEP_VERSION)
+    session.commit()
+    count = min(self.shards_per_run, len(shards))
+    selected = [shards[(run * count + i) % len(shards)] for i in range(count)]
+    total = sweep_orphaned_files(selected, self.min_age.as_timedelta())
+    logger.info('Deleted %d orphaned file(s) from %d shard(s)', total, len(selected))
@@ -1,6 +1,7 @@
 
 import datetime
 import hashlib
+import logging
 import uuid
 from typing import List, Optional
 
@@ -11,11 +12,22 @@ from nr.parsing.date import Duration
 from sqlalchemy import Column, DateTime, ForeignKey, ForeignKeyConstraint, Integer, String, Table
 from sqlalchemy.orm import backref, relationship
 
+from .. import metrics
 from ._base import Entity, instance_getter
 from ._session import session
-from .task import BaseTask, queue_task
+from .task import BaseTask, RetryPolicy, check_cancelled, queue_task, register_task
 from .user import User
 
+logger = logging.getLogger(__name__)
+
+#: Timeout in seconds for requests to fetch a feed.
+FEED_REQUEST_TIMEOUT = 30.0
+
+feed_loads = metrics.Counter(
+  'feedr_feed_loads_total', 'Number of feeds loaded by result.', ['result'])
+feed_load_duration = metrics.Histogram(
+  'feedr_feed_load_duration_seconds', 'Time spent loading feeds.')
+
 
 class Feed(Entity):
   """
@@ -106,15 +118,25 @@ Article.authors = relationship(Author, back_populates='articles', secondary=_aut
 Author.articles = relationship(Article, back_populates='authors', secondary=_author_to_article)
 
 
-def load_feed(feed_url: str) -> None:
-  response = requests.get(feed_url)
+def load_feed(feed_url: str, timeout: float = FEED_REQUEST_TIMEOUT) -> None:
+  try:
+    with feed_load_duration.time():
+      updated = _load_feed(feed_url, timeout)
+  except:
+    feed_loads.inc(result='error')
+    raise
+  feed_loads.inc(result='updated' if updated else 'unchanged')
+
+
+def _load_feed(feed_url: str, timeout: float) -> bool:
+  response = requests.get(feed_url, timeout=timeout)
   response.raise_for_status()
   feed_hash = hashlib.md5(response.content).hexdigest()
 
   feed = Feed.get(url=feed_url).or_create()
   if feed.atom and feed.atom.hash == feed_hash:
     feed.atom.last_updated = datetime.datetime.utcnow()
-    return
+    return False
 
   data = feedparser.parse(response.text)
 
@@ -159,19 +181,51 @@ def load_feed(feed_url: str) -> None:
     for tag in entry.get('tags', []):
       Tag.get(term=tag['term']).or_create()
 
+  return True
+
+
+@register_task('rss.load_feed')
+@datamodel
+class LoadFeedTask(BaseTask):
+  """
+  Loads a single feed. Queued by #UpdateRssFeedsTask for feeds that could not be updated, so
+  they are retried with a backoff instead of waiting for the next update interval.
+  """
+
+  feed_url: str
+
+  retry_policy = RetryPolicy(
+    max_attempts=5,
+    initial_delay=30.0,
+    max_delay=1800.0,
+    retry_on=(requests.RequestException,))
 
+  def execute(self):
+    load_feed(self.feed_url)
+
+
+@register_task('rss.update_feeds')
 @datamodel
 class UpdateRssFeedsTask(BaseTask):
   update_interval: Duration
 
   def execute(self):
-    ok = True
     max_update_time = datetime.datetime.utcnow() - self.update_interval.as_timedelta()
-    for atom in session.query(Atom).filter(Atom.last_updated < max_update_time):
+    query = session.query(Atom).filter(Atom.last_updated < max_update_time)
+    feed_urls = [atom.feed.url for atom in query]
+
+    # Every feed is committed separately so that a failure does not discard the feeds that
+    # have been updated successfully.
+    for feed_url in feed_urls:
+      check_cancelled()
       try:
-        load_feed(atom.feed.url)
-      except:
-        logger.exception('Error updating feed %s', atom.feed)
-        ok = False
-    if not ok:
-      raise RuntimeError('not all feeds have been updated correctly')
+        load_feed(feed_url)
+        session.commit()
+      except Exception:
+        logger.exception('Error updating feed %s, queuing a retry', feed_url)
+        session.rollback()
+        queue_task(
+          f'Load Feed {feed_url}',
+          LoadFeedTask(feed_url),
+          run_at=datetime.datetime.utcnow() + LoadFeedTask.retry_policy.get_delay(1),
+          schedule_key=f'rss.load_feed:{feed_url}')
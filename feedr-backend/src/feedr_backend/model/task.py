@@ -1,40 +1,375 @@
 
 import abc
+import asyncio
+import contextlib
+import contextvars
 import enum
 import datetime
+import functools
+import gzip
 import importlib
+import inspect
+import json
 import logging
+import random
 import sys
-from typing import Optional
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple,
+  Type, TypeVar, Union)
 
-from databind.json import from_json, to_json
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, JSON, String, desc, event
+from databind.core import Context, Converter, datamodel
+from databind.json import registry as json_registry
+from nr.parsing.date import Duration
+from sqlalchemy import Column, DateTime, Enum, Float, Index, Integer, JSON, String, event, func, or_
 from sqlalchemy.orm.query import Query
+from sqlalchemy.sql import and_
 
-from ._base import Entity
-from ._session import Session, session, session_context
+from .. import metrics
+from ._base import Entity, instance_getter
+from ._session import TASK_DATABASE, Session, TaskSession, session, session_context, task_session
 from .file import File
 
 logger = logging.getLogger(__name__)
 
+tasks_queued = metrics.Counter(
+  'feedr_tasks_queued_total', 'Number of tasks that have been queued.', ['class_name'])
+tasks_finished = metrics.Counter(
+  'feedr_tasks_finished_total', 'Number of task executions by their resulting status.',
+  ['class_name', 'status'])
+task_dequeue_latency = metrics.Histogram(
+  'feedr_task_dequeue_latency_seconds', 'Time between a task becoming due and it\'s execution.',
+  ['class_name'])
+task_duration = metrics.Histogram(
+  'feedr_task_duration_seconds', 'Time spent executing tasks.', ['class_name'])
+tasks_purged = metrics.Counter(
+  'feedr_tasks_purged_total', 'Number of finished tasks deleted by the retention policy.',
+  ['status'])
+tasks_by_status = metrics.Gauge(
+  'feedr_tasks', 'Number of tasks in the queue by status.', ['status'])
+
+#: The default duration of a lease that a worker obtains when it claims a task.
+DEFAULT_LEASE_DURATION = datetime.timedelta(seconds=60)
+
+_current_context: 'contextvars.ContextVar[Optional[TaskContext]]' = \
+  contextvars.ContextVar(__name__ + '._current_context', default=None)
+T = TypeVar('T')
+
+#: The key in `Session.info` under which tasks in the outbox are stored.
+_OUTBOX_KEY = __name__ + '.outbox'
+_outbox_enabled = False
+T_BaseTask = TypeVar('T_BaseTask', bound=Type['BaseTask'])
+
+
+@dataclass
+class RetryPolicy:
+  """
+  Describes how often and when a task is retried after it failed with an exception. The delay
+  before the n-th retry is `initial_delay * backoff_factor ** (n - 1)`, capped at *max_delay*.
+  A random fraction of up to *jitter* of the delay is subtracted to avoid that tasks which
+  failed at the same time are all retried at the same time.
+  """
+
+  #: The maximum number of times the task is executed, including the first attempt.
+  max_attempts: int = 1
+
+  #: The delay before the first retry, in seconds.
+  initial_delay: float = 10.0
+
+  backoff_factor: float = 2.0
+
+  #: The maximum delay between two attempts, in seconds.
+  max_delay: float = 3600.0
+
+  jitter: float = 0.5
+
+  #: Only exceptions of these types cause a retry.
+  retry_on: Tuple[Type[BaseException], ...] = (Exception,)
+
+  def is_retryable(self, exc: BaseException) -> bool:
+    if isinstance(exc, TaskExecutionError) and exc.error_type is not None:
+      return issubclass(exc.error_type, self.retry_on)
+    return isinstance(exc, self.retry_on)
+
+  def should_retry(self, exc: BaseException, attempts: int) -> bool:
+    return attempts < self.max_attempts and self.is_retryable(exc)
+
+  def get_delay(self, attempts: int) -> datetime.timedelta:
+    delay = min(self.max_delay, self.initial_delay * self.backoff_factor ** max(attempts - 1, 0))
+    delay -= delay * self.jitter * random.random()
+    return datetime.timedelta(seconds=delay)
+
 
 class BaseTask(metaclass=abc.ABCMeta):
+  """
+  Base class for task implementations. Subclasses may implement #execute() as a coroutine
+  function, in which case the task can be executed concurrently with other tasks by the
+  #AsyncTaskWorker. Coroutines must not use the thread-local #session directly, but perform
+  database access with #run_in_session() instead.
+  """
+
+  #: The retry policy for tasks of this type. By default, tasks are not retried.
+  retry_policy = RetryPolicy()
+
+  #: The maximum amount of memory in bytes that the task may use. Only enforced if the task
+  #: is executed in a separate process. Overrides the executor's default limit if lower.
+  memory_limit: Optional[int] = None
+
+  #: The maximum time in seconds that the task may take. Overrides the executor's default limit
+  #: if lower. Tasks executed in the worker process must call #check_cancelled() regularly for
+  #: the limit to take effect, tasks executed in a separate process are killed.
+  time_limit: Optional[float] = None
 
   def execute(self):
     pass
 
 
+class TaskType(NamedTuple):
+  """
+  A task class together with the name it is stored under in #Task.class_name and it's
+  prepared JSON converter.
+  """
+
+  name: str
+  type: Type[BaseTask]
+  converter: Converter
+
+  def load(self, args: Any) -> BaseTask:
+    return self.converter.to_python(args, Context.new(json_registry, self.type, args))
+
+  def dump(self, impl: BaseTask) -> Any:
+    return self.converter.from_python(impl, Context.new(json_registry, self.type, impl))
+
+
+class TaskRegistry:
+  """
+  Resolves the names stored in #Task.class_name to task classes and caches them. Task classes
+  can be registered under a short, stable name with #register(), otherwise their name is the
+  fully qualified `module:Class` name, which is imported on first use.
+  """
+
+  def __init__(self) -> None:
+    self._by_name: Dict[str, TaskType] = {}
+    self._by_type: Dict[Type[BaseTask], TaskType] = {}
+    self._lock = threading.Lock()
+
+  def _add(self, name: str, type_: Type[BaseTask]) -> TaskType:
+    task_type = TaskType(name, type_, json_registry.get_converter(type_))
+    with self._lock:
+      self._by_name[name] = task_type
+      self._by_type.setdefault(type_, task_type)
+    return task_type
+
+  def register(self, name: str, type_: Type[BaseTask]) -> None:
+    if ':' in name:
+      raise ValueError(f'task name must not contain a colon: {name!r}')
+    existing = self._by_name.get(name)
+    if existing and existing.type is not type_:
+      raise RuntimeError(f'task name {name!r} is already registered for {existing.type!r}')
+    self._by_type.pop(type_, None)
+    self._add(name, type_)
+
+  def for_type(self, type_: Type[BaseTask]) -> TaskType:
+    try:
+      return self._by_type[type_]
+    except KeyError:
+      return self._add(type_.__module__ + ':' + type_.__qualname__, type_)
+
+  def resolve(self, name: str) -> TaskType:
+    try:
+      return self._by_name[name]
+    except KeyError:
+      pass
+    if ':' not in name:
+      raise LookupError(f'unknown task name {name!r}, is the module that registers it imported?')
+    module_name, member_name = name.split(':')
+    type_ = importlib.import_module(module_name)
+    for part in member_name.split('.'):
+      type_ = getattr(type_, part)
+    return self._add(name, type_)
+
+
+task_registry = TaskRegistry()
+
+
+def register_task(name: str) -> Callable[[T_BaseTask], T_BaseTask]:
+  """
+  Decorator to register a #BaseTask subclass under a short and stable *name*. The name is
+  stored in #Task.class_name instead of the class' module and name, so that the class can be
+  moved or renamed without orphaning queued tasks.
+  """
+
+  def decorator(type_: T_BaseTask) -> T_BaseTask:
+    task_registry.register(name, type_)
+    return type_
+
+  return decorator
+
+
+class TaskCancelled(Exception):
+  """
+  Raised by #check_cancelled() if the cancellation of the current task was requested.
+  """
+
+
+class TaskTimeoutError(Exception):
+  """
+  Raised by #check_cancelled() if the current task exceeded it's time limit.
+  """
+
+
+class TaskContext:
+  """
+  Holds the state of the task that is currently executed in a thread. The *cancelled* event
+  is set by the worker if the cancellation of the task was requested.
+  """
+
+  def __init__(
+    self,
+    task_id: int,
+    deadline: Optional[float] = None,
+    cancelled: Optional[threading.Event] = None,
+  ) -> None:
+    self.task_id = task_id
+    self.deadline = deadline
+    self.cancelled = cancelled or threading.Event()
+
+  @property
+  def remaining_time(self) -> Optional[float]:
+    if self.deadline is None:
+      return None
+    return self.deadline - time.time()
+
+  def check(self) -> None:
+    if self.cancelled.is_set():
+      raise TaskCancelled(f'task {self.task_id} was cancelled')
+    if self.deadline is not None and time.time() > self.deadline:
+      raise TaskTimeoutError(f'task {self.task_id} exceeded it\'s time limit')
+
+
+@contextlib.contextmanager
+def task_context(context: TaskContext) -> Iterator[TaskContext]:
+  token = _current_context.set(context)
+  try:
+    yield context
+  finally:
+    _current_context.reset(token)
+
+
+def current_task_context() -> Optional[TaskContext]:
+  return _current_context.get()
+
+
+def check_cancelled() -> None:
+  """
+  Raises #TaskCancelled if the cancellation of the current task was requested, or a
+  #TaskTimeoutError if the task exceeded it's time limit. Tasks should call this between units
+  of work. Does nothing if no task is executed in the current thread.
+  """
+
+  context = current_task_context()
+  if context:
+    context.check()
+
+
+def _call_in_session(func: Callable[..., T], *args: Any) -> T:
+  with session_context():
+    return func(*args)
+
+
+async def run_in_session(func: Callable[..., T], *args: Any) -> T:
+  """
+  Call *func* in a thread of the event loop's default executor with it's own database session,
+  which is committed if the function returns successfully. Use this from tasks that implement
+  #BaseTask.execute() as a coroutine function.
+  """
+
+  loop = asyncio.get_event_loop()
+  return await loop.run_in_executor(None, functools.partial(_call_in_session, func, *args))
+
+
+def run_task_impl(impl: BaseTask) -> None:
+  """
+  Execute a task implementation in the current thread. If the task implements
+  #BaseTask.execute() as a coroutine function, it is run in a new event loop.
+  """
+
+  result = impl.execute()
+  if inspect.isawaitable(result):
+    asyncio.run(result)
+
+
+class TaskExecutionError(Exception):
+  """
+  Raised by a #TaskExecutor if the task failed in a way that is not represented by an exception
+  in the current process, e.g. if it was executed in a separate process. The *error_type* is the
+  type of the exception that caused the failure, if known.
+  """
+
+  def __init__(self, message: str, error_type: Optional[Type[BaseException]] = None) -> None:
+    super().__init__(message)
+    self.error_type = error_type
+
+
+class TaskExecutor(metaclass=abc.ABCMeta):
+  """
+  Abstract base class for executing the implementation of a task. The executor does not take
+  care of the bookkeeping of the #Task status, that is handled by #Task.execute().
+  """
+
+  #: The default time limit for tasks executed by this executor, in seconds.
+  time_limit: Optional[float] = None
+
+  @abc.abstractmethod
+  def run(self, task: 'Task', impl: BaseTask) -> None:
+    """
+    Run the task implementation. Raises an exception if the task failed.
+    """
+
+
+class InProcessTaskExecutor(TaskExecutor):
+  """
+  Executes tasks in the current thread. This is the default executor. The time limit is
+  only enforced if the task calls #check_cancelled().
+  """
+
+  def __init__(self, time_limit: Optional[float] = None) -> None:
+    self.time_limit = time_limit
+
+  def run(self, task: 'Task', impl: BaseTask) -> None:
+    run_task_impl(impl)
+
+
 class TaskStatus(enum.Enum):
   PENDING = enum.auto()
   IN_PROGRESS = enum.auto()
   COMPLETED = enum.auto()
+
+  #: The task failed with an exception that it's retry policy does not permit retrying, or
+  #: the task has no retry policy.
   FAILED = enum.auto()
 
+  #: The task failed and exhausted all attempts permitted by it's retry policy (which permits
+  #: more than one attempt). Dead tasks can be inspected and replayed with the `tasks` CLI.
+  DEAD = enum.auto()
+
+  #: The task was cancelled before or during it's execution.
+  CANCELLED = enum.auto()
+
 
 class Task(Entity):
   """
   Represents a generic task that can be executed as soon as it hit's the front of the queue.
   Tasks are used in the background only and are not exposed to users.
+
+  A task is not picked up by a worker before it's #run_at time. Tasks that have a #recurrence
+  are queued again after they have been executed.
+
+  While a task is in progress, the worker that claimed it must periodically renew it's lease
+  (see #renew_lease()). Tasks with an expired lease are assumed to be abandoned by a worker
+  that died and are requeued by #reap_expired_leases().
   """
 
   __tablename__ = __name__ + '.Task'
@@ -49,7 +384,48 @@ class Task(Entity):
   worker_id = Column(String, nullable=True, default=None)
   started_at = Column(DateTime, nullable=True, default=None)
   ended_at = Column(DateTime, nullable=True, default=None)
-  log_file = Column(Integer, ForeignKey(File.id), nullable=True, default=None)
+
+  #: The ID of the #File that contains the output of the task. This is not a foreign key, as
+  #: the task table may be stored in a separate database (see #init_db()).
+  log_file = Column(Integer, nullable=True, default=None)
+
+  #: The earliest point in time at which the task may be executed.
+  run_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+  #: An ISO 8601 duration string. If set, the task is queued again with it's #run_at
+  #: advanced by this duration after it was executed.
+  recurrence = Column(String, nullable=True, default=None)
+
+  #: A key that identifies a recurring schedule. There should only ever be one pending
+  #: task per schedule key (see #ensure_recurring_task()).
+  schedule_key = Column(String, nullable=True, default=None)
+
+  #: The number of times that the task has been claimed by a worker.
+  attempts = Column(Integer, nullable=False, default=0)
+
+  #: The time until which the worker that claimed the task holds it. Must be extended by the
+  #: worker with heartbeats while the task is executing.
+  lease_expires_at = Column(DateTime, nullable=True, default=None)
+
+  #: A description of the error of the last failed attempt.
+  last_error = Column(String, nullable=True, default=None)
+
+  #: The time limit for this task in seconds. The lowest of this, the task class' and the
+  #: executor's time limit applies.
+  time_limit = Column(Float, nullable=True, default=None)
+
+  #: Set when the cancellation of the task was requested while it was in progress. The worker
+  #: picks this up with it's next heartbeat.
+  cancel_requested_at = Column(DateTime, nullable=True, default=None)
+
+  __table_args__ = (
+    Index(__tablename__ + '.ix_status_run_at', 'status', 'run_at'),
+    Index(__tablename__ + '.ix_schedule_key', 'schedule_key'),
+    Index(__tablename__ + '.ix_status_ended_at', 'status', 'ended_at'),
+    {'info': {'database': TASK_DATABASE}},
+  )
+
+  get = instance_getter['Task'](task_session)
 
   def __repr__(self):
     return f'Task(id={self.id!r}, status={self.status.name!r}, name={self.name!r}, '\
@@ -57,62 +433,676 @@ class Task(Entity):
 
   @classmethod
   def pending(cls) -> Query:
-    return session.query(cls).filter(cls.status == TaskStatus.PENDING).order_by(desc(cls.id))
+    """
+    Returns a query for all pending tasks that are due for execution, oldest first.
+    """
+
+    now = datetime.datetime.utcnow()
+    return (task_session.query(cls)
+      .filter(cls.status == TaskStatus.PENDING, cls.run_at <= now)
+      .order_by(cls.run_at, cls.id))
+
+  @classmethod
+  def claim(
+    cls,
+    worker_id: str,
+    lease_duration: datetime.timedelta = DEFAULT_LEASE_DURATION,
+    candidates: int = 5,
+  ) -> Optional['Task']:
+    """
+    Claim the next due task for the worker with the specified *worker_id*. The status of the
+    task is changed with a conditional `UPDATE` so that multiple workers can compete for the
+    same tasks without executing one twice. Returns #None if there is no due task.
+    """
+
+    for task_id, in cls.pending().with_entities(cls.id).limit(candidates).all():
+      now = datetime.datetime.utcnow()
+      claimed = (task_session.query(cls)
+        .filter(cls.id == task_id, cls.status == TaskStatus.PENDING)
+        .update({
+          cls.status: TaskStatus.IN_PROGRESS,
+          cls.worker_id: worker_id,
+          cls.started_at: now,
+          cls.attempts: cls.attempts + 1,
+          cls.lease_expires_at: now + lease_duration,
+        }, synchronize_session=False))
+      task_session.commit()
+      if claimed:
+        return task_session.query(cls).get(task_id)
+    return None
+
+  @classmethod
+  def renew_lease(
+    cls,
+    task_id: int,
+    worker_id: str,
+    lease_duration: datetime.timedelta = DEFAULT_LEASE_DURATION,
+  ) -> bool:
+    """
+    Extend the lease of a task that is in progress. Returns #False if the task is no longer
+    held by the worker with the specified *worker_id* (e.g. because the lease expired and the
+    task was requeued in the meantime).
+    """
+
+    renewed = (task_session.query(cls)
+      .filter(cls.id == task_id, cls.worker_id == worker_id, cls.status == TaskStatus.IN_PROGRESS)
+      .update({cls.lease_expires_at: datetime.datetime.utcnow() + lease_duration},
+        synchronize_session=False))
+    task_session.commit()
+    return bool(renewed)
+
+  @classmethod
+  def renew_leases(
+    cls,
+    task_ids: List[int],
+    worker_id: str,
+    lease_duration: datetime.timedelta = DEFAULT_LEASE_DURATION,
+  ) -> Dict[int, bool]:
+    """
+    Extend the leases of multiple tasks held by the worker with the specified *worker_id* in a
+    single `UPDATE`. Returns a dictionary that maps the IDs of the tasks that are still held by
+    the worker to whether their cancellation was requested.
+    """
+
+    if not task_ids:
+      return {}
+    held = and_(cls.id.in_(task_ids), cls.worker_id == worker_id,
+      cls.status == TaskStatus.IN_PROGRESS)
+    (task_session.query(cls)
+      .filter(held)
+      .update({cls.lease_expires_at: datetime.datetime.utcnow() + lease_duration},
+        synchronize_session=False))
+    result = {task_id: cancel_requested_at is not None for task_id, cancel_requested_at in
+      task_session.query(cls.id, cls.cancel_requested_at).filter(held).all()}
+    task_session.commit()
+    return result
+
+  @classmethod
+  def reap_expired_leases(cls, max_attempts: int = 3) -> int:
+    """
+    Requeue tasks that are in progress but whose lease has expired. Tasks that have already
+    been attempted *max_attempts* times are marked as dead instead. Returns the number of
+    tasks that have been reaped.
+    """
+
+    now = datetime.datetime.utcnow()
+    expired = and_(
+      cls.status == TaskStatus.IN_PROGRESS,
+      or_(cls.lease_expires_at == None, cls.lease_expires_at < now))  # noqa: E711
+
+    requeued = (task_session.query(cls)
+      .filter(expired, cls.attempts < max_attempts)
+      .update({
+        cls.status: TaskStatus.PENDING,
+        cls.worker_id: None,
+        cls.started_at: None,
+        cls.lease_expires_at: None,
+        cls.run_at: now,
+      }, synchronize_session=False))
+
+    failed = task_session.query(cls).filter(expired).all()
+    for task in failed:
+      logger.warning('Task %s is dead after %d attempt(s), the lease of worker %r expired',
+        task, task.attempts, task.worker_id)
+      task.status = TaskStatus.DEAD
+      task.ended_at = now
+      task.lease_expires_at = None
+      task.last_error = f'Lease of worker {task.worker_id!r} expired'
+      next_task = task.next_occurrence()
+      if next_task:
+        task_session.add(next_task)
+
+    task_session.commit()
+    if requeued:
+      logger.warning('Requeued %d task(s) with an expired lease', requeued)
+    return requeued + len(failed)
+
+  @classmethod
+  def request_cancel(cls, query: Query) -> int:
+    """
+    Cancel all tasks matched by *query*. Pending tasks are cancelled immediately, tasks that are
+    in progress are flagged and cancelled by their worker. Returns the number of affected tasks.
+    """
+
+    now = datetime.datetime.utcnow()
+    cancelled = (query
+      .filter(cls.status == TaskStatus.PENDING)
+      .update({
+        cls.status: TaskStatus.CANCELLED,
+        cls.ended_at: now,
+        cls.cancel_requested_at: now,
+      }, synchronize_session=False))
+    flagged = (query
+      .filter(cls.status == TaskStatus.IN_PROGRESS, cls.cancel_requested_at == None)  # noqa: E711
+      .update({cls.cancel_requested_at: now}, synchronize_session=False))
+    task_session.commit()
+    logger.info('Cancelled %d pending task(s), requested cancellation of %d running task(s)',
+      cancelled, flagged)
+    return cancelled + flagged
+
+  @classmethod
+  def replay(cls, query: Query) -> int:
+    """
+    Queue all tasks matched by *query* for immediate execution again, resetting their attempt
+    count. Returns the number of tasks that have been replayed.
+    """
+
+    replayed = query.update({
+      cls.status: TaskStatus.PENDING,
+      cls.worker_id: None,
+      cls.started_at: None,
+      cls.ended_at: None,
+      cls.lease_expires_at: None,
+      cls.cancel_requested_at: None,
+      cls.attempts: 0,
+      cls.run_at: datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+    task_session.commit()
+    logger.info('Replayed %d task(s)', replayed)
+    return replayed
+
+  @classmethod
+  def purge(
+    cls,
+    status: TaskStatus,
+    older_than: datetime.datetime,
+    batch_size: int = 500,
+    archive: bool = False,
+  ) -> int:
+    """
+    Delete tasks with the specified *status* that ended before *older_than*, including their
+    log files. Tasks are deleted in batches of *batch_size*, every batch is committed
+    separately. If *archive* is #True, every batch is written to a #TaskArchive before it is
+    deleted. Returns the number of deleted tasks.
+    """
+
+    assert status not in (TaskStatus.PENDING, TaskStatus.IN_PROGRESS), status
+    query = (task_session.query(cls)
+      .filter(cls.status == status, func.coalesce(cls.ended_at, cls.created_at) < older_than)
+      .order_by(cls.id)
+      .limit(batch_size))
+
+    total = 0
+    while True:
+      check_cancelled()
+      if archive:
+        tasks = query.all()
+        rows = [(task.id, task.log_file) for task in tasks]
+        if tasks:
+          TaskArchive.write(tasks)
+      else:
+        rows = query.with_entities(cls.id, cls.log_file).all()
+      if not rows:
+        break
+
+      task_ids = [task_id for task_id, _ in rows]
+      log_file_ids = [log_file for _, log_file in rows if log_file is not None]
+      task_session.query(cls).filter(cls.id.in_(task_ids)).delete(synchronize_session=False)
+      session.commit()
+      task_session.commit()
+
+      # The files are deleted after the tasks, as they may live in a separate database.
+      # They are deleted one by one so that they are also removed from the storage.
+      if log_file_ids:
+        for file_ in session.query(File).filter(File.id.in_(log_file_ids)):
+          session.delete(file_)
+        session.commit()
+
+      total += len(rows)
+      tasks_purged.inc(len(rows), status=status.name)
+      if len(rows) < batch_size:
+        break
+
+    if total:
+      logger.info('Purged %d %s task(s) that ended before %s', total, status.name, older_than)
+    return total
 
   @classmethod
-  def create(cls, name: str, origin: str, task_impl: BaseTask) -> 'Task':
-    class_name = type(task_impl).__module__ + ':' + type(task_impl).__name__
-    args = to_json(task_impl, type(task_impl))
-    task = cls(name=name, origin=origin, class_name=class_name, args=args)
+  def create(
+    cls,
+    name: str,
+    origin: str,
+    task_impl: BaseTask,
+    run_at: Optional[datetime.datetime] = None,
+    recurrence: Union[str, Duration, None] = None,
+    schedule_key: Optional[str] = None,
+    time_limit: Optional[float] = None,
+  ) -> 'Task':
+    task_type = task_registry.for_type(type(task_impl))
+    task = cls(
+      name=name,
+      origin=origin,
+      class_name=task_type.name,
+      args=task_type.dump(task_impl),
+      run_at=run_at or datetime.datetime.utcnow(),
+      recurrence=str(recurrence) if recurrence is not None else None,
+      schedule_key=schedule_key,
+      time_limit=time_limit)
     return task
 
   def load(self) -> BaseTask:
-    module_name, member_name = self.class_name.split(':')
-    module = importlib.import_module(module_name)
-    type_ = getattr(module, member_name)
-    return from_json(type_, self.args)
-
-  def execute(self, worker_id: str):
-    assert self.status == TaskStatus.PENDING
-    self.worker_id = worker_id
-    self.status = TaskStatus.IN_PROGRESS
-    self.started_at = datetime.datetime.utcnow()
-    session.commit()
+    return task_registry.resolve(self.class_name).load(self.args)
+
+  def next_occurrence(self) -> Optional['Task']:
+    """
+    Create the next occurrence of a recurring task. If the task is behind schedule (e.g.
+    because no worker was running), the next occurrence is due immediately.
+    """
+
+    if not self.recurrence:
+      return None
+    interval = Duration.parse(self.recurrence).as_timedelta()
+    run_at = max(self.run_at + interval, datetime.datetime.utcnow())
+    return Task(
+      name=self.name,
+      origin=self.origin,
+      class_name=self.class_name,
+      args=self.args,
+      run_at=run_at,
+      recurrence=self.recurrence,
+      schedule_key=self.schedule_key,
+      time_limit=self.time_limit)
+
+  def iter_log(self, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Iterate over the decompressed output of the task in chunks. Yields nothing if there is no
+    log for the task (e.g. because it was not executed in a separate process).
+    """
+
+    if self.log_file is None:
+      return
+    file_ = session.query(File).get(self.log_file)
+    if file_ is None:
+      return
+    with file_.open() as fp, gzip.GzipFile(fileobj=fp, mode='rb') as gz:
+      while True:
+        chunk = gz.read(chunk_size)
+        if not chunk:
+          break
+        yield chunk
+
+  def begin_execution(
+    self,
+    time_limit: Optional[float] = None,
+    cancelled: Optional[threading.Event] = None,
+  ) -> 'TaskExecution':
+    """
+    Prepare the execution of a task that was claimed by a worker. Loads the task
+    implementation and computes the deadline of the execution from the task's, the task
+    class' and the executor's *time_limit*. Errors while loading the implementation are
+    stored in #TaskExecution.error and reported by #end_execution().
+    """
+
+    assert self.status == TaskStatus.IN_PROGRESS, 'task must be claimed before execution'
 
     logger.info('Executing task %s', self)
+    task_dequeue_latency.observe(
+      max((self.started_at - self.run_at).total_seconds(), 0), class_name=self.class_name)
+    execution = TaskExecution(self)
     try:
-      # TODO: Execute in separate process to capture full stdout/stderr.
-      #with session_context():
-      impl = self.load()
-      impl.execute()
-    except BaseException as exc:
-      logger.exception('Error executing task %s', self)
-      status = TaskStatus.FAILED
+      execution.impl = self.load()
+    except Exception as exc:
+      execution.error = exc
+    else:
+      execution.retry_policy = execution.impl.retry_policy
+      time_limit = _min_limit(self.time_limit, execution.impl.time_limit, time_limit)
+      deadline = time.time() + time_limit if time_limit is not None else None
+      execution.context = TaskContext(self.id, deadline, cancelled)
+    return execution
+
+  def end_execution(self, execution: 'TaskExecution') -> None:
+    """
+    Update the status of the task based on the result of the *execution*. Failed tasks are
+    queued again if their retry policy permits it. The result is discarded if the worker lost
+    it's lease on the task in the meantime.
+    """
+
+    exc = execution.error
+    class_name = execution.class_name
+    retry_policy = execution.retry_policy
+    if exc is not None:
+      if isinstance(exc, TaskCancelled):
+        logger.info('Task %s was cancelled', self)
+      else:
+        logger.error('Error executing task %s', self, exc_info=exc)
+      session.rollback()
+      values: Dict[Any, Any] = {Task.last_error: format_error(exc)}
+      if isinstance(exc, TaskCancelled):
+        status = TaskStatus.CANCELLED
+      elif retry_policy.should_retry(exc, execution.attempts):
+        status = TaskStatus.PENDING
+        values[Task.run_at] = datetime.datetime.utcnow() + retry_policy.get_delay(execution.attempts)
+        values[Task.worker_id] = None
+      elif retry_policy.max_attempts > 1 and retry_policy.is_retryable(exc):
+        status = TaskStatus.DEAD
+      else:
+        status = TaskStatus.FAILED
     else:
       status = TaskStatus.COMPLETED
+      values = {}
+
+    task_duration.observe(time.perf_counter() - execution.start_time, class_name=class_name)
+    tasks_finished.inc(class_name=class_name, status=status.name)
+
+    if not self._finish(execution.worker_id, status, values):
+      logger.warning('Worker %r lost the lease on task %s before it completed, the result '
+        'of the execution is discarded', execution.worker_id, self)
+      return
+
+    if status in (TaskStatus.PENDING, TaskStatus.CANCELLED):
+      task_session.commit()
+      if status == TaskStatus.PENDING:
+        logger.info('Retrying task %s at %s (attempt %d of %d)', self, self.run_at,
+          execution.attempts + 1, retry_policy.max_attempts)
+      return
 
-    self.ended_at = datetime.datetime.utcnow()
-    self.status = status
-    #self.log_file = ...
-    session.commit()
+    next_task = self.next_occurrence()
+    if next_task:
+      task_session.add(next_task)
+    task_session.commit()
     logger.info('Completed execution of task %s', self)
+    if next_task:
+      logger.info('Scheduled next occurrence %s at %s', next_task, next_task.run_at)
+
+  def execute(
+    self,
+    executor: Optional[TaskExecutor] = None,
+    cancelled: Optional[threading.Event] = None,
+  ):
+    """
+    Execute a task that was claimed by a worker using the specified *executor* (defaults to
+    executing the task in the current thread) and update it's status based on the result. The
+    *cancelled* event should be set by the worker if the cancellation of the task is requested.
+
+    The #session is committed before the status of the task is updated, so that the task is
+    not marked as completed if it's changes can not be committed. A failing commit is handled
+    like any other error of the task.
+    """
+
+    executor = executor or InProcessTaskExecutor()
+    execution = self.begin_execution(executor.time_limit, cancelled)
+    if execution.error is None:
+      try:
+        with task_context(execution.context):
+          executor.run(self, execution.impl)
+        session.commit()
+      except BaseException as exc:
+        execution.error = exc
+    self.end_execution(execution)
+
+  def _finish(
+    self,
+    worker_id: str,
+    status: TaskStatus,
+    values: Optional[Dict[Any, Any]] = None,
+  ) -> bool:
+    """
+    Transition the task from in progress into the *status*, provided that the task is still
+    held by the worker with the specified *worker_id*. Additional column *values* can be
+    updated as well.
+    """
+
+    return bool(task_session.query(Task)
+      .filter(Task.id == self.id, Task.worker_id == worker_id, Task.status == TaskStatus.IN_PROGRESS)
+      .update({
+        Task.status: status,
+        Task.ended_at: datetime.datetime.utcnow(),
+        Task.lease_expires_at: None,
+        **(values or {}),
+      }, synchronize_session='evaluate'))
+
+
+class TaskArchive(Entity):
+  """
+  A compressed file of newline delimited JSON objects that contains tasks which have been
+  deleted by #Task.purge(). Every line represents one task with the same keys as the
+  columns of the #Task table.
+  """
+
+  __tablename__ = __name__ + '.TaskArchive'
+  __table_args__ = {'info': {'database': TASK_DATABASE}}
+
+  id = Column(Integer, primary_key=True)
+  created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+  #: The ID of the #File that contains the archive (see #Task.log_file for why this is not
+  #: a foreign key).
+  file_id = Column(Integer, nullable=False)
+
+  count = Column(Integer, nullable=False)
+  first_task_id = Column(Integer, nullable=False)
+  last_task_id = Column(Integer, nullable=False)
+
+  @property
+  def file(self) -> File:
+    return session.query(File).get(self.file_id)
+
+  @classmethod
+  def write(cls, tasks: List[Task]) -> 'TaskArchive':
+    """
+    Write the *tasks* into a new archive. The file is flushed to the #session and the archive
+    is added to the #task_session, neither are committed.
+    """
+
+    task_ids = [task.id for task in tasks]
+    filename = f'tasks-{min(task_ids)}-{max(task_ids)}.ndjson.gz'
+    with File.create(filename=filename, mimetype='application/gzip') as (fp, file_):
+      with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+        for task in tasks:
+          gz.write(json.dumps(_task_to_json(task)).encode('utf8') + b'\n')
+    session.flush()
+    archive = cls(file_id=file_.id, count=len(tasks), first_task_id=min(task_ids),
+      last_task_id=max(task_ids))
+    task_session.add(archive)
+    return archive
+
+  def iter_tasks(self) -> Iterator[Dict[str, Any]]:
+    with self.file.open() as fp, gzip.GzipFile(fileobj=fp, mode='rb') as gz:
+      for line in gz:
+        yield json.loads(line)
+
+
+def _task_to_json(task: Task) -> Dict[str, Any]:
+  result = {}
+  for column in Task.__table__.columns:
+    value = getattr(task, column.key)
+    if isinstance(value, datetime.datetime):
+      value = value.isoformat()
+    elif isinstance(value, enum.Enum):
+      value = value.name
+    result[column.key] = value
+  return result
+
+
+class TaskExecution:
+  """
+  Holds the state of a single execution of a #Task between #Task.begin_execution() and
+  #Task.end_execution(). The execution can outlive the database session that the task was
+  loaded from, which allows a worker to run the task implementation outside of a session.
+  """
+
+  def __init__(self, task: Task) -> None:
+    self.task_id: int = task.id
+    self.worker_id: str = task.worker_id
+    self.class_name: str = task.class_name
+    self.attempts: int = task.attempts
+    self.impl: Optional[BaseTask] = None
+    self.retry_policy: RetryPolicy = BaseTask.retry_policy
+    self.context = TaskContext(task.id)
+    self.start_time = time.perf_counter()
+
+    #: The exception raised by the task, if any.
+    self.error: Optional[BaseException] = None
+
+  @property
+  def is_async(self) -> bool:
+    """
+    #True if the task implements #BaseTask.execute() as a coroutine function.
+    """
+
+    return self.impl is not None and inspect.iscoroutinefunction(self.impl.execute)
+
+
+def _min_limit(*limits: Any) -> Any:
+  return min((x for x in limits if x is not None), default=None)
+
+
+def format_error(exc: BaseException) -> str:
+  return ''.join(traceback.format_exception_only(type(exc), exc)).strip()
 
 
 @event.listens_for(Task, 'after_insert')
 def _task_saved(mapper, connection, target: Task):
-  logger.info('Queued task (id: %d, name: %r, origin: %r, class_name: %r)',
-    target.id, target.name, target.origin, target.class_name)
+  logger.info('Queued task (id: %d, name: %r, origin: %r, class_name: %r, run_at: %s)',
+    target.id, target.name, target.origin, target.class_name, target.run_at)
+  tasks_queued.inc(class_name=target.class_name)
 
 
-def queue_task(name: str, task_impl: BaseTask, stackdepth: int = 1) -> Task:
-  assert isinstance(task_impl, BaseTask), 'expected BaseTask instance'
-  frame = sys._getframe(stackdepth)
+@metrics.registry.add_collector
+def _collect_tasks_by_status() -> None:
+  counts = dict(task_session.query(Task.status, func.count(Task.id)).group_by(Task.status).all())
+  for status in TaskStatus:
+    tasks_by_status.set(counts.get(status, 0), status=status.name)
+
+
+def _get_origin(stackdepth: int) -> str:
+  frame = sys._getframe(stackdepth + 1)
   try:
-    origin = frame.f_code.co_filename + ':' + str(frame.f_lineno)
+    return frame.f_code.co_filename + ':' + str(frame.f_lineno)
   finally:
     del frame
-  task = Task.create(name, origin, task_impl)
-  session.add(task)
-  session.commit()
+
+
+def set_task_outbox(enabled: bool) -> None:
+  """
+  Enable or disable the transactional outbox for #queue_task(). If enabled, queued tasks are
+  held back in the current #session and only written to the task database after the
+  session is committed. If the session is rolled back, the tasks are discarded.
+  """
+
+  global _outbox_enabled
+  _outbox_enabled = enabled
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_outbox(session_) -> None:
+  tasks = session_.info.pop(_OUTBOX_KEY, None)
+  if not tasks:
+    return
+  # The committed session can not be used anymore at this point.
+  publisher = TaskSession(expire_on_commit=False)
+  try:
+    publisher.add_all(tasks)
+    publisher.commit()
+  except:
+    logger.exception('Unable to publish %d task(s) from the outbox', len(tasks))
+    publisher.rollback()
+    raise
+  finally:
+    publisher.close()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_outbox(session_) -> None:
+  tasks = session_.info.pop(_OUTBOX_KEY, None)
+  if tasks:
+    logger.info('Discarded %d task(s) from the outbox', len(tasks))
+
+
+def _find_scheduled_task(schedule_key: str) -> Optional[Task]:
+  """
+  Returns a pending or running task with the *schedule_key*, including tasks in the outbox.
+  """
+
+  for task in session.info.get(_OUTBOX_KEY, []):
+    if task.schedule_key == schedule_key:
+      return task
+  return (task_session.query(Task)
+    .filter(Task.schedule_key == schedule_key)
+    .filter(Task.status.in_([TaskStatus.PENDING, TaskStatus.IN_PROGRESS]))
+    .first())
+
+
+def queue_task(
+  name: str,
+  task_impl: BaseTask,
+  stackdepth: int = 1,
+  run_at: Optional[datetime.datetime] = None,
+  recurrence: Union[str, Duration, None] = None,
+  time_limit: Optional[float] = None,
+  schedule_key: Optional[str] = None,
+) -> Task:
+  """
+  Queue a task for execution. If *run_at* is specified, the task will not be executed before
+  that time. A *recurrence* causes the task to be queued again after every execution. The
+  *time_limit* in seconds overrides the task class' time limit if it is lower. If a
+  *schedule_key* is specified and a pending or running task with the same key exists, that
+  task is returned instead and no new task is queued.
+
+  If the outbox is enabled (see #set_task_outbox()), the task is only queued when the current
+  #session is committed and does not have an ID until then.
+  """
+
+  assert isinstance(task_impl, BaseTask), 'expected BaseTask instance'
+  if schedule_key is not None:
+    existing = _find_scheduled_task(schedule_key)
+    if existing:
+      logger.info('Not queuing task %r, task %s is already scheduled', name, existing)
+      return existing
+  origin = _get_origin(stackdepth)
+  task = Task.create(name, origin, task_impl, run_at=run_at, recurrence=recurrence,
+    time_limit=time_limit, schedule_key=schedule_key)
+  if _outbox_enabled:
+    session.info.setdefault(_OUTBOX_KEY, []).append(task)
+    logger.info('Added task %s to the outbox', task)
+    return task
+  task_session.add(task)
+  task_session.commit()
   logger.info('Queued task %s', task)
   return task
+
+
+def ensure_recurring_task(
+  schedule_key: str,
+  name: str,
+  task_impl: BaseTask,
+  recurrence: Union[str, Duration],
+  stackdepth: int = 1,
+) -> Task:
+  """
+  Ensure that a recurring task identified by *schedule_key* exists in the queue. If there is
+  already a pending or running task with the same key, that task is returned instead and no
+  new task is queued. This is safe to call on every start of the application, as the schedule
+  is persisted in the database.
+  """
+
+  assert isinstance(task_impl, BaseTask), 'expected BaseTask instance'
+  task = _find_scheduled_task(schedule_key)
+  if task:
+    return task
+  origin = _get_origin(stackdepth)
+  task = Task.create(name, origin, task_impl, recurrence=recurrence, schedule_key=schedule_key)
+  task_session.add(task)
+  task_session.commit()
+  logger.info('Scheduled recurring task %s (every %s)', task, task.recurrence)
+  return task
+
+
+@register_task('tasks.purge')
+@datamodel
+class PurgeTasksTask(BaseTask):
+  """
+  Deletes finished tasks that are older than the maximum age configured for their status.
+  Statuses without a maximum age are kept forever.
+  """
+
+  #: Maps the names of #TaskStatus values to the maximum age of tasks with that status.
+  max_age: Dict[str, Duration]
+  batch_size: int = 500
+  archive: bool = False
+
+  def execute(self):
+    now = datetime.datetime.utcnow()
+    for status_name, max_age in self.max_age.items():
+      Task.purge(TaskStatus[status_name], now - max_age.as_timedelta(), self.batch_size,
+        self.archive)
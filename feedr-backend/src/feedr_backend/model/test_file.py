@@ -0,0 +1,32 @@
+
+from pathlib import Path
+
+from . import init_db, session
+from .file import ContentAddressedStorageManager, File, init_storage, storage
+
+
+def test_content_addressed_storage(tmp_path: Path) -> None:
+  init_db('sqlite:///' + str(tmp_path / 'test.db'), create_tables=True)
+  init_storage(ContentAddressedStorageManager(tmp_path / 'media'))
+  try:
+    with File.create(mimetype='text/plain') as (fp, first):
+      fp.write(b'Hello, ')
+      fp.write(b'World!')
+    second = File.create_from_chunks([b'Hello, World!'], mimetype='text/plain')
+    session.commit()
+
+    assert first.file_id == second.file_id
+    assert first.id != second.id
+    assert second.state == 'sha256:' + first.file_id
+    with first.open() as fp:
+      assert fp.read() == b'Hello, World!'
+    assert not list((tmp_path / 'media' / '.tmp').iterdir())
+
+    # The file was just written, so it is protected from deletion.
+    assert not storage.delete_stale(first.file_id, 3600)
+    with second.open() as fp:
+      assert fp.read() == b'Hello, World!'
+    assert storage.delete_stale(first.file_id, 0)
+    assert not storage.get_path(first.file_id).exists()
+  finally:
+    session.remove()
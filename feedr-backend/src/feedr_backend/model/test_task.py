@@ -0,0 +1,215 @@
+
+import datetime
+import threading
+from pathlib import Path
+from typing import Optional
+
+from databind.core import datamodel
+from sqlalchemy import event
+
+from . import init_db, session, task_session
+from .file import LocalStorageManager, init_storage
+from .task import (BaseTask, RetryPolicy, Task, TaskArchive, TaskStatus, check_cancelled,
+  queue_task, register_task, set_task_outbox)
+
+#: A retry policy that permits a second attempt without delay.
+RETRY_ONCE = RetryPolicy(max_attempts=2, initial_delay=0, jitter=0, retry_on=(ValueError,))
+
+
+@register_task('test_task.noop')
+@datamodel
+class NoopTask(BaseTask):
+  pass
+
+
+@register_task('test_task.raise')
+@datamodel
+class RaisingTask(BaseTask):
+  retry_policy = RETRY_ONCE
+
+  error_type: str
+
+  def execute(self):
+    raise {'ValueError': ValueError, 'KeyError': KeyError}[self.error_type]('failed')
+
+
+@register_task('test_task.raise_without_retry')
+@datamodel
+class RaisingTaskWithoutRetry(BaseTask):
+
+  def execute(self):
+    raise ValueError('failed')
+
+
+@register_task('test_task.cancellable')
+@datamodel
+class CancellableTask(BaseTask):
+
+  def execute(self):
+    check_cancelled()
+
+
+@register_task('test_task.failing_commit')
+@datamodel
+class FailingCommitTask(BaseTask):
+
+  def execute(self):
+    def _fail(session_):
+      raise RuntimeError('commit failed')
+    event.listen(session(), 'before_commit', _fail, once=True)
+
+
+def _init_db(tmp_path: Path) -> None:
+  init_db(
+    'sqlite:///' + str(tmp_path / 'test.db'),
+    create_tables=True,
+    task_db_url='sqlite:///' + str(tmp_path / 'tasks.db'))
+  init_storage(LocalStorageManager(tmp_path / 'media'))
+
+
+def _remove_sessions() -> None:
+  session.remove()
+  task_session.remove()
+
+
+def _claim_and_execute(cancelled: Optional[threading.Event] = None) -> Task:
+  task = Task.claim('worker')
+  assert task is not None
+  task.execute(cancelled=cancelled)
+  return task
+
+
+def test_retry_transitions(tmp_path: Path) -> None:
+  _init_db(tmp_path)
+  try:
+    retried = queue_task('retried', RaisingTask('ValueError'))
+    task = _claim_and_execute()
+    assert task.id == retried.id
+    assert task.status == TaskStatus.PENDING
+    assert task.worker_id is None
+    assert task.last_error == 'ValueError: failed'
+
+    # The second attempt exhausts the retry policy.
+    task = _claim_and_execute()
+    assert task.id == retried.id
+    assert task.status == TaskStatus.DEAD
+    assert task.attempts == 2
+
+    # The exception is not retryable.
+    queue_task('not_retryable', RaisingTask('KeyError'))
+    task = _claim_and_execute()
+    assert task.status == TaskStatus.FAILED
+    assert task.attempts == 1
+
+    # Tasks without a retry policy fail, they are not dead.
+    queue_task('without_retry', RaisingTaskWithoutRetry())
+    task = _claim_and_execute()
+    assert task.status == TaskStatus.FAILED
+
+    queue_task('noop', NoopTask())
+    task = _claim_and_execute()
+    assert task.status == TaskStatus.COMPLETED
+    assert Task.claim('worker') is None
+  finally:
+    _remove_sessions()
+
+
+def test_failing_commit_fails_task(tmp_path: Path) -> None:
+  _init_db(tmp_path)
+  try:
+    queue_task('failing_commit', FailingCommitTask())
+    task = _claim_and_execute()
+    assert task.status == TaskStatus.FAILED
+    assert task.last_error == 'RuntimeError: commit failed'
+  finally:
+    _remove_sessions()
+
+
+def test_reap_expired_leases(tmp_path: Path) -> None:
+  _init_db(tmp_path)
+  try:
+    queued = queue_task('abandoned', NoopTask())
+
+    def _claim_and_expire() -> None:
+      task = Task.claim('worker', datetime.timedelta(seconds=60))
+      assert task is not None and task.id == queued.id
+      task.lease_expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+      task_session.commit()
+
+    _claim_and_expire()
+    assert Task.reap_expired_leases(max_attempts=2) == 1
+    task = Task.get(id=queued.id).instance
+    assert task.status == TaskStatus.PENDING
+    assert task.worker_id is None
+
+    _claim_and_expire()
+    assert Task.reap_expired_leases(max_attempts=2) == 1
+    task_session.expire_all()
+    assert task.status == TaskStatus.DEAD
+    assert task.last_error == "Lease of worker 'worker' expired"
+    assert Task.reap_expired_leases(max_attempts=2) == 0
+  finally:
+    _remove_sessions()
+
+
+def test_cancellation(tmp_path: Path) -> None:
+  _init_db(tmp_path)
+  try:
+    pending = queue_task('pending', NoopTask())
+    assert Task.request_cancel(task_session.query(Task).filter(Task.id == pending.id)) == 1
+    task_session.expire_all()
+    assert pending.status == TaskStatus.CANCELLED
+    assert Task.claim('worker') is None
+
+    # Running tasks are flagged and cancelled by their worker with the next heartbeat.
+    running = queue_task('running', CancellableTask())
+    task = Task.claim('worker')
+    assert task is not None and task.id == running.id
+    assert Task.request_cancel(task_session.query(Task).filter(Task.id == running.id)) == 1
+    assert Task.renew_leases([task.id], 'worker') == {task.id: True}
+    cancelled = threading.Event()
+    cancelled.set()
+    task.execute(cancelled=cancelled)
+    assert task.status == TaskStatus.CANCELLED
+  finally:
+    _remove_sessions()
+
+
+def test_outbox(tmp_path: Path) -> None:
+  _init_db(tmp_path)
+  set_task_outbox(True)
+  try:
+    queue_task('committed', NoopTask())
+    assert task_session.query(Task).count() == 0
+    session.commit()
+    assert [x.name for x in task_session.query(Task)] == ['committed']
+
+    queue_task('rolled_back', NoopTask())
+    session.rollback()
+    session.commit()
+    assert [x.name for x in task_session.query(Task)] == ['committed']
+  finally:
+    set_task_outbox(False)
+    _remove_sessions()
+
+
+def test_purge_with_archive(tmp_path: Path) -> None:
+  _init_db(tmp_path)
+  try:
+    for name in ['a', 'b', 'c']:
+      queue_task(name, NoopTask())
+      _claim_and_execute()
+    queue_task('failed', RaisingTaskWithoutRetry())
+    _claim_and_execute()
+
+    older_than = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+    assert Task.purge(TaskStatus.COMPLETED, older_than, batch_size=2, archive=True) == 3
+    assert [x.name for x in task_session.query(Task)] == ['failed']
+
+    archives = task_session.query(TaskArchive).order_by(TaskArchive.id).all()
+    assert [x.count for x in archives] == [2, 1]
+    names = [x['name'] for archive in archives for x in archive.iter_tasks()]
+    assert names == ['a', 'b', 'c']
+    assert all(x['status'] == 'COMPLETED' for x in archives[0].iter_tasks())
+  finally:
+    _remove_sessions()
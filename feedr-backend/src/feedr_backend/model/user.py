@@ -1,15 +1,39 @@
 
 import datetime
+import logging
 import uuid
-from typing import Optional
+from typing import Any, Iterable, List, Optional, Union
 
 import requests
-from sqlalchemy import Column, Binary, DateTime, ForeignKey, Integer, JSON, String
+from databind.core import datamodel
+from sqlalchemy import Column, Binary, DateTime, ForeignKey, Index, Integer, JSON, String
 from sqlalchemy.orm import relationship
 
+from .. import metrics
 from ._base import Entity, instance_getter
 from ._session import session
 from .file import File
+from .task import BaseTask, check_cancelled, register_task
+from .version import Version
+
+logger = logging.getLogger(__name__)
+
+#: Timeout in seconds for requests to download an avatar.
+AVATAR_REQUEST_TIMEOUT = 30.0
+
+#: The maximum size of an avatar in bytes.
+AVATAR_MAX_SIZE = 10 * 1024 * 1024
+
+#: The size of the chunks in which avatars are downloaded.
+AVATAR_CHUNK_SIZE = 64 * 1024
+
+#: The name of the #Version that is incremented when a token is revoked.
+TOKEN_VERSION = __name__ + '.Token'
+
+avatar_refreshes = metrics.Counter(
+  'feedr_avatar_refreshes_total', 'Number of avatar refreshes by result.', ['result'])
+expired_rows_swept = metrics.Counter(
+  'feedr_expired_rows_swept_total', 'Number of expired rows deleted by table.', ['table'])
 
 
 class User(Entity):
@@ -28,6 +52,11 @@ class User(Entity):
   #: where there is no #avatar_url and the image is stored directlry.
   avatar_file_id = Column(Integer, ForeignKey(File.id))
 
+  #: The `ETag` and `Last-Modified` headers of the response that the #avatar_file was
+  #: downloaded from, used to send conditional requests in #refresh_avatar().
+  avatar_etag = Column(String, nullable=True)
+  avatar_last_modified = Column(String, nullable=True)
+
   #: The ID of the collector where the user originates from.
   collector_id = Column(String)
 
@@ -38,30 +67,72 @@ class User(Entity):
   tokens = relationship('Token', back_populates='user')
   get = instance_getter['User']()
 
-  def save_avatar(self, raw_data: bytes, content_type: str) -> None:
+  def save_avatar(self, raw_data: Union[bytes, Iterable[bytes]], content_type: str) -> None:
     """
-    Saves the avatar of the user.
+    Saves the avatar of the user. The *raw_data* can also be an iterable of chunks.
     """
 
     if not content_type.startswith('image/'):
       raise ValueError(f'expected image content type, got {content_type!r}')
+    self._set_avatar_file(self._create_avatar_file(raw_data, content_type))
+
+  def _create_avatar_file(
+    self,
+    raw_data: Union[bytes, Iterable[bytes]],
+    content_type: str,
+  ) -> File:
+    chunks = [raw_data] if isinstance(raw_data, bytes) else raw_data
+    file_ = File.create_from_chunks(chunks, mimetype=content_type, max_size=AVATAR_MAX_SIZE)
+    if not file_.mimetype or not file_.mimetype.startswith('image/'):
+      file_.discard()
+      raise ValueError(f'expected image, got {file_.mimetype!r}')
+    return file_
 
+  def _set_avatar_file(self, file_: File) -> None:
     self.avatar_url = None
+    self.avatar_etag = None
+    self.avatar_last_modified = None
     if self.avatar_file:
       session.delete(self.avatar_file)
-    with File.create(mimetype=content_type) as (fp, file_):
-      fp.write(raw_data)
-      self.avatar_file = file_
+    self.avatar_file = file_
 
   def refresh_avatar(self, url: str, **kwargs):
-    # TODO: Run HEAD request and check if avatar actually needs to be updated.
+    """
+    Downloads the avatar from *url*. If the user already has an avatar file, the request is
+    conditional on the #avatar_etag and #avatar_last_modified and the file is only replaced
+    if the server responds with a different image.
+    """
+
     method = kwargs.pop('method', 'GET')
-    response = requests.request(method, url, **kwargs)
-    response.raise_for_status()
-    content_type = response.headers.get('Content-Type')
-    if not content_type or not content_type.startswith('image/'):
-      raise ValueError(f'no or unexpected Content-Type: {content_type!r}')
-    self.save_avatar(response.content, content_type)
+    kwargs.setdefault('timeout', AVATAR_REQUEST_TIMEOUT)
+    kwargs.setdefault('stream', True)
+    headers = dict(kwargs.pop('headers', None) or {})
+    if self.avatar_file:
+      if self.avatar_etag:
+        headers['If-None-Match'] = self.avatar_etag
+      if self.avatar_last_modified:
+        headers['If-Modified-Since'] = self.avatar_last_modified
+    with requests.request(method, url, headers=headers, **kwargs) as response:
+      if response.status_code == 304 and self.avatar_file:
+        logger.debug('Avatar of user %s not modified', self.id)
+        avatar_refreshes.inc(result='not_modified')
+        return
+      response.raise_for_status()
+      content_type = response.headers.get('Content-Type')
+      if not content_type or not content_type.startswith('image/'):
+        raise ValueError(f'no or unexpected Content-Type: {content_type!r}')
+      file_ = self._create_avatar_file(response.iter_content(AVATAR_CHUNK_SIZE), content_type)
+
+    if self.avatar_file and self.avatar_file.state == file_.state \
+        and self.avatar_file.mimetype == file_.mimetype:
+      logger.debug('Avatar of user %s is unchanged', self.id)
+      avatar_refreshes.inc(result='unchanged')
+      file_.discard()
+    else:
+      self._set_avatar_file(file_)
+      avatar_refreshes.inc(result='updated')
+    self.avatar_etag = response.headers.get('ETag')
+    self.avatar_last_modified = response.headers.get('Last-Modified')
 
   def create_token(self, expiration_date: datetime.datetime) -> 'Token':
     token = Token(user=self, value=str(uuid.uuid4()), expiration_date=expiration_date)
@@ -79,6 +150,13 @@ class Token(Entity):
   expiration_date = Column(DateTime, nullable=False)
   revoked_at = Column(DateTime, nullable=True)
 
+  #: The last time the token was used, updated only when it's expiration is extended.
+  last_seen_at = Column(DateTime, nullable=True)
+
+  __table_args__ = (
+    Index(__tablename__ + '.ix_expiration_date', 'expiration_date'),
+  )
+
   get = instance_getter['Token']()
 
   @property
@@ -94,7 +172,44 @@ class Token(Entity):
     return datetime.datetime.utcnow() >= self.expiration_date
 
   def revoke(self) -> None:
+    """
+    Revoke the token. Also increments the #TOKEN_VERSION so that other processes drop the
+    token from their cache.
+    """
+
     self.revoked_at = datetime.datetime.utcnow()
+    Version.increment(TOKEN_VERSION)
+
+
+class RevokedToken(Entity):
+  """
+  Records the revocation of a signed token (see #feedr_backend.app.tokens). Signed tokens are
+  not stored in the database, so their ID is recorded here until the token expires.
+  """
+
+  __tablename__ = __name__ + '.RevokedToken'
+
+  token_id = Column(String, primary_key=True)
+  expiration_date = Column(DateTime, nullable=False)
+  revoked_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+  __table_args__ = (
+    Index(__tablename__ + '.ix_expiration_date', 'expiration_date'),
+  )
+
+  @classmethod
+  def revoke(cls, token_id: str, expiration_date: datetime.datetime) -> None:
+    session.merge(cls(token_id=token_id, expiration_date=expiration_date))
+    Version.increment(TOKEN_VERSION)
+
+  @classmethod
+  def active_token_ids(cls) -> List[str]:
+    """
+    Returns the IDs of all revoked tokens that have not expired yet.
+    """
+
+    now = datetime.datetime.utcnow()
+    return [x for x, in session.query(cls.token_id).filter(cls.expiration_date > now)]
 
 
 class LoginState(Entity):
@@ -104,8 +219,56 @@ class LoginState(Entity):
   expires_at = Column(DateTime, nullable=False)
   data = Column(JSON, nullable=False)
 
+  __table_args__ = (
+    Index(__tablename__ + '.ix_expires_at', 'expires_at'),
+  )
+
   get = instance_getter['LoginState']()
 
   @property
   def is_expired(self) -> bool:
     return datetime.datetime.utcnow() >= self.expires_at
+
+
+def sweep_expired(entity: Any, expires_column: Column, batch_size: int = 500) -> int:
+  """
+  Delete the rows of *entity* whose *expires_column* lies in the past, in batches of
+  *batch_size* rows that are committed separately to keep locks short. Returns the number
+  of deleted rows.
+  """
+
+  [primary_key] = entity.__table__.primary_key.columns
+  pk_column = getattr(entity, primary_key.key)
+  total = 0
+  while True:
+    check_cancelled()
+    now = datetime.datetime.utcnow()
+    ids = [x for x, in (session.query(pk_column)
+      .filter(expires_column < now)
+      .limit(batch_size))]
+    if not ids:
+      break
+    session.query(entity).filter(pk_column.in_(ids)).delete(synchronize_session=False)
+    session.commit()
+    total += len(ids)
+    expired_rows_swept.inc(len(ids), table=entity.__tablename__)
+    if len(ids) < batch_size:
+      break
+  if total:
+    logger.info('Deleted %d expired row(s) from %s', total, entity.__tablename__)
+  return total
+
+
+@register_task('user.sweep_expired')
+@datamodel
+class SweepExpiredTask(BaseTask):
+  """
+  Deletes expired #Token#s, #RevokedToken#s and #LoginState#s.
+  """
+
+  batch_size: int = 500
+
+  def execute(self):
+    sweep_expired(Token, Token.expiration_date, self.batch_size)
+    sweep_expired(RevokedToken, RevokedToken.expiration_date, self.batch_size)
+    sweep_expired(LoginState, LoginState.expires_at, self.batch_size)
@@ -0,0 +1,42 @@
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.exc import IntegrityError
+
+from ._base import Entity
+from ._session import session
+
+
+class Version(Entity):
+  """
+  A named counter that is incremented whenever the data it represents changes. Processes that
+  cache that data compare the counter with the value they have seen before to find out if they
+  need to invalidate their cache.
+  """
+
+  __tablename__ = __name__ + '.Version'
+
+  name = Column(String, primary_key=True)
+  value = Column(Integer, nullable=False, default=0)
+
+  @classmethod
+  def get_value(cls, name: str) -> int:
+    return session.query(cls.value).filter(cls.name == name).scalar() or 0
+
+  @classmethod
+  def increment(cls, name: str) -> None:
+    """
+    Increment the counter *name* as part of the current transaction.
+    """
+
+    updated = (session.query(cls)
+      .filter(cls.name == name)
+      .update({cls.value: cls.value + 1}, synchronize_session=False))
+    if updated:
+      return
+    try:
+      with session.begin_nested():
+        session.add(cls(name=name, value=1))
+    except IntegrityError:
+      # The counter was created concurrently.
+      session.query(cls).filter(cls.name == name).update(
+        {cls.value: cls.value + 1}, synchronize_session=False)
@@ -1,42 +1,547 @@
 
+import asyncio
+import contextvars
+import datetime
 import functools
+import gzip
 import heapq
+import importlib
+import itertools
+import json
 import logging
+import os
+import resource
+import select
+import subprocess
+import sys
 import time
 import threading
-from typing import Callable, List, Tuple
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, List, NamedTuple, Optional, TextIO, Tuple, Type, Union
 
-from .model import session, session_context
-from .model.task import Task
+from nr.parsing.date import Duration
+
+from .model import session, session_context, task_session
+from .model.file import File
+from .model.lease import Lease
+from .model.task import (BaseTask, Task, TaskCancelled, TaskContext, TaskExecution,
+  TaskExecutionError, TaskExecutor, TaskTimeoutError, current_task_context, format_error,
+  ensure_recurring_task, run_in_session, run_task_impl, task_context)
 
 logger = logging.getLogger(__name__)
 
 
+class LeaseHeartbeat(threading.Thread):
+  """
+  Periodically renews the lease on a task while it is being executed by a worker. Use as a
+  context manager around the task execution. The #cancelled event is set when the heartbeat
+  notices that the cancellation of the task was requested.
+  """
+
+  #: The maximum number of seconds between two heartbeats.
+  max_interval = 10.0
+
+  def __init__(self, task_id: int, worker_id: str, lease_duration: datetime.timedelta) -> None:
+    super().__init__(daemon=True)
+    self.__task_id = task_id
+    self.__worker_id = worker_id
+    self.__lease_duration = lease_duration
+    self.__stopped = threading.Event()
+    self.cancelled = threading.Event()
+
+  def __enter__(self) -> 'LeaseHeartbeat':
+    self.start()
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.__stopped.set()
+    self.join()
+
+  def run(self):
+    interval = min(self.__lease_duration.total_seconds() / 3, self.max_interval)
+    while not self.__stopped.wait(interval):
+      try:
+        with session_context():
+          held = Task.renew_leases([self.__task_id], self.__worker_id, self.__lease_duration)
+        if self.__task_id not in held:
+          logger.warning('Worker %r lost the lease on task %d', self.__worker_id, self.__task_id)
+          break
+        if held[self.__task_id] and not self.cancelled.is_set():
+          logger.info('Cancellation of task %d was requested', self.__task_id)
+          self.cancelled.set()
+      except:
+        logger.exception('Error renewing lease on task %d', self.__task_id)
+
+
 class TaskWorker(threading.Thread):
+  """
+  Claims and executes due tasks. While executing a task, the worker keeps renewing it's lease
+  on the task. Every worker also periodically requeues tasks whose lease has expired, which
+  happens when a worker process dies while executing a task.
+
+  Errors of the bookkeeping (e.g. because the database is unavailable) are logged and the worker
+  retries after #error_interval seconds. The lease of a task whose status could not be updated
+  expires and the task is requeued by the next reaper.
+  """
+
+  #: The number of seconds to wait before polling for new tasks when the queue is empty.
+  poll_interval = 0.1
+
+  #: The number of seconds to wait after an error before the worker continues.
+  error_interval = 5.0
+
+  def __init__(
+    self,
+    worker_id: str,
+    lease_duration: float = 60.0,
+    max_attempts: int = 3,
+    executor: Optional[TaskExecutor] = None,
+  ) -> None:
+    super().__init__()
+    self.__worker_id = worker_id
+    self.__lease_duration = datetime.timedelta(seconds=lease_duration)
+    self.__max_attempts = max_attempts
+    self.__executor = executor
+    self.__stop = False
+
+  def stop(self):
+    self.__stop = True
+
+  def run(self):
+    last_reaped_at = 0.0
+    while not self.__stop:
+      try:
+        if time.time() - last_reaped_at > self.__lease_duration.total_seconds():
+          with session_context():
+            Task.reap_expired_leases(self.__max_attempts)
+          last_reaped_at = time.time()
+        with session_context():
+          task = Task.claim(self.__worker_id, self.__lease_duration)
+          if not task:
+            time.sleep(self.poll_interval)
+          else:
+            with LeaseHeartbeat(task.id, self.__worker_id, self.__lease_duration) as heartbeat:
+              task.execute(self.__executor, heartbeat.cancelled)
+      except:
+        # The session_context() already rolled back the sessions.
+        logger.exception('Error in task worker %r', self.__worker_id)
+        time.sleep(self.error_interval)
+
+
+def _run_sync_task(impl: BaseTask) -> None:
+  with session_context():
+    run_task_impl(impl)
+
 
-  def __init__(self, worker_id: str) -> None:
+class AsyncTaskWorker(threading.Thread):
+  """
+  Executes up to *concurrency* tasks at the same time on a single asyncio event loop. Tasks
+  that implement #BaseTask.execute() as a coroutine function are awaited on the loop, other
+  tasks are executed in a pool of *threads*. All database access of the worker (claiming
+  tasks, heartbeats and status updates) happens in a separate pool of *session_threads*, as
+  the session is not safe to use from the event loop, so that long running tasks can not
+  delay the heartbeat.
+
+  The worker shares the claim, lease and retry bookkeeping with the #TaskWorker, so both kinds
+  of workers can consume the same queue. The leases of all running tasks are renewed with a
+  single heartbeat.
+  """
+
+  #: The number of seconds to wait before polling for new tasks when the queue is empty.
+  poll_interval = 0.1
+
+  def __init__(
+    self,
+    worker_id: str,
+    concurrency: int = 100,
+    threads: int = 4,
+    lease_duration: float = 60.0,
+    max_attempts: int = 3,
+    time_limit: Optional[float] = None,
+    session_threads: int = 2,
+  ) -> None:
     super().__init__()
     self.__worker_id = worker_id
+    self.__concurrency = concurrency
+    self.__threads = threads
+    self.__session_threads = session_threads
+    self.__task_executor: Optional[ThreadPoolExecutor] = None
+    self.__lease_duration = datetime.timedelta(seconds=lease_duration)
+    self.__max_attempts = max_attempts
+    self.__time_limit = time_limit
+    self.__running: Dict[int, TaskExecution] = {}
     self.__stop = False
 
   def stop(self):
     self.__stop = True
 
   def run(self):
+    asyncio.run(self._main())
+
+  async def _main(self) -> None:
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(
+      ThreadPoolExecutor(self.__session_threads, f'{self.__worker_id}:session'))
+    self.__task_executor = ThreadPoolExecutor(self.__threads, f'{self.__worker_id}:tasks')
+    heartbeat = loop.create_task(self._heartbeat())
+    slots = asyncio.Semaphore(self.__concurrency)
+    futures = set()
+    last_reaped_at = 0.0
+
     while not self.__stop:
+      if time.time() - last_reaped_at > self.__lease_duration.total_seconds():
+        try:
+          await run_in_session(Task.reap_expired_leases, self.__max_attempts)
+          last_reaped_at = time.time()
+        except:
+          logger.exception('Error reaping expired leases')
+          await asyncio.sleep(self.poll_interval)
+          continue
+      await slots.acquire()
+      try:
+        execution = await run_in_session(self._claim)
+      except:
+        slots.release()
+        logger.exception('Error claiming task')
+        await asyncio.sleep(self.poll_interval)
+        continue
+      if execution is None:
+        slots.release()
+        await asyncio.sleep(self.poll_interval)
+        continue
+      future = loop.create_task(self._execute(execution))
+      futures.add(future)
+      future.add_done_callback(futures.discard)
+      future.add_done_callback(lambda _: slots.release())
+
+    if futures:
+      logger.info('Waiting for %d running task(s)', len(futures))
+      await asyncio.wait(futures)
+    heartbeat.cancel()
+    self.__task_executor.shutdown(wait=False)
+
+  def _claim(self) -> Optional[TaskExecution]:
+    task = Task.claim(self.__worker_id, self.__lease_duration)
+    if not task:
+      return None
+    return task.begin_execution(self.__time_limit, threading.Event())
+
+  def _end(self, execution: TaskExecution) -> None:
+    task = task_session.query(Task).get(execution.task_id)
+    if task is None:
+      logger.warning('Task %d disappeared before it completed', execution.task_id)
+      return
+    task.end_execution(execution)
+
+  async def _execute(self, execution: TaskExecution) -> None:
+    self.__running[execution.task_id] = execution
+    try:
+      if execution.error is None:
+        try:
+          await self._run_impl(execution)
+        except Exception as exc:
+          execution.error = exc
+      await run_in_session(self._end, execution)
+    except:
+      logger.exception('Error finishing task %d', execution.task_id)
+    finally:
+      self.__running.pop(execution.task_id, None)
+
+  async def _run_impl(self, execution: TaskExecution) -> None:
+    """
+    Run the task implementation until it completes, is cancelled or exceeds it's time limit.
+    Coroutines are cancelled when the task is, but a task that runs in a thread can only be
+    interrupted with #check_cancelled().
+    """
+
+    assert execution.impl is not None
+    loop = asyncio.get_event_loop()
+    context = execution.context
+    with task_context(context):
+      if execution.is_async:
+        future = asyncio.ensure_future(execution.impl.execute())
+      else:
+        future = loop.run_in_executor(
+          self.__task_executor, contextvars.copy_context().run, _run_sync_task, execution.impl)
+
+    while not future.done():
+      try:
+        context.check()
+      except (TaskCancelled, TaskTimeoutError):
+        future.cancel()
+        raise
+      timeout = LeaseHeartbeat.max_interval
+      if context.remaining_time is not None:
+        timeout = max(min(timeout, context.remaining_time), 0)
+      await asyncio.wait({future}, timeout=timeout)
+    future.result()
+
+  async def _heartbeat(self) -> None:
+    interval = min(self.__lease_duration.total_seconds() / 3, LeaseHeartbeat.max_interval)
+    while True:
+      await asyncio.sleep(interval)
+      task_ids = list(self.__running)
+      try:
+        held = await run_in_session(Task.renew_leases, task_ids, self.__worker_id,
+          self.__lease_duration)
+      except:
+        logger.exception('Error renewing leases on %d task(s)', len(task_ids))
+        continue
+      for task_id in task_ids:
+        execution = self.__running.get(task_id)
+        if execution is None:
+          continue
+        if task_id not in held:
+          logger.warning('Worker %r lost the lease on task %d', self.__worker_id, task_id)
+          self.__running.pop(task_id, None)
+        elif held[task_id] and not execution.context.cancelled.is_set():
+          logger.info('Cancellation of task %d was requested', task_id)
+          execution.context.cancelled.set()
+
+
+class RecurringTask(NamedTuple):
+  """
+  Describes a recurring task that is kept in the queue by the #Scheduler.
+  """
+
+  schedule_key: str
+  name: str
+  task_impl: BaseTask
+  recurrence: Union[str, Duration]
+
+
+class Scheduler(threading.Thread):
+  """
+  Ensures that the *recurring_tasks* are queued (see #ensure_recurring_task()). Multiple
+  schedulers can run in a cluster, but only the one that holds the `scheduler` #Lease
+  enqueues tasks. Other schedulers stand by and take over when the leader stops renewing
+  it's lease.
+  """
+
+  #: The name of the #Lease that the schedulers compete for.
+  lease_name = 'scheduler'
+
+  def __init__(
+    self,
+    scheduler_id: str,
+    recurring_tasks: List[RecurringTask],
+    lease_duration: float = 60.0,
+  ) -> None:
+    super().__init__()
+    self.__scheduler_id = scheduler_id
+    self.__recurring_tasks = recurring_tasks
+    self.__lease_duration = datetime.timedelta(seconds=lease_duration)
+    self.__stopped = threading.Event()
+    self.is_leader = False
+
+  def stop(self):
+    self.__stopped.set()
+
+  def run(self):
+    interval = self.__lease_duration.total_seconds() / 3
+    while True:
+      try:
+        with session_context():
+          self._tick()
+      except:
+        logger.exception('Error in scheduler %r', self.__scheduler_id)
+      if self.__stopped.wait(interval):
+        break
+    if self.is_leader:
       with session_context():
-        task = Task.pending().first()
-        if not task:
-          time.sleep(0.1)
-        else:
-          task.execute(self.__worker_id)
+        Lease.release(self.lease_name, self.__scheduler_id)
+      logger.info('Scheduler %r released the leadership', self.__scheduler_id)
+
+  def _tick(self) -> None:
+    is_leader = Lease.acquire(self.lease_name, self.__scheduler_id, self.__lease_duration)
+    if is_leader != self.is_leader:
+      logger.info('Scheduler %r %s the leadership', self.__scheduler_id,
+        'acquired' if is_leader else 'lost')
+      self.is_leader = is_leader
+    if not is_leader:
+      return
+    for recurring_task in self.__recurring_tasks:
+      ensure_recurring_task(
+        recurring_task.schedule_key,
+        recurring_task.name,
+        recurring_task.task_impl,
+        recurring_task.recurrence)
+
+
+class ProcessTaskExecutor(TaskExecutor):
+  """
+  Executes every task in a new process, so that a task that leaks memory or hogs the CPU cannot
+  degrade the worker process. The combined stdout/stderr of the process is streamed into a
+  gzip compressed #File that is referenced by #Task.log_file.
+
+  The *command* must run #run_isolated_job() in the child process (e.g. the hidden
+  `feedr_backend tasks exec` command). The memory limit is applied with `RLIMIT_AS` in the child
+  process. The process is killed if it exceeds the time limit or if the cancellation of the task
+  is requested.
+  """
+
+  #: The interval in seconds in which the executor checks if the task was cancelled.
+  poll_interval = 1.0
+
+  def __init__(
+    self,
+    command: List[str],
+    memory_limit: Optional[int] = None,
+    time_limit: Optional[float] = None,
+    chunk_size: int = 64 * 1024,
+  ) -> None:
+    self.command = command
+    self.memory_limit = memory_limit
+    self.time_limit = time_limit
+    self.chunk_size = chunk_size
+
+  def run(self, task: Task, impl: BaseTask) -> None:
+    context = current_task_context() or TaskContext(task.id)
+    memory_limits = [x for x in (self.memory_limit, impl.memory_limit) if x is not None]
+    result_r, result_w = os.pipe()
+    job = {
+      'task_id': task.id,
+      'class_name': task.class_name,
+      'args': task.args,
+      'memory_limit': min(memory_limits, default=None),
+      'deadline': context.deadline,
+      'result_fd': result_w,
+    }
+
+    try:
+      proc = subprocess.Popen(
+        self.command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        pass_fds=[result_w],
+        env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    finally:
+      os.close(result_w)
+
+    with os.fdopen(result_r, 'rb') as result_fp:
+      assert proc.stdin and proc.stdout
+      proc.stdin.write(json.dumps(job).encode('utf8'))
+      proc.stdin.close()
+      logger.info('Executing task %s in process %d', task, proc.pid)
+      # The result pipe is drained together with the output, otherwise a child writing a
+      # result that exceeds the pipe buffer would block forever.
+      killed_by, result_data = self._capture_output(task, proc, context, result_fp)
+      returncode = proc.wait()
+      result = json.loads(result_data or b'{}')
+
+    if killed_by is not None:
+      raise killed_by
+    if returncode != 0 or result.get('error'):
+      raise TaskExecutionError(
+        result.get('error') or f'task process exited with code {returncode}',
+        _resolve_error_type(result.get('error_type')))
+
+  def _capture_output(
+    self,
+    task: Task,
+    proc: subprocess.Popen,
+    context: TaskContext,
+    result_fp: BinaryIO,
+  ) -> Tuple[Optional[BaseException], bytes]:
+    """
+    Streams the output of *proc* into the log file of the *task* and reads the result of the
+    process from *result_fp* until both reach EOF. Kills the process if it exceeds it's time
+    limit or if the task is cancelled. Returns the exception that describes why the process
+    was killed and the result data.
+    """
+
+    assert proc.stdout
+    killed_by: Optional[BaseException] = None
+    streams = [proc.stdout, result_fp]
+    result_data = bytearray()
+    with File.create(filename=f'task-{task.id}.log.gz', mimetype='application/gzip') as (fp, log_file):
+      with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+        while streams:
+          try:
+            context.check()
+          except (TaskCancelled, TaskTimeoutError) as exc:
+            logger.warning('Killing process %d of task %s: %s', proc.pid, task, exc)
+            proc.kill()
+            gz.write(f'\n*** Killed: {exc}\n'.encode('utf8'))
+            killed_by = exc if isinstance(exc, TaskCancelled) else \
+              TaskExecutionError(str(exc), TaskTimeoutError)
+            break
+          timeout = self.poll_interval
+          if context.remaining_time is not None:
+            timeout = max(min(timeout, context.remaining_time), 0)
+          ready, _, _ = select.select(streams, [], [], timeout)
+          for stream in ready:
+            data = os.read(stream.fileno(), self.chunk_size)
+            if not data:
+              streams.remove(stream)
+            elif stream is proc.stdout:
+              gz.write(data)
+            else:
+              result_data += data
+    proc.stdout.close()
+
+    # The log is committed independently of the task's result.
+    session.commit()
+    task_session.query(Task).filter(Task.id == task.id).update(
+      {Task.log_file: log_file.id}, synchronize_session=False)
+    task_session.commit()
+    return killed_by, bytes(result_data)
+
+
+def _resolve_error_type(name: Optional[str]) -> Optional[Type[BaseException]]:
+  if not name:
+    return None
+  module_name, _, member_name = name.partition(':')
+  try:
+    value = importlib.import_module(module_name)
+    for part in member_name.split('.'):
+      value = getattr(value, part)
+  except (ImportError, AttributeError):
+    return None
+  if isinstance(value, type) and issubclass(value, BaseException):
+    return value
+  return None
+
+
+def run_isolated_job(stdin: TextIO) -> int:
+  """
+  Entrypoint in the child process started by #ProcessTaskExecutor. Reads the job description
+  from *stdin*, executes the task and writes the result to the file descriptor specified in
+  the job. Returns the exit code for the process.
+  """
+
+  job = json.load(stdin)
+  if job['memory_limit'] is not None:
+    resource.setrlimit(resource.RLIMIT_AS, (job['memory_limit'], job['memory_limit']))
+
+  result: Dict[str, Any] = {}
+  try:
+    impl = Task(class_name=job['class_name'], args=job['args']).load()
+    with task_context(TaskContext(job['task_id'], job['deadline'])), session_context():
+      run_task_impl(impl)
+  except BaseException as exc:
+    traceback.print_exc()
+    result['error_type'] = f'{type(exc).__module__}:{type(exc).__qualname__}'
+    result['error'] = format_error(exc)
+
+  sys.stdout.flush()
+  with os.fdopen(job['result_fd'], 'w') as fp:
+    json.dump(result, fp)
+  return 1 if result else 0
 
 
 class BackgroundDispatcher(threading.Thread):
+  """
+  Calls functions at a specified time in a background thread. The schedule is only held in
+  memory, use #ensure_recurring_task() for schedules that need to survive a restart.
+  """
 
   def __init__(self) -> None:
     super().__init__()
-    self.__heap: List[Tuple[float, Callable[[], None]]] = []
+    self.__heap: List[Tuple[float, int, Callable[[], None]]] = []
+    self.__counter = itertools.count()
     self.__lock = threading.Lock()
     self.__cond = threading.Condition(self.__lock)
     self.__stop = False
@@ -48,7 +553,7 @@ class BackgroundDispatcher(threading.Thread):
 
   def push(self, run_at: float, callback: Callable[[], None]) -> None:
     with self.__cond:
-      heapq.heappush(self.__heap, (run_at, callback))
+      heapq.heappush(self.__heap, (run_at, next(self.__counter), callback))
       self.__cond.notify()
 
   def push_recurring(self, interval: float, callback: Callable[[], None]) -> None:
@@ -63,18 +568,16 @@ class BackgroundDispatcher(threading.Thread):
   def run(self):
     while True:
       with self.__cond:
-        if not self.__heap:
-          self.__cond.wait()
+        # Sleep until the earliest deadline, or until we're woken up by a new item that may
+        # have an earlier deadline.
+        while not self.__stop and (not self.__heap or self.__heap[0][0] > time.time()):
+          timeout = self.__heap[0][0] - time.time() if self.__heap else None
+          self.__cond.wait(timeout)
         if self.__stop:
           break
-        if not self.__heap:
-          continue
-        t, callback = heapq.heappop(self.__heap)
-      if t <= time.time():
-        try:
-          logger.info('Calling %s', callback)
-          callback()
-        except:
-          logger.exception('Error in background dispatcher')
-      else:
-        self.push(t, callback)
+        _, _, callback = heapq.heappop(self.__heap)
+      try:
+        logger.info('Calling %s', callback)
+        callback()
+      except:
+        logger.exception('Error in background dispatcher')
@@ -0,0 +1,101 @@
+
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from databind.core import datamodel
+
+from .model import init_db, session, task_session
+from .model.file import LocalStorageManager, init_storage
+from .model.task import BaseTask, Task, TaskStatus, queue_task, register_task
+from .task_worker import ProcessTaskExecutor, TaskWorker
+
+#: Runs the job in the child process of the #ProcessTaskExecutor, this module is imported to
+#: register the tasks.
+CHILD_SCRIPT = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+from feedr_backend.model import init_db
+from feedr_backend.task_worker import run_isolated_job
+from feedr_backend import test_task_worker
+init_db(sys.argv[2])
+sys.exit(run_isolated_job(sys.stdin))
+'''
+
+
+@register_task('test_task_worker.print')
+@datamodel
+class PrintTask(BaseTask):
+  message: str
+  error_size: int = 0
+
+  def execute(self):
+    print(self.message)
+    if self.error_size:
+      raise ValueError('x' * self.error_size)
+
+
+def _init_db(tmp_path: Path) -> str:
+  db_url = 'sqlite:///' + str(tmp_path / 'test.db')
+  init_db(db_url, create_tables=True)
+  init_storage(LocalStorageManager(tmp_path / 'media'))
+  return db_url
+
+
+def test_process_task_executor(tmp_path: Path) -> None:
+  db_url = _init_db(tmp_path)
+  executor = ProcessTaskExecutor([
+    sys.executable, '-c', CHILD_SCRIPT, str(Path(__file__).parent.parent), db_url])
+  try:
+    queue_task('print', PrintTask('Hello from the child process'))
+    task = Task.claim('worker')
+    assert task is not None
+    task.execute(executor)
+    assert task.status == TaskStatus.COMPLETED
+    assert b'Hello from the child process' in b''.join(task.iter_log())
+
+    # The result of the process exceeds the size of a pipe buffer.
+    queue_task('fail', PrintTask('Failing', error_size=1024 * 1024))
+    task = Task.claim('worker')
+    assert task is not None
+    task.execute(executor)
+    assert task.status == TaskStatus.FAILED
+    assert task.last_error.endswith('ValueError: ' + 'x' * 1024 * 1024)
+    assert b'Failing' in b''.join(task.iter_log())
+  finally:
+    session.remove()
+    task_session.remove()
+
+
+def test_task_worker_survives_errors(tmp_path: Path, monkeypatch) -> None:
+  _init_db(tmp_path)
+  errors: List[Exception] = []
+  claim = Task.claim
+
+  def _claim(*args):
+    if len(errors) < 2:
+      errors.append(RuntimeError('database is unavailable'))
+      raise errors[-1]
+    return claim(*args)
+
+  monkeypatch.setattr(Task, 'claim', _claim)
+  worker = TaskWorker('worker')
+  worker.error_interval = 0.01
+  worker.start()
+  try:
+    queue_task('print', PrintTask('Hello'))
+    task_session.remove()
+    for _ in range(100):
+      if Task.get(name='print').instance.status == TaskStatus.COMPLETED:
+        break
+      task_session.remove()
+      time.sleep(0.05)
+    assert len(errors) == 2
+    assert worker.is_alive()
+    assert Task.get(name='print').instance.status == TaskStatus.COMPLETED
+  finally:
+    worker.stop()
+    worker.join()
+    session.remove()
+    task_session.remove()